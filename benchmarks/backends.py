@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import platform
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import weakref
+
+from siosocks.io.asyncio import open_connection
+
+HOST = "127.0.0.1"
+DOMAIN = "localhost"
+USERNAME = "yoba"
+PASSWORD = "foo"
+BACKENDS = ("asyncio", "asyncio-protocol", "selector", "socketserver", "trio")
+# name: (client kwargs, auth server)
+VARIANTS = {
+    "socks4": (dict(socks_version=4), False),
+    "socks4a": (dict(socks_version=4, domain=True), False),
+    "socks5": (dict(socks_version=5), False),
+    "socks5-domain": (dict(socks_version=5, domain=True), False),
+    "socks5-auth": (dict(socks_version=5, username=USERNAME, password=PASSWORD), True),
+}
+
+
+echo_tasks = weakref.WeakSet()
+
+
+async def echo_handler(r, w):
+    echo_tasks.add(asyncio.current_task())
+    with contextlib.suppress(ConnectionError):
+        while b := await r.read(2**16):
+            w.write(b)
+            await w.drain()
+    w.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def rss(pid):
+    """
+    Resident set size of process in bytes, linux only
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+class ProxyProcess:
+    """
+    One-shot socks server (`python -m siosocks`) in child process
+    """
+
+    def __init__(self, backend, auth, extra_args):
+        self.port = free_port()
+        self.args = ["-u", "-m", "siosocks", "--backend", backend, "--host", HOST, "--port", str(self.port)]
+        if auth:
+            self.args += ["--socks", "5", "--username", USERNAME, "--password", PASSWORD]
+        self.args += extra_args
+        self.process = None
+
+    async def __aenter__(self):
+        # shutdown with open connections is noisy, keep log aside and show it only on startup failure
+        self.log = tempfile.TemporaryFile()
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            *self.args,
+            stdout=subprocess.PIPE,
+            stderr=self.log,
+        )
+        # server prints banner after socket is bound
+        if not await self.process.stdout.readline():
+            code = await self.process.wait()
+            self.log.seek(0)
+            sys.stderr.write(self.log.read().decode(errors="replace"))
+            self.log.close()
+            raise RuntimeError(f"Proxy exited with code {code}")
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.process.wait(), 10)
+        except TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+        finally:
+            self.log.close()
+
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+async def measure(proxy, echo_port, kwargs, ns):
+    kwargs = dict(kwargs)
+    host = DOMAIN if kwargs.pop("domain", False) else HOST
+
+    def connect():
+        return open_connection(host, echo_port, socks_host=HOST, socks_port=proxy.port, **kwargs)
+
+    # memory of idle established tunnels, measured first on fresh process
+    before = rss(proxy.process.pid)
+    tunnels = []
+    for _ in range(ns.idle):
+        r, w = await connect()
+        w.write(b"x")
+        await r.readexactly(1)
+        tunnels.append(w)
+    after = rss(proxy.process.pid)
+    for w in tunnels:
+        w.close()
+    await asyncio.gather(*(w.wait_closed() for w in tunnels), return_exceptions=True)
+    per_connection = None
+    if before is not None and after is not None and ns.idle:
+        per_connection = (after - before) / ns.idle
+
+    # handshake rate and connect latency with `concurrency` clients in parallel
+    latencies = []
+    remaining = ns.connections
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            _, w = await connect()
+            latencies.append(time.perf_counter() - start)
+            w.close()
+            await w.wait_closed()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(ns.concurrency)))
+    rate = len(latencies) / (time.perf_counter() - start)
+
+    # bulk echo through single tunnel
+    payload = b"x" * 2**20
+    r, w = await connect()
+
+    async def send():
+        for _ in range(ns.megabytes):
+            w.write(payload)
+            await w.drain()
+
+    async def receive():
+        size = 0
+        while size < len(payload) * ns.megabytes:
+            size += len(await r.read(2**16))
+        return size
+
+    start = time.perf_counter()
+    _, size = await asyncio.gather(send(), receive())
+    throughput = size / 2**20 / (time.perf_counter() - start)
+    w.close()
+    await w.wait_closed()
+
+    return dict(
+        handshakes_per_s=rate,
+        connect_p50_ms=percentile(latencies, 50) * 1000,
+        connect_p99_ms=percentile(latencies, 99) * 1000,
+        throughput_mb_s=throughput,
+        memory_per_connection_kb=None if per_connection is None else per_connection / 1024,
+    )
+
+
+async def run(ns):
+    endpoint = await asyncio.start_server(echo_handler, HOST, 0)
+    echo_port = endpoint.sockets[0].getsockname()[1]
+    results = {}
+    async with endpoint:
+        for backend in ns.backend or BACKENDS:
+            for name in ns.variant or VARIANTS:
+                kwargs, auth = VARIANTS[name]
+                try:
+                    async with ProxyProcess(backend, auth, ns.proxy_args) as proxy:
+                        result = await measure(proxy, echo_port, kwargs, ns)
+                except (OSError, RuntimeError) as exc:
+                    print(f"{backend:<17} {name:<14} failed: {exc!r}")
+                    continue
+                results[f"{backend}/{name}"] = result
+                memory = result["memory_per_connection_kb"]
+                print(
+                    f"{backend:<17} {name:<14} "
+                    f"{result['handshakes_per_s']:8,.0f} hs/s  "
+                    f"p50 {result['connect_p50_ms']:6.2f} ms  "
+                    f"p99 {result['connect_p99_ms']:6.2f} ms  "
+                    f"{result['throughput_mb_s']:7.1f} MB/s  "
+                    f"{'-' if memory is None else f'{memory:.1f}':>6} KiB/conn",
+                )
+        # proxy is gone, echo handlers are about to see end of file
+        if echo_tasks:
+            await asyncio.wait(echo_tasks, timeout=1)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Socks server backends through local echo server")
+    parser.add_argument("--backend", action="append", choices=BACKENDS, help="Server backend [default: all]")
+    parser.add_argument("--variant", action="append", choices=sorted(VARIANTS), help="Variant to run [default: all]")
+    parser.add_argument("--connections", default=500, type=int, help="Handshakes per variant [default: %(default)s]")
+    parser.add_argument("--concurrency", default=8, type=int, help="Parallel handshakes [default: %(default)s]")
+    parser.add_argument("--megabytes", default=64, type=int, help="Bulk echo size [default: %(default)s]")
+    parser.add_argument("--idle", default=500, type=int, help="Idle tunnels for memory usage [default: %(default)s]")
+    parser.add_argument("--json", default=None, help="Write results to json file")
+    parser.add_argument(
+        "proxy_args",
+        nargs=argparse.REMAINDER,
+        help="Extra `python -m siosocks` arguments after `--`, e.g. `-- --splice`",
+    )
+    ns = parser.parse_args()
+    if ns.proxy_args[:1] == ["--"]:
+        ns.proxy_args = ns.proxy_args[1:]
+    results = asyncio.run(run(ns))
+    if ns.json is not None:
+        meta = dict(python=platform.python_version(), platform=platform.platform(), args=vars(ns))
+        with open(ns.json, "w") as f:
+            json.dump(dict(meta=meta, results=results), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import json
+import socket
+import statistics
+import threading
+import time
+import tracemalloc
+
+from siosocks.buffers import BufferPool
+from siosocks.io.socket import relay
+
+HOST = "127.0.0.1"
+# name: (block_size, max_block_size, buffer pool size)
+CONFIGS = {
+    "fixed-4k": (2**12, None, 0),
+    "fixed-8k": (2**13, None, 0),
+    "fixed-64k": (2**16, None, 0),
+    "fixed-256k": (2**18, None, 0),
+    "adaptive-8k-256k": (2**13, 2**18, 0),
+    "pooled-8k": (2**13, None, 4),
+    "pooled-adaptive-8k-256k": (2**13, 2**18, 4),
+}
+MESSAGE = b"x" * 64
+# preallocated, so traced memory is relay own
+PAYLOAD = b"x" * 2**20
+
+
+def tcp_pair():
+    with socket.create_server((HOST, 0)) as listener:
+        a = socket.create_connection(listener.getsockname())
+        b, _ = listener.accept()
+    return a, b
+
+
+class Tunnel:
+    """
+    client <-> relay thread (`siosocks.io.socket.relay`) <-> destination, all over loopback tcp
+    """
+
+    def __init__(self, block_size, max_block_size, pool_size):
+        self.client, incoming = tcp_pair()
+        outgoing, self.destination = tcp_pair()
+        kw = dict(block_size=block_size, max_block_size=max_block_size)
+        if pool_size:
+            kw["buffer_pool"] = BufferPool(size=pool_size, buffer_size=max_block_size or block_size)
+        self.thread = threading.Thread(target=relay, args=(incoming, outgoing), kwargs=kw)
+        self.thread.start()
+        self.sockets = self.client, incoming, outgoing, self.destination
+
+    def close(self):
+        self.client.shutdown(socket.SHUT_WR)
+        self.destination.shutdown(socket.SHUT_WR)
+        self.thread.join()
+        for sock in self.sockets:
+            sock.close()
+
+
+def bulk(config, megabytes):
+    """
+    One direction transfer through tunnel, returns MB/s
+    """
+    tunnel = Tunnel(*config)
+    buffer = bytearray(2**18)
+
+    def send():
+        for _ in range(megabytes):
+            tunnel.client.sendall(PAYLOAD)
+
+    sender = threading.Thread(target=send)
+    start = time.perf_counter()
+    sender.start()
+    size = 0
+    while size < len(PAYLOAD) * megabytes:
+        size += tunnel.destination.recv_into(buffer)
+    elapsed = time.perf_counter() - start
+    sender.join()
+    tunnel.close()
+    return size / 2**20 / elapsed
+
+
+def bulk_memory(config, megabytes):
+    """
+    Traced memory peak while moving data through tunnel, reads buffers dominate it
+    """
+    tracemalloc.start()
+    try:
+        bulk(config, megabytes)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def interactive(config, count):
+    """
+    Small request/response round trips through tunnel, returns median in microseconds
+    """
+    tunnel = Tunnel(*config)
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        tunnel.client.sendall(MESSAGE)
+        tunnel.destination.recv(len(MESSAGE))
+        tunnel.destination.sendall(MESSAGE)
+        tunnel.client.recv(len(MESSAGE))
+        timings.append(time.perf_counter() - start)
+    tunnel.close()
+    return statistics.median(timings) * 10**6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Passthrough block size trade-offs of socket relay")
+    parser.add_argument("--config", action="append", choices=CONFIGS, help="Block size config [default: all]")
+    parser.add_argument("--megabytes", default=512, type=int, help="Bulk transfer size [default: %(default)s]")
+    parser.add_argument(
+        "--traced-megabytes",
+        default=32,
+        type=int,
+        help="Bulk transfer size for memory measurement [default: %(default)s]",
+    )
+    parser.add_argument("--round-trips", default=2000, type=int, help="Interactive round trips [default: %(default)s]")
+    parser.add_argument("--json", default=None, help="Write results to json file")
+    ns = parser.parse_args()
+    results = {}
+    for name in ns.config or CONFIGS:
+        config = CONFIGS[name]
+        result = results[name] = dict(
+            throughput_mb_s=bulk(config, ns.megabytes),
+            peak_memory_kb=bulk_memory(config, ns.traced_megabytes) / 1024,
+            round_trip_us=interactive(config, ns.round_trips),
+        )
+        print(
+            f"{name:<24} {result['throughput_mb_s']:8.1f} MB/s  "
+            f"{result['peak_memory_kb']:8.1f} KiB peak  "
+            f"{result['round_trip_us']:7.1f} us round trip",
+        )
+    if ns.json is not None:
+        with open(ns.json, "w") as f:
+            json.dump(dict(meta=dict(args=vars(ns)), results=results), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import argparse
+import json
+
+
+def flatten(value, prefix=""):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, f"{prefix}/{key}" if prefix else key)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def load(path):
+    with open(path) as f:
+        data = json.load(f)
+    # backends.py keeps run metadata next to results
+    return dict(flatten(data.get("results", data)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark json files")
+    parser.add_argument("before", help="Baseline results")
+    parser.add_argument("after", help="New results")
+    ns = parser.parse_args()
+    before, after = load(ns.before), load(ns.after)
+    # only measurements present in both runs are comparable
+    names = [name for name in before if name in after]
+    width = max(map(len, names), default=0)
+    for name in names:
+        old, new = before[name], after[name]
+        change = f"{(new - old) / old * 100:+7.1f}%" if old else "      -"
+        print(f"{name:<{width}}  {old:12.2f}  {new:12.2f}  {change}")
+
+
+if __name__ == "__main__":
+    main()
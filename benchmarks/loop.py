@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import functools
+import json
+import statistics
+import time
+
+from siosocks.io.asyncio import EVENT_LOOPS, SocksServerProtocol, loop_factory, open_connection, socks_server_handler
+
+HOST = "127.0.0.1"
+BACKENDS = ("asyncio", "asyncio-protocol")
+
+
+async def echo_handler(r, w):
+    while True:
+        b = await r.read(2**16)
+        if not b:
+            break
+        w.write(b)
+        await w.drain()
+    w.close()
+
+
+async def start_proxy(backend):
+    if backend == "asyncio-protocol":
+        return await asyncio.get_running_loop().create_server(SocksServerProtocol, HOST, 0)
+    return await asyncio.start_server(socks_server_handler, HOST, 0)
+
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+async def measure(backend, ns):
+    endpoint = await asyncio.start_server(echo_handler, HOST, 0)
+    proxy = await start_proxy(backend)
+    connect = functools.partial(
+        open_connection,
+        HOST,
+        endpoint.sockets[0].getsockname()[1],
+        socks_host=HOST,
+        socks_port=proxy.sockets[0].getsockname()[1],
+        socks_version=5,
+    )
+    async with endpoint, proxy:
+        # latency: tunnel setup plus one small round trip
+        latencies = []
+        for _ in range(ns.connections):
+            start = time.perf_counter()
+            r, w = await connect()
+            w.write(b"x")
+            await r.readexactly(1)
+            latencies.append(time.perf_counter() - start)
+            w.close()
+        # throughput: bulk echo through single tunnel
+        payload = b"x" * 2**20
+        r, w = await connect()
+
+        async def send():
+            for _ in range(ns.megabytes):
+                w.write(payload)
+                await w.drain()
+
+        async def receive():
+            size = 0
+            while size < len(payload) * ns.megabytes:
+                size += len(await r.read(2**16))
+            return size
+
+        start = time.perf_counter()
+        _, size = await asyncio.gather(send(), receive())
+        elapsed = time.perf_counter() - start
+        w.close()
+        await w.wait_closed()
+        # let proxy and echo handlers see end of file before loop shutdown
+        await asyncio.sleep(0.1)
+    return dict(
+        latency_p50_ms=percentile(latencies, 50) * 1000,
+        latency_p99_ms=percentile(latencies, 99) * 1000,
+        throughput_mb_s=size / 2**20 / elapsed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Echo through local socks proxy on different event loops")
+    parser.add_argument("--loop", action="append", choices=EVENT_LOOPS, help="Event loop [default: all]")
+    parser.add_argument("--backend", action="append", choices=BACKENDS, help="Server backend [default: all]")
+    parser.add_argument("--connections", default=1000, type=int, help="Tunnels for latency [default: %(default)s]")
+    parser.add_argument("--megabytes", default=256, type=int, help="Bulk echo size [default: %(default)s]")
+    parser.add_argument("--json", default=None, help="Write results to json file")
+    ns = parser.parse_args()
+    results = {}
+    for loop in ns.loop or EVENT_LOOPS:
+        for backend in ns.backend or BACKENDS:
+            try:
+                factory = loop_factory(loop)
+            except ImportError as exc:
+                print(f"{loop:<8} skipped: {exc}")
+                break
+            with asyncio.Runner(loop_factory=factory) as runner:
+                result = runner.run(measure(backend, ns))
+            results[f"{loop}/{backend}"] = result
+            print(
+                f"{loop:<8} {backend:<17} "
+                f"p50 {result['latency_p50_ms']:6.3f} ms  "
+                f"p99 {result['latency_p99_ms']:6.3f} ms  "
+                f"{result['throughput_mb_s']:8.1f} MB/s",
+            )
+    if ns.json is not None:
+        with open(ns.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,22 +2,40 @@ import argparse
 import asyncio
 import contextlib
 import functools
+import os
+import signal
 import socket
 import socketserver
 import sys
+import time
+import traceback
 
 from . import __version__
+from .buffers import BlockSize, BufferPool
+from .io.asyncio import EVENT_LOOPS, Resolver, SocksServerProtocol, loop_factory
 from .io.asyncio import socks_server_handler as asyncio_socks_server_handler
+from .io.const import DEFAULT_BLOCK_SIZE, DEFAULT_HAPPY_EYEBALLS_DELAY, DEFAULT_MAX_BLOCK_SIZE
 from .io.socket import socks_server_handler as socket_socks_server_handler
+from .limits import ServerLimits
+from .metrics import ServerMetrics, start_http_server
 from .protocol import DEFAULT_ENCODING
+from .resolver import DEFAULT_MAX_SIZE, DEFAULT_NEGATIVE_TTL
+from .sockopts import SocketOptions
+from .sources import STRATEGIES, SourceAddresses
 
 parser = argparse.ArgumentParser("siosocks", description="Socks proxy server")
 parser.add_argument(
     "--backend",
     default="asyncio",
-    choices=["asyncio", "socketserver", "trio"],
+    choices=["asyncio", "asyncio-protocol", "selector", "socketserver", "trio"],
     help="Socks server backend [default: %(default)s]",
 )
+parser.add_argument(
+    "--loop",
+    default="asyncio",
+    choices=EVENT_LOOPS,
+    help="Event loop implementation, asyncio backends only [default: %(default)s]",
+)
 parser.add_argument("--host", default=None, help="Socks server host [default: %(default)s]")
 parser.add_argument("--port", default=1080, type=int, help="Socks server port [default: %(default)s]")
 parser.add_argument(
@@ -42,11 +60,210 @@ parser.add_argument(
     action="store_true",
     help="Allow multiversion socks server, when socks5 used with username/password auth " "[default: %(default)s]",
 )
+parser.add_argument(
+    "--splice",
+    default=False,
+    action="store_true",
+    help="Use zero-copy splice(2) passthrough where available, asyncio, selector and socketserver backends "
+    "[default: %(default)s]",
+)
+parser.add_argument(
+    "--connect-workers",
+    default=0,
+    type=int,
+    help="Thread pool size for outgoing connections, zero for non-blocking connect from event loop, "
+    "selector backend only [default: %(default)s]",
+)
+parser.add_argument(
+    "--workers",
+    default=1,
+    type=int,
+    help="Number of worker processes, each one binds server port with SO_REUSEPORT [default: %(default)s]",
+)
+parser.add_argument(
+    "--metrics-port",
+    default=None,
+    type=int,
+    help="Serve prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics, worker N uses METRICS_PORT + N "
+    "[default: %(default)s]",
+)
+parser.add_argument("--metrics-host", default="", help="Metrics server host [default: all interfaces]")
+parser.add_argument(
+    "--dns-cache-ttl",
+    default=0,
+    type=float,
+    help="Cache resolved outgoing hostnames for DNS_CACHE_TTL seconds, zero disables cache, asyncio and trio "
+    "backends only [default: %(default)s]",
+)
+parser.add_argument(
+    "--dns-cache-size",
+    default=DEFAULT_MAX_SIZE,
+    type=int,
+    help="Maximum number of cached hostnames [default: %(default)s]",
+)
+parser.add_argument(
+    "--dns-negative-ttl",
+    default=DEFAULT_NEGATIVE_TTL,
+    type=float,
+    help="Cache failed hostname lookups for DNS_NEGATIVE_TTL seconds [default: %(default)s]",
+)
+parser.add_argument(
+    "--happy-eyeballs-delay",
+    default=DEFAULT_HAPPY_EYEBALLS_DELAY,
+    type=float,
+    help="Start connection to next resolved address of destination after HAPPY_EYEBALLS_DELAY seconds if previous "
+    "attempts did not finish yet (RFC 8305), zero starts all attempts at once [default: %(default)s]",
+)
+parser.add_argument(
+    "--handshake-timeout",
+    default=None,
+    type=float,
+    help="Close client connection if it did not reach passthrough in HANDSHAKE_TIMEOUT seconds [default: %(default)s]",
+)
+parser.add_argument(
+    "--connect-timeout",
+    default=None,
+    type=float,
+    help="Outgoing connection timeout in seconds [default: %(default)s]",
+)
+parser.add_argument(
+    "--idle-timeout",
+    default=None,
+    type=float,
+    help="Close tunnel without data in both directions for IDLE_TIMEOUT seconds [default: %(default)s]",
+)
+parser.add_argument(
+    "--max-connections",
+    default=None,
+    type=int,
+    help="Concurrent client connections limit (per worker) [default: %(default)s]",
+)
+parser.add_argument(
+    "--max-connections-per-ip",
+    default=None,
+    type=int,
+    help="Concurrent client connections limit for one client ip address (per worker) [default: %(default)s]",
+)
+parser.add_argument(
+    "--max-connecting",
+    default=None,
+    type=int,
+    help="Concurrent outgoing connection attempts limit (per worker), rest of requests get socks failure reply "
+    "[default: %(default)s]",
+)
+parser.add_argument(
+    "--block-size",
+    default=DEFAULT_BLOCK_SIZE,
+    type=int,
+    help="Passthrough read size in bytes, asyncio-protocol backend and splice passthrough read what kernel gives "
+    "[default: %(default)s]",
+)
+parser.add_argument(
+    "--max-block-size",
+    default=None,
+    type=int,
+    help="Adaptive passthrough read size: grow up to MAX_BLOCK_SIZE while reads fill block, shrink back to "
+    f"BLOCK_SIZE for interactive traffic, e.g. {DEFAULT_MAX_BLOCK_SIZE} [default: fixed BLOCK_SIZE]",
+)
+parser.add_argument(
+    "--buffer-pool-size",
+    default=0,
+    type=int,
+    help="Share up to BUFFER_POOL_SIZE passthrough buffers (of maximum block size) between tunnels, zero keeps "
+    "buffer per tunnel direction, selector and socketserver backends without splice only [default: %(default)s]",
+)
+parser.add_argument(
+    "--tcp-nodelay",
+    default=None,
+    action="store_true",
+    help="Disable Nagle algorithm (TCP_NODELAY) on client and destination sockets, asyncio and trio set it anyway",
+)
+parser.add_argument(
+    "--tcp-quickack",
+    default=None,
+    action="store_true",
+    help="Disable delayed acks (TCP_QUICKACK) at connection start, linux only",
+)
+parser.add_argument("--send-buffer", default=None, type=int, help="Socket send buffer size (SO_SNDBUF) in bytes")
+parser.add_argument("--receive-buffer", default=None, type=int, help="Socket receive buffer size (SO_RCVBUF) in bytes")
+parser.add_argument("--keepalive", default=None, action="store_true", help="Enable tcp keepalive (SO_KEEPALIVE)")
+parser.add_argument(
+    "--keepalive-idle",
+    default=None,
+    type=int,
+    help="Seconds without data before first keepalive probe (TCP_KEEPIDLE), enables keepalive",
+)
+parser.add_argument(
+    "--keepalive-interval",
+    default=None,
+    type=int,
+    help="Seconds between keepalive probes (TCP_KEEPINTVL), enables keepalive",
+)
+parser.add_argument(
+    "--keepalive-count",
+    default=None,
+    type=int,
+    help="Unanswered keepalive probes before connection is dropped (TCP_KEEPCNT), enables keepalive",
+)
+parser.add_argument(
+    "--tcp-notsent-lowat",
+    default=None,
+    type=int,
+    help="Limit of unsent data in kernel send buffer (TCP_NOTSENT_LOWAT) in bytes",
+)
+parser.add_argument(
+    "--tcp-fastopen",
+    default=None,
+    type=int,
+    help="Accept tcp fast open connections (TCP_FASTOPEN) with pending queue of TCP_FASTOPEN length",
+)
+parser.add_argument(
+    "--bind-outgoing",
+    default=[],
+    action="append",
+    metavar="ADDRESS",
+    help="Local source address for outgoing connections, can be used multiple times to spread connections over "
+    "several addresses [default: kernel choice]",
+)
+parser.add_argument(
+    "--bind-outgoing-strategy",
+    default=STRATEGIES[0],
+    choices=STRATEGIES,
+    help="Source address choice for outgoing connection [default: %(default)s]",
+)
 parser.add_argument("-v", "--version", action="store_true", help="Show siosocks version")
 ns = parser.parse_args()
 if ns.version:
     print(__version__)
     sys.exit()
+try:
+    BlockSize(ns.block_size, ns.max_block_size)
+except ValueError as exc:
+    parser.error(str(exc))
+socket_options_kw = dict(
+    nodelay=ns.tcp_nodelay,
+    send_buffer=ns.send_buffer,
+    receive_buffer=ns.receive_buffer,
+    keepalive=ns.keepalive,
+    keepalive_idle=ns.keepalive_idle,
+    keepalive_interval=ns.keepalive_interval,
+    keepalive_count=ns.keepalive_count,
+    quickack=ns.tcp_quickack,
+    notsent_lowat=ns.tcp_notsent_lowat,
+    fastopen=ns.tcp_fastopen,
+)
+socket_options = None
+if any(value is not None for value in socket_options_kw.values()):
+    try:
+        socket_options = SocketOptions(**socket_options_kw)
+    except ValueError as exc:
+        parser.error(str(exc))
+source_addresses = None
+if ns.bind_outgoing:
+    try:
+        source_addresses = SourceAddresses(ns.bind_outgoing, strategy=ns.bind_outgoing_strategy)
+    except ValueError as exc:
+        parser.error(str(exc))
 
 family = {
     "ipv4": socket.AF_INET,
@@ -60,11 +277,120 @@ if 4 in socks_versions and ns.username is not None:
         "and auth required and strict security policy enabled",
     )
     sys.exit(1)
+socks_protocol_kw = dict(
+    allowed_versions=socks_versions,
+    username=ns.username,
+    password=ns.password,
+    strict_security_policy=not ns.no_strict,
+    encoding=ns.encoding,
+)
+reuse_port = ns.workers > 1
+# outgoing connection, timeouts and socket options arguments, same for all backends
+connection_kw = dict(
+    happy_eyeballs_delay=ns.happy_eyeballs_delay,
+    handshake_timeout=ns.handshake_timeout,
+    connect_timeout=ns.connect_timeout,
+    idle_timeout=ns.idle_timeout,
+    socket_options=socket_options,
+    source_addresses=source_addresses,
+)
+# passthrough read size, all backends except asyncio-protocol
+block_kw = dict(block_size=ns.block_size, max_block_size=ns.max_block_size)
+io_kw = dict(splice=ns.splice, **connection_kw, **block_kw)
+limits_kw = dict(
+    max_connections=ns.max_connections,
+    max_connections_per_ip=ns.max_connections_per_ip,
+    max_connecting=ns.max_connecting,
+)
+resolver_kw = dict(ttl=ns.dns_cache_ttl, negative_ttl=ns.dns_negative_ttl, max_size=ns.dns_cache_size)
+# seconds
+WORKER_RESTART_DELAY = 1
+WORKER_SHUTDOWN_TIMEOUT = 10
+
 
+def buffer_pool(metrics):
+    if ns.buffer_pool_size <= 0:
+        return None
+    pool = BufferPool(size=ns.buffer_pool_size, buffer_size=ns.max_block_size or ns.block_size)
+    if metrics is not None:
+        metrics.track_buffer_pool(pool)
+    return pool
 
-def asyncio_main(socks_versions, family, ns):
+
+def tune_listeners(sockets):
+    if socket_options is not None:
+        for sock in sockets:
+            socket_options.apply_listener(sock)
+
+
+def reuse_port_sockets(host, port, family):
+    # one listening socket per resolved address, as asyncio `create_server` binds them
+    infos = socket.getaddrinfo(host or None, port, family, socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
+    sockets = []
+    try:
+        for af, kind, proto, _, address in dict.fromkeys(infos):
+            sock = socket.socket(af, kind, proto)
+            sockets.append(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if af == socket.AF_INET6:
+                # ipv4 clients are served by ipv4 socket
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.bind(address)
+            sock.listen()
+    except BaseException:
+        for sock in sockets:
+            sock.close()
+        raise
+    return sockets
+
+
+def server_limits():
+    if all(value is None for value in limits_kw.values()):
+        return None
+    return ServerLimits(**limits_kw)
+
+
+def asyncio_main(socks_versions, family, ns, metrics):
     async def main():
-        server = await asyncio.start_server(handler, host=ns.host, port=ns.port, family=family)
+        resolver = Resolver(**resolver_kw) if ns.dns_cache_ttl > 0 else None
+        limits = server_limits()
+        if ns.backend == "asyncio-protocol":
+            loop = asyncio.get_running_loop()
+            factory = functools.partial(
+                SocksServerProtocol,
+                metrics=metrics,
+                resolver=resolver,
+                limits=limits,
+                **connection_kw,
+                **socks_protocol_kw,
+            )
+            server = await loop.create_server(
+                factory,
+                host=ns.host,
+                port=ns.port,
+                family=family,
+                reuse_port=reuse_port,
+            )
+        else:
+            handler = functools.partial(
+                asyncio_socks_server_handler,
+                metrics=metrics,
+                resolver=resolver,
+                limits=limits,
+                splice=ns.splice,
+                **connection_kw,
+                **block_kw,
+                **socks_protocol_kw,
+            )
+            server = await asyncio.start_server(
+                handler,
+                host=ns.host,
+                port=ns.port,
+                family=family,
+                reuse_port=reuse_port,
+            )
+        tune_listeners(server.sockets)
         addresses = []
         for sock in server.sockets:
             if sock.family in (socket.AF_INET, socket.AF_INET6):
@@ -74,30 +400,26 @@ def asyncio_main(socks_versions, family, ns):
         with contextlib.suppress(KeyboardInterrupt):
             await server.serve_forever()
 
-    handler = functools.partial(
-        asyncio_socks_server_handler,
-        allowed_versions=socks_versions,
-        username=ns.username,
-        password=ns.password,
-        strict_security_policy=not ns.no_strict,
-        encoding=ns.encoding,
-    )
     with contextlib.suppress(KeyboardInterrupt):
-        return asyncio.run(main())
+        with asyncio.Runner(loop_factory=loop_factory(ns.loop)) as runner:
+            return runner.run(main())
 
 
-def socketserver_main(socks_versions, family, ns):
+def socketserver_main(socks_versions, family, ns, metrics):
     handler = functools.partial(
         socket_socks_server_handler,
-        socks_protocol_kw=dict(
-            allowed_versions=socks_versions,
-            username=ns.username,
-            password=ns.password,
-            strict_security_policy=not ns.no_strict,
-            encoding=ns.encoding,
-        ),
+        socks_protocol_kw=socks_protocol_kw,
+        io_kw=io_kw,
+        metrics=metrics,
+        limits=server_limits(),
+        buffer_pool=buffer_pool(metrics),
     )
-    with socketserver.ThreadingTCPServer((ns.host or "0.0.0.0", ns.port), handler) as server:
+
+    class Server(socketserver.ThreadingTCPServer):
+        allow_reuse_port = reuse_port
+
+    with Server((ns.host or "0.0.0.0", ns.port), handler) as server:
+        tune_listeners([server.socket])
         server.socket.settimeout(0.5)
         h, p = server.server_address
         print(f"Socks{socks_versions} porxy serving on {h}:{p}")
@@ -105,16 +427,46 @@ def socketserver_main(socks_versions, family, ns):
             server.serve_forever()
 
 
-def trio_main(socks_versions, family, ns):
+def selector_main(socks_versions, family, ns, metrics):
+    from .io.selector import SelectorServer
+
+    server = SelectorServer(
+        (ns.host or "0.0.0.0", ns.port),
+        family=socket.AF_INET6 if family == socket.AF_INET6 else socket.AF_INET,
+        connect_workers=ns.connect_workers,
+        reuse_port=reuse_port,
+        socks_protocol_kw=socks_protocol_kw,
+        io_kw=io_kw,
+        metrics=metrics,
+        limits=server_limits(),
+        buffer_pool=buffer_pool(metrics),
+    )
+    with server:
+        h, p, *_ = server.server_address
+        print(f"Socks{socks_versions} proxy serving on {h}:{p}")
+        with contextlib.suppress(KeyboardInterrupt):
+            server.serve_forever()
+
+
+def trio_main(socks_versions, family, ns, metrics):
     import trio
 
+    from .io.trio import Resolver as TrioResolver
     from .io.trio import socks_server_handler as trio_socks_server_handler
 
     async def main():
         with contextlib.suppress(KeyboardInterrupt):
             async with trio.open_nursery() as n:
-                serve_tcp = functools.partial(trio.serve_tcp, handler, ns.port, host=ns.host)
-                listeners = await n.start(serve_tcp)
+                if reuse_port:
+                    listeners = [
+                        trio.SocketListener(trio.socket.from_stdlib_socket(sock))
+                        for sock in reuse_port_sockets(ns.host, ns.port, family)
+                    ]
+                    n.start_soon(trio.serve_listeners, handler, listeners)
+                else:
+                    serve_tcp = functools.partial(trio.serve_tcp, handler, ns.port, host=ns.host)
+                    listeners = await n.start(serve_tcp)
+                tune_listeners(listener.socket for listener in listeners)
                 addresses = []
                 for listener in listeners:
                     sock = listener.socket
@@ -123,24 +475,96 @@ def trio_main(socks_versions, family, ns):
                         addresses.append(f"{host}:{port}")
                 print(f"Socks{socks_versions} proxy serving on {', '.join(addresses)}")
 
+    resolver = TrioResolver(**resolver_kw) if ns.dns_cache_ttl > 0 else None
     handler = functools.partial(
         trio_socks_server_handler,
-        allowed_versions=socks_versions,
-        username=ns.username,
-        password=ns.password,
-        strict_security_policy=not ns.no_strict,
-        encoding=ns.encoding,
+        metrics=metrics,
+        resolver=resolver,
+        limits=server_limits(),
+        **connection_kw,
+        **block_kw,
+        **socks_protocol_kw,
     )
     trio.run(main)
 
 
 backends = {
     "asyncio": asyncio_main,
+    "asyncio-protocol": asyncio_main,
+    "selector": selector_main,
     "socketserver": socketserver_main,
     "trio": trio_main,
 }
-try:
-    backends[ns.backend](socks_versions, family, ns)
-except ImportError:
-    print(f"{ns.backend} backend dependencies are not installed")
-    raise
+
+
+def run(worker_index=0):
+    metrics = None
+    if ns.metrics_port is not None:
+        metrics = ServerMetrics()
+        metrics_server = start_http_server(metrics, ns.metrics_port + worker_index, ns.metrics_host)
+        h, p, *_ = metrics_server.server_address
+        print(f"Metrics serving on http://{h}:{p}/metrics")
+    try:
+        backends[ns.backend](socks_versions, family, ns, metrics)
+    except ImportError:
+        print(f"{ns.backend} backend dependencies are not installed")
+        raise
+
+
+def supervise(workers, target):
+    children = {}
+    deadline = None
+
+    def spawn(index):
+        pid = os.fork()
+        if pid:
+            children[pid] = index
+            return
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            # graceful shutdown path of all backends is KeyboardInterrupt
+            signal.signal(signal.SIGTERM, lambda *_: signal.raise_signal(signal.SIGINT))
+            target(index)
+        except SystemExit as exc:
+            code = exc.code if isinstance(exc.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def stop(*_):
+        nonlocal deadline
+        if deadline is None:
+            deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+        for pid in children:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(workers):
+        spawn(index)
+    while children:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if not pid:
+            if deadline is not None and time.monotonic() > deadline:
+                for pid in children:
+                    with contextlib.suppress(ProcessLookupError):
+                        os.kill(pid, signal.SIGKILL)
+            time.sleep(0.1)
+            continue
+        index = children.pop(pid)
+        if deadline is None:
+            code = os.waitstatus_to_exitcode(status)
+            print(f"Worker {index} (pid {pid}) exited with code {code}, restarting")
+            time.sleep(WORKER_RESTART_DELAY)
+            spawn(index)
+
+
+if ns.workers > 1:
+    supervise(ns.workers, run)
+else:
+    signal.signal(signal.SIGTERM, lambda *_: signal.raise_signal(signal.SIGINT))
+    run()
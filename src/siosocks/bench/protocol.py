@@ -0,0 +1,197 @@
+"""
+In-memory client/server handshake benchmark, no sockets involved
+
+    python -m siosocks.bench.protocol --json before.json
+"""
+
+import argparse
+import collections
+import gc
+import json
+import time
+import tracemalloc
+
+from ..protocol import SocksClient, SocksServer
+from ..sansio import Connect, Passthrough, Read, Write, from_dict
+
+HOST = "127.0.0.1"
+DOMAIN = "python.org"
+PORT = 666
+USERNAME = "yoba"
+PASSWORD = "foo"
+
+VARIANTS = {
+    "socks4": (
+        lambda: SocksClient(HOST, PORT, 4),
+        lambda: SocksServer(),
+    ),
+    "socks4a": (
+        lambda: SocksClient(DOMAIN, PORT, 4),
+        lambda: SocksServer(),
+    ),
+    "socks5": (
+        lambda: SocksClient(HOST, PORT, 5),
+        lambda: SocksServer(),
+    ),
+    "socks5-domain": (
+        lambda: SocksClient(DOMAIN, PORT, 5),
+        lambda: SocksServer(),
+    ),
+    "socks5-auth": (
+        lambda: SocksClient(HOST, PORT, 5, username=USERNAME, password=PASSWORD),
+        lambda: SocksServer(allowed_versions={5}, username=USERNAME, password=PASSWORD),
+    ),
+}
+
+
+class Peer:
+    """
+    Drives one protocol generator, delivers its writes to other peer inbox
+    """
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.inbox = collections.deque()
+        self.reading = False
+        self.done = False
+        self.steps = 0
+        self.messages = collections.Counter()
+        self.written = 0
+
+    def run(self, other):
+        """
+        Run generator until it waits for data or reaches passthrough, returns `True` if there was progress
+        """
+        data = None
+        if self.reading:
+            if not self.inbox:
+                return False
+            data = self.inbox.popleft()
+            self.reading = False
+        while True:
+            message = self.generator.send(data)
+            self.steps += 1
+            if message.__class__ is dict:
+                message = from_dict(message)
+            self.messages[message.method] += 1
+            data = None
+            opcode = message.opcode
+            if opcode == Read.opcode:
+                if not self.inbox:
+                    self.reading = True
+                    return True
+                data = self.inbox.popleft()
+            elif opcode == Write.opcode:
+                if message.data:
+                    self.written += len(message.data)
+                    other.inbox.append(message.data)
+            elif opcode == Connect.opcode:
+                pass
+            elif opcode == Passthrough.opcode:
+                self.done = True
+                return True
+
+
+def handshake(client, server):
+    """
+    Run client and server generators against each other until both reach passthrough, returns peers
+    """
+    client, server = Peer(client), Peer(server)
+    while not (client.done and server.done):
+        progress = client.run(server) if not client.done else False
+        progress = (server.run(client) if not server.done else False) or progress
+        if not progress:
+            raise RuntimeError("Handshake stalled")
+    return client, server
+
+
+def profile(client_factory, server_factory):
+    """
+    Generator steps, messages and bytes of single handshake, they do not depend on hardware
+    """
+    client, server = handshake(client_factory(), server_factory())
+    return {
+        name: dict(steps=peer.steps, messages=dict(peer.messages), written=peer.written)
+        for name, peer in (("client", client), ("server", server))
+    }
+
+
+def measure_memory(client_factory, server_factory, number):
+    """
+    Traced peak and retained memory per handshake in bytes
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        peak_bytes = 0
+        start, _ = tracemalloc.get_traced_memory()
+        for _ in range(number):
+            base, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            handshake(client_factory(), server_factory())
+            _, peak = tracemalloc.get_traced_memory()
+            peak_bytes = max(peak_bytes, peak - base)
+        gc.collect()
+        end, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # non-zero retained memory means something outlives handshake (caches warm up on first call)
+    return dict(peak_bytes=peak_bytes, retained_bytes=(end - start) / number)
+
+
+def measure_time(client_factory, server_factory, number, repeat):
+    """
+    Best of `repeat` wall time per handshake in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            handshake(client_factory(), server_factory())
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def measure(client_factory, server_factory, *, number=20_000, repeat=3, memory_number=100):
+    result = profile(client_factory, server_factory)
+    elapsed = measure_time(client_factory, server_factory, number, repeat)
+    result.update(
+        handshakes_per_s=1 / elapsed,
+        handshake_us=elapsed * 1_000_000,
+        **measure_memory(client_factory, server_factory, memory_number),
+    )
+    return result
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        "siosocks.bench.protocol",
+        description="In-memory socks handshake cost: generator steps, traced memory and wall time",
+    )
+    parser.add_argument("-n", "--number", default=20_000, type=int, help="Handshakes per repeat [default: %(default)s]")
+    parser.add_argument("--repeat", default=3, type=int, help="Best of repeats [default: %(default)s]")
+    parser.add_argument(
+        "--memory-number", default=100, type=int, help="Traced handshakes per variant [default: %(default)s]"
+    )
+    parser.add_argument("--variant", action="append", choices=sorted(VARIANTS), help="Variant to run [default: all]")
+    parser.add_argument("--json", default=None, help="Write results to json file")
+    ns = parser.parse_args(args)
+    results = {}
+    for name in ns.variant or VARIANTS:
+        result = measure(*VARIANTS[name], number=ns.number, repeat=ns.repeat, memory_number=ns.memory_number)
+        results[name] = result
+        print(
+            f"{name:<14} {result['handshakes_per_s']:>10,.0f} handshakes/s  "
+            f"{result['handshake_us']:6.2f} us  "
+            f"steps {result['client']['steps']:>2}/{result['server']['steps']:<2}  "
+            f"peak {result['peak_bytes']:>6,} B  "
+            f"retained {result['retained_bytes']:6.1f} B",
+        )
+    if ns.json is not None:
+        with open(ns.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
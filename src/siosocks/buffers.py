@@ -0,0 +1,66 @@
+import threading
+
+from .io.const import DEFAULT_BLOCK_SIZE, DEFAULT_BUFFER_POOL_SIZE
+
+
+class BlockSize:
+    """
+    Read size of one passthrough direction, fixed `size` if `maximum` is `None`, otherwise adaptive: doubles after
+    read, which filled whole block (bulk transfer), up to `maximum`, halves down to `size` after read, which used less
+    than quarter of block (interactive traffic)
+
+    Big reads cut per chunk overhead, small ones keep memory and allocation size low for tunnels moving little data
+    """
+
+    __slots__ = ("minimum", "maximum", "size")
+
+    def __init__(self, size=DEFAULT_BLOCK_SIZE, maximum=None):
+        if maximum is None:
+            maximum = size
+        if not 0 < size <= maximum:
+            raise ValueError(f"Block size must be positive and not greater than maximum, got {size} and {maximum}")
+        self.minimum = self.size = size
+        self.maximum = maximum
+
+    def update(self, received):
+        size = self.size
+        if received >= size:
+            if size < self.maximum:
+                self.size = min(size * 2, self.maximum)
+        elif received < size // 4 and size > self.minimum:
+            self.size = max(size // 2, self.minimum)
+
+
+class BufferPool:
+    """
+    Free list of `buffer_size` bytearrays shared by passthrough relays of server, relay takes buffer for read and
+    returns it when read data is sent, so idle tunnels hold no buffers
+
+    Up to `size` returned buffers are kept, new buffer is allocated when pool is empty, `hits` and `misses` count
+    both cases
+    """
+
+    def __init__(self, *, size=DEFAULT_BUFFER_POOL_SIZE, buffer_size=DEFAULT_BLOCK_SIZE):
+        self.size = size
+        self.buffer_size = buffer_size
+        self.hits = 0
+        self.misses = 0
+        self._free = []
+        # socketserver backend relays run in many threads
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._free)
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                self.hits += 1
+                return self._free.pop()
+            self.misses += 1
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        with self._lock:
+            if len(self._free) < self.size:
+                self._free.append(buffer)
@@ -1,2 +1,10 @@
 class SocksException(Exception):
     pass
+
+
+class SocksAuthException(SocksException):
+    pass
+
+
+class SocksLimitException(SocksException):
+    pass
@@ -1,6 +1,8 @@
 import abc
+import time
 
 from siosocks.exceptions import SocksException
+from siosocks.sansio import from_dict
 
 
 class AbstractSocksIO(abc.ABC):
@@ -23,13 +25,129 @@ class AbstractSocksIO(abc.ABC):
         """
 
     @abc.abstractmethod
-    def passthrough(self):
+    def passthrough(self, data=b""):
         """
-        Transfer data between sockets
+        Transfer data between sockets, server implementations return bytes moved (up, down)
+
+        `data` is already received part of stream after handshake: client data to send to destination first for
+        server, data from destination to give to application for client
         """
 
 
-async def async_engine(protocol, io):
+class EngineHooks:
+    """
+    Protocol steps observer, all methods do nothing, override needed ones
+
+    Timestamps are `time.perf_counter()` values, `transferred` is (up, down) bytes tuple or `None` if io
+    do not count them
+    """
+
+    def read(self, started, finished, data):
+        pass
+
+    def write(self, started, finished, size):
+        pass
+
+    def connect(self, started, finished, host, port, exc):
+        pass
+
+    def passthrough_started(self, timestamp):
+        pass
+
+    def passthrough_finished(self, timestamp, transferred):
+        pass
+
+
+def _passthrough(io):
+    # io implementations without `data` argument keep working while there is no leftover data
+    return lambda message: io.passthrough(message.data) if message.data else io.passthrough()
+
+
+def _handlers(io):
+    # indexed by message opcode
+    return (
+        lambda message: io.read(),
+        lambda message: io.write(message.data),
+        lambda message: io.connect(message.host, message.port),
+        _passthrough(io),
+    )
+
+
+def _sync_hooked_handlers(io, hooks):
+    clock = time.perf_counter
+
+    def read(message):
+        started = clock()
+        data = io.read()
+        hooks.read(started, clock(), data)
+        return data
+
+    def write(message):
+        started = clock()
+        io.write(message.data)
+        hooks.write(started, clock(), len(message.data))
+
+    def connect(message):
+        started = clock()
+        try:
+            io.connect(message.host, message.port)
+        except Exception as exc:
+            hooks.connect(started, clock(), message.host, message.port, exc)
+            raise
+        hooks.connect(started, clock(), message.host, message.port, None)
+
+    handler = _passthrough(io)
+
+    def passthrough(message):
+        hooks.passthrough_started(clock())
+        transferred = None
+        try:
+            transferred = handler(message)
+        finally:
+            hooks.passthrough_finished(clock(), transferred)
+
+    return read, write, connect, passthrough
+
+
+def _async_hooked_handlers(io, hooks):
+    clock = time.perf_counter
+
+    async def read(message):
+        started = clock()
+        data = await io.read()
+        hooks.read(started, clock(), data)
+        return data
+
+    async def write(message):
+        started = clock()
+        await io.write(message.data)
+        hooks.write(started, clock(), len(message.data))
+
+    async def connect(message):
+        started = clock()
+        try:
+            await io.connect(message.host, message.port)
+        except Exception as exc:
+            hooks.connect(started, clock(), message.host, message.port, exc)
+            raise
+        hooks.connect(started, clock(), message.host, message.port, None)
+
+    handler = _passthrough(io)
+
+    async def passthrough(message):
+        hooks.passthrough_started(clock())
+        transferred = None
+        try:
+            transferred = await handler(message)
+        finally:
+            hooks.passthrough_finished(clock(), transferred)
+
+    return read, write, connect, passthrough
+
+
+async def async_engine(protocol, io, *, hooks=None):
+    # hooks wrap handlers table, loop itself is the same with and without them
+    handlers = _handlers(io) if hooks is None else _async_hooked_handlers(io, hooks)
     generator_method, data = protocol.send, None
     while True:
         try:
@@ -38,15 +156,27 @@ async def async_engine(protocol, io):
             raise
         except StopIteration:
             break
-        method = message.pop("method")
+        if message.__class__ is dict:
+            message = from_dict(message)
         try:
             generator_method = protocol.send
-            data = await getattr(io, method)(**message)
+            data = await handlers[message.opcode](message)
         except Exception as exc:
             generator_method, data = protocol.throw, exc
 
 
-def sync_engine(protocol, io):
+def log_failure(logger, exc):
+    """
+    Log connection handler failure: client protocol errors and disconnects without traceback, unexpected errors with it
+    """
+    if isinstance(exc, (SocksException, OSError)):
+        logger.debug("handler failed: %r", exc)
+    else:
+        logger.error("handler failed", exc_info=exc)
+
+
+def sync_engine(protocol, io, *, hooks=None):
+    handlers = _handlers(io) if hooks is None else _sync_hooked_handlers(io, hooks)
     generator_method, data = protocol.send, None
     while True:
         try:
@@ -55,9 +185,10 @@ def sync_engine(protocol, io):
             raise
         except StopIteration:
             break
-        method = message.pop("method")
+        if message.__class__ is dict:
+            message = from_dict(message)
         try:
             generator_method = protocol.send
-            data = getattr(io, method)(**message)
+            data = handlers[message.opcode](message)
         except Exception as exc:
             generator_method, data = protocol.throw, exc
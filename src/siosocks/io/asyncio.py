@@ -1,23 +1,247 @@
 import asyncio
+import collections
+import contextlib
+import functools
 import logging
+import os
+import selectors
+import socket
+import time
 
-from ..exceptions import SocksException
-from ..interface import AbstractSocksIO, async_engine
-from ..protocol import DEFAULT_ENCODING, SocksClient, SocksServer
-from .const import DEFAULT_BLOCK_SIZE
+from ..buffers import BlockSize
+from ..exceptions import SocksException, SocksLimitException
+from ..interface import AbstractSocksIO, async_engine, log_failure
+from ..protocol import DEFAULT_ENCODING, SocksClient, SocksClientGreeting, SocksServer
+from ..resolver import ResolverCache, interleave, is_ip_address, numeric_infos, with_port
+from ..sansio import Connect, Passthrough, Read, Write, from_dict
+from .const import (
+    DEFAULT_BLOCK_SIZE,
+    DEFAULT_HAPPY_EYEBALLS_DELAY,
+    DEFAULT_POOL_RETRY_DELAY,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_POOL_TTL,
+)
+from .socket import SPLICE_AVAILABLE, Tunnel
 
 logger = logging.getLogger(__name__)
+DIRECTIONS = ("up", "down")
+EVENT_LOOPS = ("asyncio", "uvloop")
+
+
+def loop_factory(name="asyncio"):
+    """
+    Event loop factory by name, to be used as `asyncio.Runner(loop_factory=loop_factory("uvloop"))`
+    """
+    if name == "asyncio":
+        return asyncio.new_event_loop
+    elif name == "uvloop":
+        try:
+            import uvloop
+        except ImportError as exc:
+            raise ImportError("uvloop event loop requested, but uvloop is not installed (pip install uvloop)") from exc
+        return uvloop.new_event_loop
+    raise ValueError(f"Unknown event loop {name!r}, expected one of {EVENT_LOOPS}")
+
+
+class Resolver:
+    """
+    Caching resolver for outgoing connections, concurrent lookups of same host share one `getaddrinfo` call
+
+    One instance is shared by all connections of server, `cache_kw` are `siosocks.resolver.ResolverCache` arguments
+    """
+
+    def __init__(self, cache=None, **cache_kw):
+        self.cache = ResolverCache(**cache_kw) if cache is None else cache
+        self._pending = {}
+
+    async def resolve(self, host, port):
+        if is_ip_address(host):
+            return numeric_infos(host, port)
+        while True:
+            infos = self.cache.get(host)
+            if infos is not None:
+                return with_port(infos, port)
+            pending = self._pending.get(host)
+            if pending is None:
+                break
+            # lookup owner fills cache, or failed without caching (cancelled), then next waiter takes over
+            await pending.wait()
+        self._pending[host] = pending = asyncio.Event()
+        try:
+            loop = asyncio.get_running_loop()
+            infos = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        except socket.gaierror as exc:
+            self.cache.set_error(host, exc)
+            raise
+        else:
+            self.cache.set(host, infos)
+        finally:
+            del self._pending[host]
+            pending.set()
+        return with_port(infos, port)
+
+
+async def _resolve(host, port):
+    if is_ip_address(host):
+        return numeric_infos(host, port)
+    loop = asyncio.get_running_loop()
+    return await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+
+
+async def create_connection(
+    host,
+    port,
+    *,
+    happy_eyeballs_delay=DEFAULT_HAPPY_EYEBALLS_DELAY,
+    resolver=None,
+    socket_options=None,
+    source_addresses=None,
+):
+    """
+    Connected non-blocking socket, next resolved address is tried when previous attempt failed or
+    `happy_eyeballs_delay` seconds passed (RFC 8305), `None` delay tries addresses one by one
+
+    Works the same on any event loop (`uvloop` has no `happy_eyeballs_delay` support), `resolver` is optional
+    caching `Resolver`, `socket_options` is optional `siosocks.sockopts.SocketOptions` applied before connect,
+    `source_addresses` is optional `siosocks.sources.SourceAddresses`, connected socket keeps its address, caller
+    releases it
+    """
+    infos = await (_resolve if resolver is None else resolver.resolve)(host, port)
+    infos = collections.deque(interleave(infos))
+    loop = asyncio.get_running_loop()
+    close = socket.socket.close if source_addresses is None else source_addresses.close
+    attempts = set()
+    exceptions = []
+    try:
+        while True:
+            if infos:
+                connect = _connect_socket(loop, socket_options, source_addresses, *infos.popleft())
+                attempts.add(asyncio.ensure_future(connect))
+            if not attempts:
+                break
+            timeout = happy_eyeballs_delay if infos else None
+            done, attempts = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            sock = None
+            for attempt in done:
+                if attempt.exception() is not None:
+                    exceptions.append(attempt.exception())
+                elif sock is None:
+                    sock = attempt.result()
+                else:
+                    close(attempt.result())
+            if sock is not None:
+                return sock
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
+        if attempts:
+            await asyncio.wait(attempts)
+        for attempt in attempts:
+            if not attempt.cancelled() and attempt.exception() is None:
+                close(attempt.result())
+    if len(exceptions) == 1:
+        raise exceptions[0]
+    raise OSError(f"Multiple exceptions: {', '.join(map(str, exceptions))}")
+
+
+async def _connect_socket(loop, socket_options, source_addresses, family, kind, proto, _, address):
+    sock = socket.socket(family, kind, proto)
+    try:
+        if socket_options is not None:
+            socket_options.apply_outgoing(sock)
+        if source_addresses is not None:
+            source_addresses.bind(sock)
+        sock.setblocking(False)
+        await loop.sock_connect(sock, address)
+    except BaseException:
+        if source_addresses is None:
+            sock.close()
+        else:
+            source_addresses.close(sock)
+        raise
+    return sock
+
+
+def _apply_socket_options(socket_options, transport):
+    # stream writer or transport, transports without socket (pipes, tests) are skipped
+    sock = transport.get_extra_info("socket")
+    if sock is not None:
+        socket_options.apply(sock)
+
+
+def _read_buffer(reader):
+    """
+    Bytes `StreamReader` received, but not read yet, as its own mutable buffer, `None` for readers without it. There
+    is no public way to take these bytes without waiting for more data, so this is the only private access to reader
+    """
+    if not hasattr(reader, "_buffer"):
+        return None
+    return reader._buffer
+
+
+def _spliceable(reader, writer):
+    # plain socket under transport, tls data must go through ssl object, buffered data must be taken from reader
+    return (
+        writer.get_extra_info("sslcontext") is None
+        and writer.get_extra_info("socket") is not None
+        and _read_buffer(reader) is not None
+    )
 
 
 class ServerIO(AbstractSocksIO):
-    def __init__(self, reader, writer):
+    def __init__(
+        self,
+        reader,
+        writer,
+        *,
+        metrics=None,
+        resolver=None,
+        happy_eyeballs_delay=DEFAULT_HAPPY_EYEBALLS_DELAY,
+        handshake=None,
+        connect_timeout=None,
+        idle_timeout=None,
+        limits=None,
+        block_size=DEFAULT_BLOCK_SIZE,
+        max_block_size=None,
+        splice=False,
+        socket_options=None,
+        source_addresses=None,
+    ):
         self.incoming_reader = reader
         self.incoming_writer = writer
         self.outgoing_reader = None
         self.outgoing_writer = None
+        # raw outgoing socket, used instead of streams by splice passthrough
+        self.outgoing_socket = None
+        self.metrics = metrics
+        self.resolver = resolver
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+        # optional `asyncio.Timeout` around handshake, disabled when passthrough starts
+        self.handshake = handshake
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        # optional `siosocks.limits.ConnectionLimits`
+        self.limits = limits
+        # passthrough read size, adaptive if `max_block_size` is set
+        self.block_size = block_size
+        self.max_block_size = max_block_size
+        self.splice = splice and SPLICE_AVAILABLE and _spliceable(reader, writer)
+        # optional `siosocks.sockopts.SocketOptions` of both sockets
+        self.socket_options = socket_options
+        if socket_options is not None:
+            _apply_socket_options(socket_options, writer)
+        # optional `siosocks.sources.SourceAddresses` and address of outgoing socket
+        self.source_addresses = source_addresses
+        self.source_address = None
+        self.last_activity = None
+        # bytes moved up (client to destination) and down
+        self.transferred = [0, 0]
 
     async def read(self):
-        return await self.incoming_reader.read(DEFAULT_BLOCK_SIZE)
+        data = await self.incoming_reader.read(DEFAULT_BLOCK_SIZE)
+        if self.metrics is not None:
+            self.metrics.received(data)
+        return data
 
     async def write(self, data):
         self.incoming_writer.write(data)
@@ -25,14 +249,57 @@ class ServerIO(AbstractSocksIO):
 
     async def connect(self, host, port):
         logger.debug("connect call %s:%d", host, port)
-        self.outgoing_reader, self.outgoing_writer = await asyncio.open_connection(host, port)
+        if self.metrics is None:
+            await self._open_connection(host, port)
+            return
+        self.metrics.connect(host, port)
+        try:
+            await self._open_connection(host, port)
+        except Exception as exc:
+            self.metrics.connected(exc)
+            raise
+        self.metrics.connected()
+
+    async def _open_connection(self, host, port):
+        if self.limits is not None:
+            self.limits.connect()
+        try:
+            async with asyncio.timeout(self.connect_timeout):
+                sock = await create_connection(
+                    host,
+                    port,
+                    happy_eyeballs_delay=self.happy_eyeballs_delay,
+                    resolver=self.resolver,
+                    socket_options=self.socket_options,
+                    source_addresses=self.source_addresses,
+                )
+                if self.source_addresses is not None:
+                    self.source_address = self.source_addresses.address_of(sock)
+                if self.splice:
+                    self.outgoing_socket = sock
+                else:
+                    self.outgoing_reader, self.outgoing_writer = await asyncio.open_connection(sock=sock)
+        finally:
+            if self.limits is not None:
+                self.limits.connected()
 
-    async def passthrough(self):
+    async def passthrough(self, data=b""):
         logger.debug("passthrough started")
+        if self.handshake is not None:
+            self.handshake.reschedule(None)
+        if self.metrics is not None:
+            self.metrics.passthrough()
+        if self.splice:
+            return await self._splice_passthrough(data)
+        # pipelined client data, sink drains it with its first write
+        self.outgoing_writer.write(data)
         coros = [
-            self._sink(self.incoming_reader, self.outgoing_writer),
-            self._sink(self.outgoing_reader, self.incoming_writer),
+            self._sink(self.incoming_reader, self.outgoing_writer, 0, len(data)),
+            self._sink(self.outgoing_reader, self.incoming_writer, 1),
         ]
+        if self.idle_timeout is not None:
+            self.last_activity = asyncio.get_running_loop().time()
+            coros.append(self._watchdog())
         tasks = {asyncio.ensure_future(coro) for coro in coros}
         try:
             await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
@@ -40,15 +307,112 @@ class ServerIO(AbstractSocksIO):
             for t in tasks:
                 t.cancel()
             await asyncio.wait(tasks)
+        return tuple(self.transferred)
+
+    async def _sink(self, r, w, index, size=0):
+        time = asyncio.get_running_loop().time
+        watched = self.idle_timeout is not None
+        metrics = self.metrics
+        direction = DIRECTIONS[index]
+        if metrics is not None and size:
+            metrics.transferred(direction, size)
+        block = BlockSize(self.block_size, self.max_block_size)
+        try:
+            while True:
+                b = await r.read(block.size)
+                if not b:
+                    break
+                block.update(len(b))
+                size += len(b)
+                if metrics is not None:
+                    metrics.transferred(direction, len(b))
+                if watched:
+                    self.last_activity = time()
+                w.write(b)
+                await w.drain()
+        finally:
+            self.transferred[index] = size
+
+    async def _splice_passthrough(self, data):
+        loop = asyncio.get_running_loop()
+        # detach incoming socket from streams: stop transport reads, flush handshake replies and take bytes reader
+        # already buffered
+        self.incoming_writer.transport.pause_reading()
+        self.incoming_writer.transport.set_write_buffer_limits(high=0)
+        await self.incoming_writer.drain()
+        buffered = _read_buffer(self.incoming_reader)
+        data += bytes(buffered)
+        buffered.clear()
+        self.outgoing_socket.setblocking(False)
+        if data:
+            if self.metrics is not None:
+                self.metrics.transferred("up", len(data))
+            await loop.sock_sendall(self.outgoing_socket, data)
+        # duplicated descriptor, original one stays with (paused) transport and is closed with it
+        fd = os.dup(self.incoming_writer.get_extra_info("socket").fileno())
+        incoming = socket.socket(fileno=fd)
+        tunnel = Tunnel(incoming, self.outgoing_socket, splice=True, metrics=self.metrics)
+        registered = dict.fromkeys(tunnel.sockets, 0)
+        done = loop.create_future()
+        watchers = (
+            (selectors.EVENT_READ, loop.add_reader, loop.remove_reader),
+            (selectors.EVENT_WRITE, loop.add_writer, loop.remove_writer),
+        )
+
+        def update():
+            if tunnel.done:
+                done.set_result(None)
+                return
+            for sock, events in tunnel.interest().items():
+                for event, add, remove in watchers:
+                    if events & event and not registered[sock] & event:
+                        add(sock, ready, sock, event)
+                    elif registered[sock] & event and not events & event:
+                        remove(sock)
+                registered[sock] = events
+
+        def ready(sock, mask):
+            if done.done():
+                return
+            if self.idle_timeout is not None:
+                self.last_activity = loop.time()
+            try:
+                changed = tunnel.process(sock, mask)
+            except OSError as exc:
+                logger.debug("passthrough failed: %r", exc)
+                done.set_result(None)
+                return
+            if changed:
+                update()
+
+        tasks = {done}
+        if self.idle_timeout is not None:
+            self.last_activity = loop.time()
+            tasks.add(asyncio.ensure_future(self._watchdog()))
+        try:
+            update()
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for sock in tunnel.sockets:
+                loop.remove_reader(sock)
+                loop.remove_writer(sock)
+            for t in tasks:
+                t.cancel()
+            tunnel.close()
+            incoming.close()
+            up, down = tunnel.transferred
+            self.transferred = [up + len(data), down]
+        return tuple(self.transferred)
 
-    @staticmethod
-    async def _sink(r, w):
+    async def _watchdog(self):
+        # ends passthrough when no data was moved in any direction for idle timeout
+        time = asyncio.get_running_loop().time
         while True:
-            b = await r.read(DEFAULT_BLOCK_SIZE)
-            if not b:
-                break
-            w.write(b)
-            await w.drain()
+            delay = self.last_activity + self.idle_timeout - time()
+            if delay <= 0:
+                logger.debug("passthrough idle timeout")
+                return
+            await asyncio.sleep(delay)
 
     async def __aenter__(self):
         return self
@@ -56,23 +420,379 @@ class ServerIO(AbstractSocksIO):
     async def __aexit__(self, *exc_info):
         if self.outgoing_writer is not None:
             self.outgoing_writer.close()
+        if self.outgoing_socket is not None:
+            self.outgoing_socket.close()
+        if self.source_addresses is not None:
+            self.source_addresses.release(self.source_address)
+
+
+async def socks_server_handler(
+    reader,
+    writer,
+    *,
+    metrics=None,
+    hooks_factory=None,
+    resolver=None,
+    happy_eyeballs_delay=DEFAULT_HAPPY_EYEBALLS_DELAY,
+    handshake_timeout=None,
+    connect_timeout=None,
+    idle_timeout=None,
+    limits=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+    max_block_size=None,
+    splice=False,
+    socket_options=None,
+    source_addresses=None,
+    **kwargs,
+):
+    """
+    `asyncio.start_server` callback, `metrics` is optional `siosocks.metrics.ServerMetrics`, `hooks_factory` is
+    optional callable, which returns `siosocks.interface.EngineHooks` for each connection, `resolver` is optional
+    shared `Resolver` for outgoing connections, `happy_eyeballs_delay` is RFC 8305 connection attempt delay for
+    outgoing connections (`None` tries resolved addresses one by one)
 
+    Timeouts are seconds or `None`: `handshake_timeout` from accept to passthrough start, `connect_timeout` for
+    outgoing connection, `idle_timeout` for tunnel without data in both directions
 
-async def socks_server_handler(reader, writer, **kwargs):
+    `limits` is optional `siosocks.limits.ServerLimits`, rejected connection gets socks failure reply to its request
+
+    `block_size` is passthrough read size, with `max_block_size` it is adaptive (see `siosocks.buffers.BlockSize`)
+
+    `splice` moves passthrough data between raw sockets with linux `splice` inside kernel, streams are used when it is
+    not available or connection is tls
+
+    `socket_options` is optional `siosocks.sockopts.SocketOptions` for incoming and outgoing sockets,
+    `source_addresses` is optional `siosocks.sources.SourceAddresses` for outgoing connections
+    """
+    rejection = connection_limits = None
+    if limits is not None:
+        try:
+            connection_limits, rejection = limits.admit(writer.get_extra_info("peername")[0])
+        except SocksLimitException as exc:
+            logger.debug("connection dropped: %s", exc)
+            writer.close()
+            return
+    if rejection is not None:
+        # client gets failure reply to its request in short time
+        logger.debug("connection rejected: %s", rejection)
+        handshake_timeout = limits.handshake_timeout(handshake_timeout)
+    connection_metrics = None if metrics is None else metrics.connection()
+    hooks = None if hooks_factory is None else hooks_factory()
+    handshake = asyncio.timeout(handshake_timeout)
     try:
-        async with ServerIO(reader, writer) as io:
-            await async_engine(SocksServer(**kwargs), io)
+        io = ServerIO(
+            reader,
+            writer,
+            metrics=connection_metrics,
+            resolver=resolver,
+            happy_eyeballs_delay=happy_eyeballs_delay,
+            handshake=handshake,
+            connect_timeout=connect_timeout,
+            idle_timeout=idle_timeout,
+            limits=connection_limits,
+            block_size=block_size,
+            max_block_size=max_block_size,
+            splice=splice,
+            socket_options=socket_options,
+            source_addresses=source_addresses,
+        )
+        async with handshake, io:
+            await async_engine(SocksServer(rejection=rejection, **kwargs), io, hooks=hooks)
+    except Exception as exc:
+        log_failure(logger, exc)
+        if connection_metrics is not None:
+            connection_metrics.failed(exc)
     finally:
+        if connection_metrics is not None:
+            connection_metrics.close()
+        if connection_limits is not None:
+            connection_limits.close()
         writer.close()
 
 
+class _OutgoingProtocol(asyncio.Protocol):
+    def __init__(self, incoming):
+        self.incoming = incoming
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # incoming side resumes reading when passthrough starts
+        transport.pause_reading()
+
+    def data_received(self, data):
+        self.incoming.transport.write(data)
+        self.incoming.transferred_down += len(data)
+        if self.incoming.metrics is not None:
+            self.incoming.metrics.transferred("down", len(data))
+        if self.incoming._idle_timeout is not None:
+            self.incoming.last_activity = self.incoming.time()
+
+    def eof_received(self):
+        self.incoming.close()
+
+    def connection_lost(self, exc):
+        self.incoming.close()
+
+    def pause_writing(self):
+        self.incoming.transport.pause_reading()
+
+    def resume_writing(self):
+        self.incoming.transport.resume_reading()
+
+
+class SocksServerProtocol(asyncio.Protocol):
+    """
+    Socks server built directly on transports, use as `loop.create_server` protocol factory, keyword arguments are
+    the same as `socks_server_handler` ones
+    """
+
+    def __init__(
+        self,
+        *,
+        metrics=None,
+        hooks_factory=None,
+        resolver=None,
+        happy_eyeballs_delay=DEFAULT_HAPPY_EYEBALLS_DELAY,
+        handshake_timeout=None,
+        connect_timeout=None,
+        idle_timeout=None,
+        limits=None,
+        socket_options=None,
+        source_addresses=None,
+        **kwargs,
+    ):
+        self._socks_protocol_kw = kwargs
+        self._server_metrics = metrics
+        self._hooks_factory = hooks_factory
+        self._resolver = resolver
+        self._happy_eyeballs_delay = happy_eyeballs_delay
+        self._handshake_timeout = handshake_timeout
+        self._connect_timeout = connect_timeout
+        self._idle_timeout = idle_timeout
+        self._server_limits = limits
+        self._socket_options = socket_options
+        self._source_addresses = source_addresses
+        self._source_address = None
+        self._timer = None
+        self.time = None
+        self.last_activity = None
+        self._protocol = None
+        self._connecting = None
+        self._passthrough = False
+        self._read_started = None
+        self._closed = False
+        self.transport = None
+        self.outgoing = None
+        self.metrics = None
+        self.hooks = None
+        self.limits = None
+        self.transferred_up = self.transferred_down = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        rejection = None
+        handshake_timeout = self._handshake_timeout
+        if self._server_limits is not None:
+            try:
+                self.limits, rejection = self._server_limits.admit(transport.get_extra_info("peername")[0])
+            except SocksLimitException as exc:
+                logger.debug("connection dropped: %s", exc)
+                self._closed = True
+                transport.close()
+                return
+        if rejection is not None:
+            # client gets failure reply to its request in short time
+            logger.debug("connection rejected: %s", rejection)
+            handshake_timeout = self._server_limits.handshake_timeout(handshake_timeout)
+        if self._socket_options is not None:
+            _apply_socket_options(self._socket_options, transport)
+        loop = asyncio.get_running_loop()
+        self.time = loop.time
+        if handshake_timeout is not None:
+            self._timer = loop.call_later(handshake_timeout, self._handshake_timed_out)
+        if self._server_metrics is not None:
+            self.metrics = self._server_metrics.connection()
+        if self._hooks_factory is not None:
+            self.hooks = self._hooks_factory()
+        self._protocol = SocksServer(rejection=rejection, **self._socks_protocol_kw)
+        self._step(self._protocol.send, None)
+
+    def _step(self, generator_method, data):
+        while True:
+            try:
+                message = generator_method(data)
+            except StopIteration:
+                return self.close()
+            except Exception as exc:
+                log_failure(logger, exc)
+                if self.metrics is not None:
+                    self.metrics.failed(exc)
+                return self.close()
+            if message.__class__ is dict:
+                message = from_dict(message)
+            generator_method, data = self._protocol.send, None
+            opcode = message.opcode
+            if opcode == Read.opcode:
+                if self.hooks is not None:
+                    self._read_started = time.perf_counter()
+                return
+            elif opcode == Write.opcode:
+                if self.hooks is None:
+                    self.transport.write(message.data)
+                else:
+                    started = time.perf_counter()
+                    self.transport.write(message.data)
+                    self.hooks.write(started, time.perf_counter(), len(message.data))
+            elif opcode == Connect.opcode:
+                self.transport.pause_reading()
+                self._connecting = asyncio.ensure_future(self._connect(message.host, message.port))
+                return
+            elif opcode == Passthrough.opcode:
+                logger.debug("passthrough started")
+                if self.metrics is not None:
+                    self.metrics.passthrough()
+                if self.hooks is not None:
+                    self.hooks.passthrough_started(time.perf_counter())
+                self._passthrough = True
+                if message.data:
+                    # pipelined client data
+                    self.outgoing.transport.write(message.data)
+                    self.transferred_up += len(message.data)
+                    if self.metrics is not None:
+                        self.metrics.transferred("up", len(message.data))
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if self._idle_timeout is not None:
+                    self.last_activity = self.time()
+                    self._timer = asyncio.get_running_loop().call_at(
+                        self.last_activity + self._idle_timeout,
+                        self._check_idle,
+                    )
+                self.transport.resume_reading()
+                self.outgoing.transport.resume_reading()
+                return
+
+    def _handshake_timed_out(self):
+        logger.debug("handshake timeout")
+        self._timer = None
+        self.close()
+
+    def _check_idle(self):
+        deadline = self.last_activity + self._idle_timeout
+        if deadline > self.time():
+            self._timer = asyncio.get_running_loop().call_at(deadline, self._check_idle)
+            return
+        logger.debug("passthrough idle timeout")
+        self._timer = None
+        self.close()
+
+    async def _connect(self, host, port):
+        logger.debug("connect call %s:%d", host, port)
+        loop = asyncio.get_running_loop()
+        factory = functools.partial(_OutgoingProtocol, self)
+        if self.metrics is not None:
+            self.metrics.connect(host, port)
+        started = time.perf_counter()
+        try:
+            if self.limits is not None:
+                self.limits.connect()
+            async with asyncio.timeout(self._connect_timeout):
+                sock = await create_connection(
+                    host,
+                    port,
+                    happy_eyeballs_delay=self._happy_eyeballs_delay,
+                    resolver=self._resolver,
+                    socket_options=self._socket_options,
+                    source_addresses=self._source_addresses,
+                )
+                if self._source_addresses is not None:
+                    self._source_address = self._source_addresses.address_of(sock)
+                _, self.outgoing = await loop.create_connection(factory, sock=sock)
+        except Exception as exc:
+            if self.limits is not None:
+                self.limits.connected()
+            if self.metrics is not None:
+                self.metrics.connected(exc)
+            if self.hooks is not None:
+                self.hooks.connect(started, time.perf_counter(), host, port, exc)
+            self._step(self._protocol.throw, exc)
+        else:
+            if self.limits is not None:
+                self.limits.connected()
+            if self.metrics is not None:
+                self.metrics.connected()
+            if self.hooks is not None:
+                self.hooks.connect(started, time.perf_counter(), host, port, None)
+            self._step(self._protocol.send, None)
+
+    def data_received(self, data):
+        if self._passthrough:
+            self.outgoing.transport.write(data)
+            self.transferred_up += len(data)
+            if self.metrics is not None:
+                self.metrics.transferred("up", len(data))
+            if self._idle_timeout is not None:
+                self.last_activity = self.time()
+        else:
+            if self.metrics is not None:
+                self.metrics.received(data)
+            if self.hooks is not None:
+                self.hooks.read(self._read_started, time.perf_counter(), data)
+            self._step(self._protocol.send, data)
+
+    def eof_received(self):
+        if self._passthrough:
+            self.close()
+        else:
+            if self.hooks is not None:
+                self.hooks.read(self._read_started, time.perf_counter(), b"")
+            self._step(self._protocol.send, b"")
+
+    def connection_lost(self, exc):
+        self.close()
+
+    def pause_writing(self):
+        if self.outgoing is not None:
+            self.outgoing.transport.pause_reading()
+
+    def resume_writing(self):
+        if self.outgoing is not None:
+            self.outgoing.transport.resume_reading()
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._connecting is not None and not self._connecting.done():
+            self._connecting.cancel()
+        if self.outgoing is not None:
+            self.outgoing.transport.close()
+        self.transport.close()
+        if self._closed:
+            return
+        self._closed = True
+        if self.limits is not None:
+            self.limits.close()
+        if self._source_addresses is not None:
+            self._source_addresses.release(self._source_address)
+        if self.metrics is not None:
+            self.metrics.close()
+        if self.hooks is not None and self._passthrough:
+            self.hooks.passthrough_finished(time.perf_counter(), (self.transferred_up, self.transferred_down))
+
+
 class ClientIO(AbstractSocksIO):
     def __init__(self, reader, writer):
         self.r = reader
         self.w = writer
+        self.received = 0
 
     async def read(self):
-        return await self.r.read(DEFAULT_BLOCK_SIZE)
+        data = await self.r.read(DEFAULT_BLOCK_SIZE)
+        self.received += len(data)
+        return data
 
     async def write(self, data):
         self.w.write(data)
@@ -81,8 +801,14 @@ class ClientIO(AbstractSocksIO):
     async def connect(self, *_):
         raise RuntimeError("ClientIO.connect should not be called")
 
-    async def passthrough(self):
-        return
+    async def passthrough(self, data=b""):
+        # destination data received along with socks reply goes back to reader, before data it received since
+        if data:
+            buffer = _read_buffer(self.r)
+            if buffer:
+                buffer[:0] = data
+            else:
+                self.r.feed_data(data)
 
 
 async def open_connection(
@@ -97,8 +823,14 @@ async def open_connection(
     encoding=DEFAULT_ENCODING,
     socks4_extras={},
     socks5_extras={},
+    optimistic=False,
+    early_data=b"",
     **open_connection_extras,
 ):
+    """
+    `optimistic` and `early_data` are `siosocks.protocol.SocksClient` arguments, without socks `early_data` is
+    written right after connect
+    """
     socks_required = socks_host, socks_port, socks_version
     socks_enabled = all(socks_required)
     socks_disabled = not any(socks_required)
@@ -118,9 +850,168 @@ async def open_connection(
             encoding=encoding,
             socks4_extras=socks4_extras,
             socks5_extras=socks5_extras,
+            optimistic=optimistic,
+            early_data=early_data,
         )
         io = ClientIO(reader, writer)
         await async_engine(protocol, io)
     else:
         reader, writer = await asyncio.open_connection(host, port, **open_connection_extras)
+        writer.write(early_data)
     return reader, writer
+
+
+class ClientPool:
+    """
+    Pool of connections to socks server with socks5 greeting and auth already done (plain tcp connections for
+    socks4), so new tunnel costs only connect request round trip, use as `async with ClientPool(...) as pool`
+
+    Pool keeps `size` idle connections, idle connection is replaced when server closes it or after `ttl` seconds
+    (keep it below server handshake timeout), failed connection attempt is repeated after `retry_delay` seconds.
+    `open_connection_extras` are passed to `asyncio.open_connection`, `optimistic` applies to
+    connections opened when there is no idle one
+    """
+
+    def __init__(
+        self,
+        socks_host,
+        socks_port,
+        socks_version,
+        *,
+        username=None,
+        password=None,
+        encoding=DEFAULT_ENCODING,
+        size=DEFAULT_POOL_SIZE,
+        ttl=DEFAULT_POOL_TTL,
+        retry_delay=DEFAULT_POOL_RETRY_DELAY,
+        optimistic=False,
+        **open_connection_extras,
+    ):
+        if socks_version == 4 and username is not None:
+            raise SocksException("Socks4 do not provide auth methods, but auth provided")
+        self.socks_host = socks_host
+        self.socks_port = socks_port
+        self.socks_version = socks_version
+        self.size = size
+        self.ttl = ttl
+        self.retry_delay = retry_delay
+        self.optimistic = optimistic
+        self._client_kw = dict(username=username, password=password, encoding=encoding)
+        self._open_connection_extras = open_connection_extras
+        # (reader, writer) -> task holding idle connection, insertion ordered, newest is taken first
+        self._idle = {}
+        self._starting = 0
+        self._tasks = set()
+        self._closed = False
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    async def __aenter__(self):
+        self._fill()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        self._closed = True
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+    def _fill(self):
+        while not self._closed and len(self._idle) + self._starting < self.size:
+            self._starting += 1
+            task = asyncio.ensure_future(self._keep())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _greet(self):
+        reader, writer = await asyncio.open_connection(self.socks_host, self.socks_port, **self._open_connection_extras)
+        try:
+            await async_engine(SocksClientGreeting(self.socks_version, **self._client_kw), ClientIO(reader, writer))
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _keep(self):
+        """
+        Establish connection and hold it until it is taken, expired or closed by server
+        """
+        try:
+            reader, writer = await self._greet()
+        except Exception as exc:
+            logger.debug("pool connection failed: %r", exc)
+            await asyncio.sleep(self.retry_delay)
+            self._starting -= 1
+            self._fill()
+            return
+        self._starting -= 1
+        self._idle[reader, writer] = asyncio.current_task()
+        try:
+            with contextlib.suppress(TimeoutError):
+                async with asyncio.timeout(self.ttl):
+                    # server sends nothing before connect request, so this is end of file or protocol violation
+                    await reader.read(1)
+        finally:
+            # connection is not taken
+            if self._idle.pop((reader, writer), None) is not None:
+                writer.close()
+                self._fill()
+
+    async def _take(self):
+        while self._idle:
+            (reader, writer), task = self._idle.popitem()
+            task.cancel()
+            await asyncio.wait([task])
+            if task.cancelled():
+                return reader, writer
+            writer.close()
+        return None
+
+    async def open_connection(self, host, port, *, socks4_extras={}, socks5_extras={}, early_data=b""):
+        """
+        Same as `open_connection` through pool socks server, opens new connection if there is no idle one
+        """
+        pooled = await self._take()
+        self._fill()
+        if pooled is not None:
+            reader, writer = pooled
+            io = ClientIO(reader, writer)
+            protocol = SocksClient(
+                host,
+                port,
+                self.socks_version,
+                socks4_extras=socks4_extras,
+                socks5_extras=socks5_extras,
+                greeting=False,
+                early_data=early_data,
+                **self._client_kw,
+            )
+            try:
+                await async_engine(protocol, io)
+            except Exception as exc:
+                writer.close()
+                if io.received:
+                    raise
+                # server closed idle connection right before request
+                logger.debug("pool connection is stale: %r", exc)
+            else:
+                return reader, writer
+        return await open_connection(
+            host,
+            port,
+            socks_host=self.socks_host,
+            socks_port=self.socks_port,
+            socks_version=self.socks_version,
+            socks4_extras=socks4_extras,
+            socks5_extras=socks5_extras,
+            optimistic=self.optimistic,
+            early_data=early_data,
+            **self._client_kw,
+            **self._open_connection_extras,
+        )
@@ -1 +1,14 @@
 DEFAULT_BLOCK_SIZE = 8192
+# seconds, RFC 8305 recommended connection attempt delay
+DEFAULT_HAPPY_EYEBALLS_DELAY = 0.25
+# client pool idle connections count
+DEFAULT_POOL_SIZE = 4
+# seconds, client pool idle connection lifetime (below common server handshake timeouts) and failed attempt delay
+DEFAULT_POOL_TTL = 20
+DEFAULT_POOL_RETRY_DELAY = 1
+# upper bound for adaptive passthrough read size
+DEFAULT_MAX_BLOCK_SIZE = 2**18
+# passthrough buffers kept by buffer pool
+DEFAULT_BUFFER_POOL_SIZE = 64
+# selector server threads for blocking name resolution, when there is no connect thread pool
+DEFAULT_RESOLVE_WORKERS = 4
@@ -0,0 +1,574 @@
+import collections
+import errno
+import heapq
+import itertools
+import logging
+import os
+import selectors
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ..exceptions import SocksLimitException
+from ..interface import log_failure
+from ..protocol import SocksServer
+from ..resolver import interleave, is_ip_address, numeric_infos
+from ..sansio import Connect, Passthrough, Read, Write, from_dict
+from .const import DEFAULT_BLOCK_SIZE, DEFAULT_HAPPY_EYEBALLS_DELAY, DEFAULT_RESOLVE_WORKERS
+from .socket import Tunnel, create_connection, set_events
+
+logger = logging.getLogger(__name__)
+
+
+class _Timer:
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _Connection:
+    def __init__(self, server, sock, limits, rejection=None):
+        self.server = server
+        self.incoming_socket = sock
+        self.limits = limits
+        self.outgoing_socket = None
+        # `server.source_addresses` address of outgoing socket, released on close
+        self.source_address = None
+        self.protocol = SocksServer(rejection=rejection, **server.socks_protocol_kw)
+        self.pending = None
+        # name resolution in `server.resolver` thread, then resolved addresses to try
+        self.resolving = None
+        self.addresses = None
+        # non-blocking connect attempts in progress
+        self.attempts = set()
+        self.attempt_timer = None
+        self.connect_timer = None
+        self.connect_error = None
+        # handshake timeout timer, then idle timeout timer
+        self.timer = None
+        self.last_activity = None
+        self.tunnel = None
+        self.closed = False
+        self.metrics = None if server.metrics is None else server.metrics.connection()
+        self.hooks = None if server.hooks_factory is None else server.hooks_factory()
+        # start of current handshake io operation and its subject, for hooks
+        self._started = None
+        self._subject = None
+        handshake_timeout = server.handshake_timeout
+        if rejection is not None:
+            handshake_timeout = server.limits.handshake_timeout(handshake_timeout)
+        if handshake_timeout is not None:
+            self.timer = server.call_later(handshake_timeout, self._timed_out, "handshake timeout")
+
+    def _set_events(self, sock, events):
+        set_events(self.server.selector, sock, events, self)
+
+    def step(self, generator_method, data):
+        while True:
+            try:
+                message = generator_method(data)
+            except StopIteration:
+                return self.close()
+            except Exception as exc:
+                log_failure(logger, exc)
+                if self.metrics is not None:
+                    self.metrics.failed(exc)
+                return self.close()
+            if message.__class__ is dict:
+                message = from_dict(message)
+            generator_method, data = self.protocol.send, None
+            opcode = message.opcode
+            if self.hooks is not None:
+                self._started = time.perf_counter()
+            if opcode == Read.opcode:
+                return self._set_events(self.incoming_socket, selectors.EVENT_READ)
+            elif opcode == Write.opcode:
+                try:
+                    sent = self.incoming_socket.send(message.data)
+                except BlockingIOError:
+                    sent = 0
+                except OSError as exc:
+                    generator_method, data = self.protocol.throw, exc
+                    continue
+                if sent < len(message.data):
+                    self.pending = memoryview(message.data)[sent:]
+                    self._subject = len(message.data)
+                    return self._set_events(self.incoming_socket, selectors.EVENT_WRITE)
+                if self.hooks is not None:
+                    self.hooks.write(self._started, time.perf_counter(), sent)
+            elif opcode == Connect.opcode:
+                self._set_events(self.incoming_socket, 0)
+                return self.connect(message.host, message.port)
+            elif opcode == Passthrough.opcode:
+                logger.debug("passthrough started")
+                if self.metrics is not None:
+                    self.metrics.passthrough()
+                if self.hooks is not None:
+                    self.hooks.passthrough_started(self._started)
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if self.server.idle_timeout is not None:
+                    self.last_activity = time.monotonic()
+                    self.timer = self.server.call_later(self.server.idle_timeout, self._check_idle)
+                self.tunnel = Tunnel(
+                    self.incoming_socket,
+                    self.outgoing_socket,
+                    splice=self.server.splice,
+                    data=message.data,
+                    metrics=self.metrics,
+                    **self.server.relay_kw,
+                )
+                return self._update_tunnel()
+
+    def connect(self, host, port):
+        logger.debug("connect call %s:%d", host, port)
+        self._subject = host, port
+        if self.metrics is not None:
+            self.metrics.connect(host, port)
+        if self.limits is not None:
+            try:
+                self.limits.connect()
+            except SocksLimitException as exc:
+                return self._connect_failed(exc)
+        if self.server.executor is not None:
+            future = self.server.executor.submit(
+                create_connection,
+                (host, port),
+                happy_eyeballs_delay=self.server.happy_eyeballs_delay,
+                timeout=self.server.connect_timeout,
+                socket_options=self.server.socket_options,
+                source_addresses=self.server.source_addresses,
+            )
+            future.add_done_callback(lambda f: self.server.call_soon(self._connected, f))
+            return
+        if self.server.connect_timeout is not None:
+            self.connect_timer = self.server.call_later(self.server.connect_timeout, self._connect_timed_out)
+        if is_ip_address(host):
+            return self._connect_addresses(numeric_infos(host, port))
+        # name resolution is blocking, so it is done in resolver threads
+        self.resolving = self.server.resolver.submit(socket.getaddrinfo, host, port, type=socket.SOCK_STREAM)
+        self.resolving.add_done_callback(lambda f: self.server.call_soon(self._resolved, f))
+
+    def _resolved(self, future):
+        if future is not self.resolving:
+            # connection is closed or connect timed out
+            return
+        self.resolving = None
+        try:
+            infos = future.result()
+        except Exception as exc:
+            return self._connect_failed(exc)
+        self._connect_addresses(infos)
+
+    def _connect_addresses(self, infos):
+        self.addresses = collections.deque(interleave(infos))
+        self._connect_next()
+
+    def _connect_timed_out(self):
+        self.connect_timer = None
+        if self.addresses is not None:
+            self.addresses.clear()
+        self._close_attempts()
+        self._connect_failed(TimeoutError(f"Connect to {self._subject[0]}:{self._subject[1]} timed out"))
+
+    def _timed_out(self, reason):
+        logger.debug(reason)
+        self.timer = None
+        self.close()
+
+    def _check_idle(self):
+        deadline = self.last_activity + self.server.idle_timeout
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            self.timer = self.server.call_later(remaining, self._check_idle)
+            return
+        self._timed_out("passthrough idle timeout")
+
+    def _connect_next(self):
+        """
+        Start next connect attempt, called on connect start, attempt failure and happy eyeballs delay timeout
+        """
+        if self.attempt_timer is not None:
+            self.attempt_timer.cancel()
+            self.attempt_timer = None
+        while self.addresses:
+            family, kind, proto, _, address = self.addresses.popleft()
+            sock = None
+            try:
+                sock = socket.socket(family, kind, proto)
+                if self.server.socket_options is not None:
+                    self.server.socket_options.apply_outgoing(sock)
+                if self.server.source_addresses is not None:
+                    self.server.source_addresses.bind(sock)
+                sock.setblocking(False)
+                code = sock.connect_ex(address)
+                if code not in (0, errno.EINPROGRESS):
+                    raise OSError(code, os.strerror(code))
+            except OSError as exc:
+                self.connect_error = exc
+                if sock is not None:
+                    self._close_attempt(sock)
+                continue
+            self.attempts.add(sock)
+            self._set_events(sock, selectors.EVENT_WRITE)
+            delay = self.server.happy_eyeballs_delay
+            if self.addresses and delay is not None:
+                self.attempt_timer = self.server.call_later(delay, self._connect_next)
+            return
+        if not self.attempts:
+            # getaddrinfo never returns empty list, so there is at least one error
+            self._connect_failed(self.connect_error)
+
+    def _close_attempts(self):
+        self._cancel_connect_timer()
+        if self.resolving is not None:
+            self.resolving.cancel()
+            self.resolving = None
+        if self.attempt_timer is not None:
+            self.attempt_timer.cancel()
+            self.attempt_timer = None
+        for sock in self.attempts:
+            self._set_events(sock, 0)
+            self._close_attempt(sock)
+        self.attempts.clear()
+
+    def _close_attempt(self, sock):
+        if self.server.source_addresses is None:
+            sock.close()
+        else:
+            self.server.source_addresses.close(sock)
+
+    def _set_outgoing(self, sock):
+        self.outgoing_socket = sock
+        if self.server.source_addresses is not None:
+            self.source_address = self.server.source_addresses.address_of(sock)
+
+    def _cancel_connect_timer(self):
+        if self.connect_timer is not None:
+            self.connect_timer.cancel()
+            self.connect_timer = None
+
+    def _connect_failed(self, exc):
+        self._cancel_connect_timer()
+        if self.limits is not None:
+            self.limits.connected()
+        if self.metrics is not None:
+            self.metrics.connected(exc)
+        if self.hooks is not None:
+            self.hooks.connect(self._started, time.perf_counter(), *self._subject, exc)
+        self.step(self.protocol.throw, exc)
+
+    def _connect_done(self):
+        self._cancel_connect_timer()
+        if self.limits is not None:
+            self.limits.connected()
+        if self.metrics is not None:
+            self.metrics.connected()
+        if self.hooks is not None:
+            self.hooks.connect(self._started, time.perf_counter(), *self._subject, None)
+        self.step(self.protocol.send, None)
+
+    def _connected(self, future):
+        if self.closed:
+            if not future.cancelled() and future.exception() is None:
+                self._close_attempt(future.result())
+            return
+        try:
+            self._set_outgoing(future.result())
+        except Exception as exc:
+            self._connect_failed(exc)
+        else:
+            self.outgoing_socket.setblocking(False)
+            self._connect_done()
+
+    def _update_tunnel(self):
+        if self.tunnel.done:
+            return self.close()
+        for sock, events in self.tunnel.interest().items():
+            self._set_events(sock, events)
+
+    def process(self, sock, mask):
+        if self.tunnel is not None:
+            if self.timer is not None:
+                self.last_activity = time.monotonic()
+            try:
+                changed = self.tunnel.process(sock, mask)
+            except OSError as exc:
+                logger.debug("passthrough failed: %r", exc)
+                return self.close()
+            if changed:
+                self._update_tunnel()
+            return
+        if sock in self.attempts:
+            self.attempts.discard(sock)
+            self._set_events(sock, 0)
+            code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if code:
+                self._close_attempt(sock)
+                self.connect_error = OSError(code, os.strerror(code))
+                return self._connect_next()
+            self._close_attempts()
+            self._set_outgoing(sock)
+            return self._connect_done()
+        if self.pending is not None:
+            try:
+                sent = self.incoming_socket.send(self.pending)
+            except BlockingIOError:
+                return
+            except OSError as exc:
+                self.pending = None
+                return self.step(self.protocol.throw, exc)
+            self.pending = self.pending[sent:]
+            if self.pending:
+                return
+            self.pending = None
+            if self.hooks is not None:
+                self.hooks.write(self._started, time.perf_counter(), self._subject)
+            return self.step(self.protocol.send, None)
+        try:
+            data = self.incoming_socket.recv(DEFAULT_BLOCK_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as exc:
+            return self.step(self.protocol.throw, exc)
+        if self.metrics is not None:
+            self.metrics.received(data)
+        if self.hooks is not None:
+            self.hooks.read(self._started, time.perf_counter(), data)
+        self.step(self.protocol.send, data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.server.connections.discard(self)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.tunnel is not None:
+            self.tunnel.close()
+        if self.metrics is not None:
+            self.metrics.close()
+        if self.hooks is not None and self.tunnel is not None:
+            self.hooks.passthrough_finished(time.perf_counter(), self.tunnel.transferred)
+        self._close_attempts()
+        for sock in (self.incoming_socket, self.outgoing_socket):
+            if sock is not None:
+                self._set_events(sock, 0)
+                sock.close()
+        if self.server.source_addresses is not None:
+            self.server.source_addresses.release(self.source_address)
+        if self.limits is not None:
+            self.limits.close()
+            self.server._resume_accepting()
+
+
+class SelectorServer:
+    """
+    Single-threaded event driven socks server, mimics `socketserver.TCPServer` api
+
+    `connect_workers` is size of thread pool for outgoing connections (with name resolution), if zero
+    connections are made from event loop thread with non-blocking connect, and domain names are resolved in pool of
+    `resolve_workers` threads
+
+    `io_kw` are `splice`, `happy_eyeballs_delay` (RFC 8305 connection attempt delay, `None` tries resolved
+    addresses one by one) and timeouts in seconds (`None` for no limit): `handshake_timeout` from accept to
+    passthrough start, `connect_timeout` for outgoing connection, `idle_timeout` for tunnel without socket events,
+    `block_size` and `max_block_size` for passthrough reads (see `siosocks.buffers.BlockSize`), `socket_options`
+    (`siosocks.sockopts.SocketOptions`) for listening, accepted and outgoing sockets and `source_addresses`
+    (`siosocks.sources.SourceAddresses`) for outgoing connections
+
+    `metrics` is optional `siosocks.metrics.ServerMetrics`, `hooks_factory` is optional callable, which returns
+    `siosocks.interface.EngineHooks` for each connection, `limits` is optional `siosocks.limits.ServerLimits`, server
+    stops accepting while `max_connections` is reached (clients wait in listen backlog), `buffer_pool` is optional
+    `siosocks.buffers.BufferPool` for passthrough
+    """
+
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        server_address,
+        *,
+        family=socket.AF_INET,
+        connect_workers=0,
+        resolve_workers=DEFAULT_RESOLVE_WORKERS,
+        reuse_port=False,
+        socks_protocol_kw={},
+        io_kw={},
+        metrics=None,
+        hooks_factory=None,
+        limits=None,
+        buffer_pool=None,
+    ):
+        self.socks_protocol_kw = socks_protocol_kw
+        self.metrics = metrics
+        self.hooks_factory = hooks_factory
+        self.limits = limits
+        self.splice = io_kw.get("splice", False)
+        self.happy_eyeballs_delay = io_kw.get("happy_eyeballs_delay", DEFAULT_HAPPY_EYEBALLS_DELAY)
+        self.handshake_timeout = io_kw.get("handshake_timeout")
+        self.connect_timeout = io_kw.get("connect_timeout")
+        self.idle_timeout = io_kw.get("idle_timeout")
+        self.relay_kw = dict(
+            block_size=io_kw.get("block_size", DEFAULT_BLOCK_SIZE),
+            max_block_size=io_kw.get("max_block_size"),
+            buffer_pool=buffer_pool,
+        )
+        self.socket_options = io_kw.get("socket_options")
+        self.source_addresses = io_kw.get("source_addresses")
+        self.socket = socket.create_server(
+            server_address,
+            family=family,
+            backlog=self.request_queue_size,
+            reuse_port=reuse_port,
+        )
+        if self.socket_options is not None:
+            self.socket_options.apply_listener(self.socket)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+        self.executor = self.resolver = None
+        if connect_workers:
+            self.executor = ThreadPoolExecutor(max_workers=connect_workers, thread_name_prefix="siosocks-connect")
+        else:
+            self.resolver = ThreadPoolExecutor(max_workers=resolve_workers, thread_name_prefix="siosocks-resolve")
+        self.selector = None
+        self.connections = set()
+        self._callbacks = collections.deque()
+        self._timers = []
+        self._timers_counter = itertools.count()
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._wakeup_read.setblocking(False)
+        self._wakeup_write.setblocking(False)
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+
+    def call_soon(self, callback, *args):
+        """
+        Thread-safe scheduling of callback call in event loop thread
+        """
+        self._callbacks.append((callback, args))
+        try:
+            self._wakeup_write.send(b"\x00")
+        except BlockingIOError:
+            pass
+        except OSError:
+            # connect worker finished after `server_close`, there is no loop to run callback
+            if self._wakeup_write.fileno() != -1:
+                raise
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedule callback call after `delay` seconds, event loop thread only, returns timer with `cancel` method
+        """
+        timer = _Timer(time.monotonic() + delay, callback, args)
+        heapq.heappush(self._timers, (timer.deadline, next(self._timers_counter), timer))
+        return timer
+
+    def _run_timers(self):
+        """
+        Run due timers, returns seconds until next one or `None`
+        """
+        while self._timers:
+            deadline, _, timer = self._timers[0]
+            if timer.cancelled:
+                heapq.heappop(self._timers)
+                continue
+            timeout = deadline - time.monotonic()
+            if timeout > 0:
+                return timeout
+            heapq.heappop(self._timers)
+            timer.callback(*timer.args)
+        return None
+
+    def _run_callbacks(self):
+        try:
+            while self._wakeup_read.recv(DEFAULT_BLOCK_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        while self._callbacks:
+            callback, args = self._callbacks.popleft()
+            callback(*args)
+
+    def _accept(self):
+        while True:
+            if self.limits is not None and self.limits.full():
+                set_events(self.selector, self.socket, 0)
+                return
+            try:
+                sock, address = self.socket.accept()
+            except BlockingIOError:
+                return
+            rejection = limits = None
+            if self.limits is not None:
+                try:
+                    limits, rejection = self.limits.admit(address[0])
+                except SocksLimitException as exc:
+                    logger.debug("connection dropped: %s", exc)
+                    sock.close()
+                    continue
+            if rejection is not None:
+                # client gets failure reply to its request in short time
+                logger.debug("connection rejected: %s", rejection)
+            sock.setblocking(False)
+            if self.socket_options is not None:
+                self.socket_options.apply(sock)
+            connection = _Connection(self, sock, limits, rejection)
+            self.connections.add(connection)
+            connection.step(connection.protocol.send, None)
+
+    def _resume_accepting(self):
+        if self.selector is not None and not self.limits.full():
+            set_events(self.selector, self.socket, selectors.EVENT_READ)
+
+    def serve_forever(self, poll_interval=0.5):
+        self._is_shut_down.clear()
+        try:
+            with selectors.DefaultSelector() as self.selector:
+                self.selector.register(self.socket, selectors.EVENT_READ)
+                self.selector.register(self._wakeup_read, selectors.EVENT_READ)
+                while not self._shutdown_request:
+                    timeout = self._run_timers()
+                    timeout = poll_interval if timeout is None else min(timeout, poll_interval)
+                    for key, mask in self.selector.select(timeout):
+                        if key.fileobj is self.socket:
+                            self._accept()
+                        elif key.fileobj is self._wakeup_read:
+                            self._run_callbacks()
+                        else:
+                            key.data.process(key.fileobj, mask)
+                for connection in list(self.connections):
+                    connection.close()
+        finally:
+            self.selector = None
+            self._shutdown_request = False
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        self._shutdown_request = True
+        self.call_soon(lambda: None)
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        self.socket.close()
+        self._wakeup_read.close()
+        self._wakeup_write.close()
+        for executor in (self.executor, self.resolver):
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server_close()
@@ -1,66 +1,518 @@
+import collections
+import errno
 import logging
+import os
+import selectors
 import socket
 import socketserver
-from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+import time
 
-from ..interface import AbstractSocksIO, sync_engine
+from ..buffers import BlockSize
+from ..exceptions import SocksLimitException
+from ..interface import AbstractSocksIO, log_failure, sync_engine
 from ..protocol import SocksServer
-from .const import DEFAULT_BLOCK_SIZE
+from ..resolver import interleave
+from .const import DEFAULT_BLOCK_SIZE, DEFAULT_HAPPY_EYEBALLS_DELAY
 
 logger = logging.getLogger(__name__)
 
 
-TIMEOUT = 0.5
+SPLICE_AVAILABLE = hasattr(os, "splice")
+# default linux pipe capacity
+SPLICE_BLOCK_SIZE = 2**16
+
+
+class CopyRelay:
+    """
+    One direction of non-blocking passthrough, copies data through userspace, reads `block_size` bytes at once,
+    adaptive up to `max_block_size` if it is set
+
+    Data is received into reused buffer, taken from `buffer_pool` (`siosocks.buffers.BufferPool`) for each read, or
+    owned by relay if there is no pool, own buffer has current block size and is replaced by bigger one when block grows
+
+    Received bytes are counted by `metrics` (`siosocks.metrics.ConnectionMetrics`) as `direction` on each read
+    """
+
+    def __init__(
+        self,
+        producer,
+        consumer,
+        *,
+        block_size=DEFAULT_BLOCK_SIZE,
+        max_block_size=None,
+        buffer_pool=None,
+        metrics=None,
+        direction="up",
+    ):
+        self.producer = producer
+        self.consumer = consumer
+        self.metrics = metrics
+        self.direction = direction
+        self.block = BlockSize(block_size, max_block_size)
+        self.buffer_pool = buffer_pool
+        self.buffer = None
+        self.pending = None
+        self.eof = False
+        self.transferred = 0
+
+    @property
+    def reading(self):
+        return not self.eof and not self.pending
+
+    @property
+    def writing(self):
+        return bool(self.pending)
+
+    @property
+    def done(self):
+        return self.eof and not self.pending
+
+    def process(self, sock, mask):
+        if sock is self.producer and mask & selectors.EVENT_READ and self.reading:
+            self._receive()
+        elif sock is self.consumer and mask & selectors.EVENT_WRITE and self.writing:
+            self._send()
+
+    def _receive(self):
+        buffer = self.buffer
+        if buffer is None:
+            if self.buffer_pool is None:
+                buffer = bytearray(self.block.size)
+            else:
+                buffer = self.buffer_pool.acquire()
+            self.buffer = buffer
+        elif len(buffer) < self.block.size:
+            # own buffer holds no data while relay reads
+            buffer = self.buffer = bytearray(self.block.size)
+        try:
+            size = self.producer.recv_into(buffer, min(self.block.size, len(buffer)))
+        except BlockingIOError:
+            return self._release()
+        if not size:
+            self._release()
+            return self._shutdown()
+        self.block.update(size)
+        self._count(size)
+        self.pending = memoryview(buffer)[:size]
+        self._send()
+
+    def _send(self):
+        try:
+            sent = self.consumer.send(self.pending)
+        except BlockingIOError:
+            return
+        self.pending = self.pending[sent:]
+        if not self.pending:
+            self._release()
+
+    def _release(self):
+        # pooled buffer goes back as soon as it holds no data, own buffer is kept
+        if self.buffer_pool is not None and self.buffer is not None:
+            self.pending = None
+            self.buffer_pool.release(self.buffer)
+            self.buffer = None
+
+    def feed(self, data):
+        """
+        Queue data, which was received from producer before relay started, relay must be idle
+        """
+        self._count(len(data))
+        self.pending = memoryview(data)
+
+    def _count(self, size):
+        self.transferred += size
+        if self.metrics is not None:
+            self.metrics.transferred(self.direction, size)
+
+    def _shutdown(self):
+        self.eof = True
+        # propagate half-close to other side
+        try:
+            self.consumer.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.pending = None
+        self._release()
+
+
+class SpliceRelay(CopyRelay):
+    """
+    One direction of non-blocking passthrough, moves data socket -> pipe -> socket inside kernel, up to pipe
+    capacity at once, block size and buffer pool arguments are ignored
+    """
+
+    def __init__(self, producer, consumer, *, metrics=None, direction="up", **relay_kw):
+        super().__init__(producer, consumer, metrics=metrics, direction=direction)
+        self.pending = 0
+        self.pipe_read, self.pipe_write = os.pipe()
+
+    def _receive(self):
+        try:
+            size = os.splice(self.producer.fileno(), self.pipe_write, SPLICE_BLOCK_SIZE)
+        except BlockingIOError:
+            return
+        if not size:
+            return self._shutdown()
+        self._count(size)
+        self.pending = size
+        self._send()
+
+    def _send(self):
+        try:
+            self.pending -= os.splice(self.pipe_read, self.consumer.fileno(), self.pending)
+        except BlockingIOError:
+            return
+
+    def feed(self, data):
+        # empty pipe takes up to its capacity without blocking, data is at most one read block
+        os.write(self.pipe_write, data)
+        self._count(len(data))
+        self.pending = len(data)
+
+    def close(self):
+        os.close(self.pipe_read)
+        os.close(self.pipe_write)
+
+
+def set_events(selector, sock, events, data=None):
+    """
+    Register, modify or unregister socket, depending on events mask
+    """
+    try:
+        key = selector.get_key(sock)
+    except KeyError:
+        if events:
+            selector.register(sock, events, data)
+        return
+    if not events:
+        selector.unregister(sock)
+    elif key.events != events:
+        selector.modify(sock, events, data)
+
+
+class Tunnel:
+    """
+    Both directions of non-blocking passthrough between two sockets, `data` is part of a -> b stream received before
+    tunnel start, it is sent to b first, a -> b is counted by `metrics` as "up" direction
+    """
+
+    def __init__(self, a, b, *, splice=False, data=b"", **relay_kw):
+        relay_class = SpliceRelay if splice and SPLICE_AVAILABLE else CopyRelay
+        a.setblocking(False)
+        b.setblocking(False)
+        self.sockets = a, b
+        self.relays = relay_class(a, b, direction="up", **relay_kw), relay_class(b, a, direction="down", **relay_kw)
+        if data:
+            self.relays[0].feed(data)
+
+    @property
+    def done(self):
+        return all(r.done for r in self.relays)
+
+    def interest(self):
+        interest = dict.fromkeys(self.sockets, 0)
+        for r in self.relays:
+            if r.reading:
+                interest[r.producer] |= selectors.EVENT_READ
+            elif r.writing:
+                interest[r.consumer] |= selectors.EVENT_WRITE
+        return interest
+
+    def process(self, sock, mask):
+        """
+        Handle socket events, returns `True` if `interest` changed (relay buffer filled or drained, or end of file),
+        so callers touch selector registrations only then
+        """
+        changed = False
+        for r in self.relays:
+            reading, writing = r.reading, r.writing
+            r.process(sock, mask)
+            if r.reading is not reading or r.writing is not writing:
+                changed = True
+        return changed
+
+    @property
+    def transferred(self):
+        """
+        Bytes moved a -> b and b -> a
+        """
+        return tuple(r.transferred for r in self.relays)
+
+    def close(self):
+        for r in self.relays:
+            r.close()
+
+
+def relay(a, b, *, splice=False, idle_timeout=None, data=b"", **relay_kw):
+    """
+    Transfer data between two sockets in both directions until both directions reach end of file or there were no
+    socket events for `idle_timeout` seconds, returns bytes moved a -> b and b -> a (`data` is sent to b first and
+    counted), `relay_kw` are `CopyRelay` `block_size`, `max_block_size`, `buffer_pool` and `metrics`
+    """
+    tunnel = Tunnel(a, b, splice=splice, data=data, **relay_kw)
+    timeout = None
+    last_activity = time.monotonic()
+    changed = True
+    try:
+        with selectors.DefaultSelector() as selector:
+            while True:
+                if changed:
+                    if tunnel.done:
+                        break
+                    for sock, events in tunnel.interest().items():
+                        set_events(selector, sock, events)
+                    changed = False
+                if idle_timeout is not None:
+                    timeout = last_activity + idle_timeout - time.monotonic()
+                    if timeout <= 0:
+                        logger.debug("passthrough idle timeout")
+                        break
+                ready = selector.select(timeout)
+                if ready and idle_timeout is not None:
+                    last_activity = time.monotonic()
+                for key, mask in ready:
+                    if tunnel.process(key.fileobj, mask):
+                        changed = True
+    except OSError as exc:
+        logger.debug("passthrough failed: %r", exc)
+    finally:
+        tunnel.close()
+    return tunnel.transferred
+
+
+def create_connection(
+    address,
+    *,
+    happy_eyeballs_delay=DEFAULT_HAPPY_EYEBALLS_DELAY,
+    timeout=None,
+    socket_options=None,
+    source_addresses=None,
+):
+    """
+    Blocking `socket.create_connection` with RFC 8305 happy eyeballs: next resolved address is tried when previous
+    attempt failed or `happy_eyeballs_delay` seconds passed, first connected socket wins, `None` delay tries addresses
+    one by one
+
+    `timeout` bounds whole connect (excluding name resolution), `TimeoutError` is raised when it is exceeded,
+    `socket_options` is optional `siosocks.sockopts.SocketOptions` applied before connect, `source_addresses` is
+    optional `siosocks.sources.SourceAddresses`, connected socket keeps its address, caller releases it
+    """
+    host, port = address
+    infos = collections.deque(interleave(socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)))
+    deadline = None if timeout is None else time.monotonic() + timeout
+    error = None
+    close = socket.socket.close if source_addresses is None else source_addresses.close
+    with selectors.DefaultSelector() as selector:
+        try:
+            while True:
+                while infos:
+                    family, kind, proto, _, address = infos.popleft()
+                    sock = None
+                    try:
+                        sock = socket.socket(family, kind, proto)
+                        if socket_options is not None:
+                            socket_options.apply_outgoing(sock)
+                        if source_addresses is not None:
+                            source_addresses.bind(sock)
+                        sock.setblocking(False)
+                        code = sock.connect_ex(address)
+                        if code not in (0, errno.EINPROGRESS):
+                            raise OSError(code, os.strerror(code))
+                    except OSError as exc:
+                        error = exc
+                        if sock is not None:
+                            close(sock)
+                        continue
+                    if code == 0:
+                        sock.setblocking(True)
+                        return sock
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    break
+                if not selector.get_map():
+                    # getaddrinfo never returns empty list, so there is at least one error
+                    raise error
+                wait = happy_eyeballs_delay if infos else None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"Connect to {host}:{port} timed out")
+                    wait = remaining if wait is None else min(wait, remaining)
+                for key, _ in selector.select(wait):
+                    sock = key.fileobj
+                    selector.unregister(sock)
+                    code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if code:
+                        error = OSError(code, os.strerror(code))
+                        close(sock)
+                        continue
+                    sock.setblocking(True)
+                    return sock
+        finally:
+            for key in list(selector.get_map().values()):
+                close(key.fileobj)
 
 
 class ServerIO(AbstractSocksIO):
-    def __init__(self, socket):
+    def __init__(
+        self,
+        socket,
+        *,
+        splice=False,
+        metrics=None,
+        happy_eyeballs_delay=DEFAULT_HAPPY_EYEBALLS_DELAY,
+        handshake_timeout=None,
+        connect_timeout=None,
+        idle_timeout=None,
+        limits=None,
+        block_size=DEFAULT_BLOCK_SIZE,
+        max_block_size=None,
+        buffer_pool=None,
+        socket_options=None,
+        source_addresses=None,
+    ):
         self.incoming_socket = socket
-        self.incoming_socket.settimeout(TIMEOUT)
         self.outgoing_socket = None
-        self._finished = False
+        self.metrics = metrics
+        self._splice = splice
+        self._happy_eyeballs_delay = happy_eyeballs_delay
+        self._handshake_deadline = None if handshake_timeout is None else time.monotonic() + handshake_timeout
+        self._connect_timeout = connect_timeout
+        self._idle_timeout = idle_timeout
+        self._limits = limits
+        self._relay_kw = dict(block_size=block_size, max_block_size=max_block_size, buffer_pool=buffer_pool)
+        self._socket_options = socket_options
+        if socket_options is not None:
+            socket_options.apply(socket)
+        self._source_addresses = source_addresses
+        self._source_address = None
+
+    def _handshake_remaining(self):
+        if self._handshake_deadline is None:
+            return None
+        remaining = self._handshake_deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Handshake timed out")
+        return remaining
 
     def read(self):
-        return self.incoming_socket.recv(DEFAULT_BLOCK_SIZE)
+        # socket timeout error is TimeoutError
+        self.incoming_socket.settimeout(self._handshake_remaining())
+        data = self.incoming_socket.recv(DEFAULT_BLOCK_SIZE)
+        if self.metrics is not None:
+            self.metrics.received(data)
+        return data
 
     def write(self, data):
+        self.incoming_socket.settimeout(self._handshake_remaining())
         self.incoming_socket.sendall(data)
 
     def connect(self, host, port):
         logger.debug("connect call %s:%d", host, port)
-        self.outgoing_socket = socket.socket()
-        self.outgoing_socket.connect((host, port))
-        self.outgoing_socket.settimeout(TIMEOUT)
+        if self.metrics is not None:
+            self.metrics.connect(host, port)
+        try:
+            timeout = self._handshake_remaining()
+            if self._connect_timeout is not None:
+                timeout = self._connect_timeout if timeout is None else min(timeout, self._connect_timeout)
+            if self._limits is not None:
+                self._limits.connect()
+            try:
+                self.outgoing_socket = create_connection(
+                    (host, port),
+                    happy_eyeballs_delay=self._happy_eyeballs_delay,
+                    timeout=timeout,
+                    socket_options=self._socket_options,
+                    source_addresses=self._source_addresses,
+                )
+                if self._source_addresses is not None:
+                    self._source_address = self._source_addresses.address_of(self.outgoing_socket)
+            finally:
+                if self._limits is not None:
+                    self._limits.connected()
+        except Exception as exc:
+            if self.metrics is not None:
+                self.metrics.connected(exc)
+            raise
+        if self.metrics is not None:
+            self.metrics.connected()
 
-    def passthrough(self):
+    def passthrough(self, data=b""):
         logger.debug("passthrough started")
-        tasks = [
-            (self._sink, self.incoming_socket, self.outgoing_socket),
-            (self._sink, self.outgoing_socket, self.incoming_socket),
-        ]
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            fs = [executor.submit(*args) for args in tasks]
-            wait(fs, return_when=FIRST_EXCEPTION)
-            self._finished = True
-
-    def _sink(self, producer, consumer):
-        while True:
-            try:
-                data = producer.recv(DEFAULT_BLOCK_SIZE)
-                if not data:
-                    break
-                consumer.sendall(data)
-            except TimeoutError:
-                if self._finished:
-                    return
+        relay_kw = dict(splice=self._splice, idle_timeout=self._idle_timeout, data=data, **self._relay_kw)
+        if self.metrics is not None:
+            self.metrics.passthrough()
+        return relay(self.incoming_socket, self.outgoing_socket, metrics=self.metrics, **relay_kw)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.outgoing_socket is not None:
+            self.outgoing_socket.close()
+        if self._source_addresses is not None:
+            self._source_addresses.release(self._source_address)
 
 
 class socks_server_handler(socketserver.BaseRequestHandler):
-    def __init__(self, *args, socks_protocol_kw, **kwargs):
+    """
+    `socketserver` request handler, `metrics` is optional `siosocks.metrics.ServerMetrics`, `hooks_factory` is
+    optional callable, which returns `siosocks.interface.EngineHooks` for each connection, `limits` is optional
+    `siosocks.limits.ServerLimits`, `buffer_pool` is optional `siosocks.buffers.BufferPool` for passthrough
+    """
+
+    def __init__(
+        self,
+        *args,
+        socks_protocol_kw,
+        io_kw={},
+        metrics=None,
+        hooks_factory=None,
+        limits=None,
+        buffer_pool=None,
+        **kwargs,
+    ):
         self._socks_protocol_kw = socks_protocol_kw
+        self._io_kw = io_kw
+        self._metrics = metrics
+        self._hooks_factory = hooks_factory
+        self._limits = limits
+        self._buffer_pool = buffer_pool
         super().__init__(*args, **kwargs)
 
     def handle(self):
-        io = ServerIO(self.request)
-        protocol = SocksServer(**self._socks_protocol_kw)
-        sync_engine(protocol, io)
+        rejection = connection_limits = None
+        io_kw = self._io_kw
+        if self._limits is not None:
+            try:
+                connection_limits, rejection = self._limits.admit(self.client_address[0])
+            except SocksLimitException as exc:
+                logger.debug("connection dropped: %s", exc)
+                return
+        if rejection is not None:
+            # client gets failure reply to its request in short time
+            logger.debug("connection rejected: %s", rejection)
+            io_kw = dict(io_kw, handshake_timeout=self._limits.handshake_timeout(io_kw.get("handshake_timeout")))
+        connection_metrics = None if self._metrics is None else self._metrics.connection()
+        hooks = None if self._hooks_factory is None else self._hooks_factory()
+        try:
+            io = ServerIO(
+                self.request,
+                metrics=connection_metrics,
+                limits=connection_limits,
+                buffer_pool=self._buffer_pool,
+                **io_kw,
+            )
+            with io:
+                protocol = SocksServer(rejection=rejection, **self._socks_protocol_kw)
+                sync_engine(protocol, io, hooks=hooks)
+        except Exception as exc:
+            log_failure(logger, exc)
+            if connection_metrics is not None:
+                connection_metrics.failed(exc)
+        finally:
+            if connection_metrics is not None:
+                connection_metrics.close()
+            if connection_limits is not None:
+                connection_limits.close()
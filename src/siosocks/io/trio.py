@@ -1,66 +1,424 @@
+import functools
 import logging
+import math
+import socket
 
 import trio
 
-from ..exceptions import SocksException
-from ..interface import AbstractSocksIO, async_engine
-from ..protocol import DEFAULT_ENCODING, SocksClient, SocksServer
-from .const import DEFAULT_BLOCK_SIZE
+from ..buffers import BlockSize
+from ..exceptions import SocksException, SocksLimitException
+from ..interface import AbstractSocksIO, async_engine, log_failure
+from ..protocol import DEFAULT_ENCODING, SocksClient, SocksClientGreeting, SocksServer
+from ..resolver import ResolverCache, interleave, is_ip_address, numeric_infos, with_port
+from .const import (
+    DEFAULT_BLOCK_SIZE,
+    DEFAULT_HAPPY_EYEBALLS_DELAY,
+    DEFAULT_POOL_RETRY_DELAY,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_POOL_TTL,
+)
 
 logger = logging.getLogger(__name__)
+DIRECTIONS = ("up", "down")
+
+
+class Resolver:
+    """
+    Caching resolver for outgoing connections, concurrent lookups of same host share one `getaddrinfo` call
+
+    One instance is shared by all connections of server, `cache_kw` are `siosocks.resolver.ResolverCache` arguments
+    """
+
+    def __init__(self, cache=None, **cache_kw):
+        self.cache = ResolverCache(**cache_kw) if cache is None else cache
+        self._pending = {}
+
+    async def resolve(self, host, port):
+        if is_ip_address(host):
+            return numeric_infos(host, port)
+        while True:
+            infos = self.cache.get(host)
+            if infos is not None:
+                return with_port(infos, port)
+            pending = self._pending.get(host)
+            if pending is None:
+                break
+            # lookup owner fills cache, or failed without caching (cancelled), then next waiter takes over
+            await pending.wait()
+        self._pending[host] = pending = trio.Event()
+        try:
+            infos = await trio.socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        except socket.gaierror as exc:
+            self.cache.set_error(host, exc)
+            raise
+        else:
+            self.cache.set(host, infos)
+        finally:
+            del self._pending[host]
+            pending.set()
+        return with_port(infos, port)
+
+    async def open_tcp_stream(
+        self,
+        host,
+        port,
+        *,
+        happy_eyeballs_delay=None,
+        source_addresses=None,
+        socket_options=None,
+    ):
+        """
+        Connected `trio.SocketStream`, next resolved address is tried when previous attempt failed or
+        `happy_eyeballs_delay` seconds passed (RFC 8305), `None` delay tries addresses one by one
+
+        `source_addresses` is optional `siosocks.sources.SourceAddresses`, connected socket keeps its address, caller
+        releases it, `socket_options` is optional `siosocks.sockopts.SocketOptions` applied before connect
+        """
+        infos = await self.resolve(host, port)
+        return await _connect_tcp_stream(infos, host, port, happy_eyeballs_delay, source_addresses, socket_options)
+
+
+async def _connect_tcp_stream(infos, host, port, happy_eyeballs_delay, source_addresses, socket_options):
+    delay = math.inf if happy_eyeballs_delay is None else happy_eyeballs_delay
+    winner = None
+    exceptions = []
+
+    def close(sock):
+        if source_addresses is None:
+            sock.close()
+        else:
+            source_addresses.close(sock)
+
+    async def attempt(family, kind, proto, _, address, failed):
+        nonlocal winner
+        if source_addresses is None and socket_options is None:
+            sock = trio.socket.socket(family, kind, proto)
+        else:
+            # trio socket bind is async, options are set and pool binds on stdlib socket before connect
+            sock = socket.socket(family, kind, proto)
+            try:
+                if socket_options is not None:
+                    socket_options.apply_outgoing(sock)
+                if source_addresses is not None:
+                    source_addresses.bind(sock)
+            except OSError as exc:
+                sock.close()
+                exceptions.append(exc)
+                failed.set()
+                return
+            sock = trio.socket.from_stdlib_socket(sock)
+        try:
+            await sock.connect(address)
+        except OSError as exc:
+            close(sock)
+            exceptions.append(exc)
+            failed.set()
+            return
+        except BaseException:
+            close(sock)
+            raise
+        if winner is None:
+            winner = sock
+            nursery.cancel_scope.cancel()
+        else:
+            close(sock)
+
+    async with trio.open_nursery() as nursery:
+        for info in interleave(infos):
+            failed = trio.Event()
+            nursery.start_soon(attempt, *info, failed)
+            with trio.move_on_after(delay):
+                await failed.wait()
+    if winner is not None:
+        stream = trio.SocketStream(winner)
+        if socket_options is not None and socket_options.nodelay is not None:
+            # `trio.SocketStream` enables `TCP_NODELAY`
+            stream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, socket_options.nodelay)
+        return stream
+    if len(exceptions) == 1:
+        raise exceptions[0]
+    raise OSError(f"all attempts to connect to {host}:{port} failed: {', '.join(map(str, exceptions))}")
+
+
+async def _open_tuned_tcp_stream(host, port, *, happy_eyeballs_delay=None, source_addresses=None, socket_options=None):
+    # `trio.open_tcp_stream` takes one `local_address` for all attempts and gives connected socket, pool binds each
+    # attempt by its family and options are set before connect
+    infos = await trio.socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    return await _connect_tcp_stream(infos, host, port, happy_eyeballs_delay, source_addresses, socket_options)
 
 
 class ServerIO(AbstractSocksIO):
-    def __init__(self, stream):
+    def __init__(
+        self,
+        stream,
+        *,
+        metrics=None,
+        resolver=None,
+        happy_eyeballs_delay=DEFAULT_HAPPY_EYEBALLS_DELAY,
+        handshake=None,
+        connect_timeout=None,
+        idle_timeout=None,
+        limits=None,
+        block_size=DEFAULT_BLOCK_SIZE,
+        max_block_size=None,
+        socket_options=None,
+        source_addresses=None,
+    ):
         self.incoming_stream = stream
         self.outgoing_stream = None
+        self.metrics = metrics
+        self.resolver = resolver
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+        # optional `trio.CancelScope` around handshake, its deadline is dropped when passthrough starts
+        self.handshake = handshake
+        self.connect_timeout = math.inf if connect_timeout is None else connect_timeout
+        self.idle_timeout = idle_timeout
+        # optional `siosocks.limits.ConnectionLimits`
+        self.limits = limits
+        # passthrough read size, adaptive if `max_block_size` is set
+        self.block_size = block_size
+        self.max_block_size = max_block_size
+        # optional `siosocks.sockopts.SocketOptions` of both sockets, outgoing one is tuned before connect
+        self.socket_options = socket_options
+        if socket_options is not None:
+            socket_options.apply(stream.socket)
+        # optional `siosocks.sources.SourceAddresses` and address of outgoing socket
+        self.source_addresses = source_addresses
+        self.source_address = None
+        self.last_activity = None
+        # bytes moved up (client to destination) and down
+        self.transferred = [0, 0]
 
     async def read(self):
-        return await self.incoming_stream.receive_some(DEFAULT_BLOCK_SIZE)
+        data = await self.incoming_stream.receive_some(DEFAULT_BLOCK_SIZE)
+        if self.metrics is not None:
+            self.metrics.received(data)
+        return data
 
     async def write(self, data):
         await self.incoming_stream.send_all(data)
 
     async def connect(self, host, port):
         logger.debug("connect call %s:%d", host, port)
-        self.outgoing_stream = await trio.open_tcp_stream(host, port)
+        tuning = dict(source_addresses=self.source_addresses, socket_options=self.socket_options)
+        if self.resolver is not None:
+            open_tcp_stream = functools.partial(self.resolver.open_tcp_stream, **tuning)
+        elif self.source_addresses is not None or self.socket_options is not None:
+            open_tcp_stream = functools.partial(_open_tuned_tcp_stream, **tuning)
+        else:
+            open_tcp_stream = trio.open_tcp_stream
+        # `None` is trio default delay, infinite one tries addresses one by one
+        delay = math.inf if self.happy_eyeballs_delay is None else self.happy_eyeballs_delay
+        open_tcp_stream = functools.partial(open_tcp_stream, happy_eyeballs_delay=delay)
+        if self.metrics is None:
+            self.outgoing_stream = await self._open_tcp_stream(open_tcp_stream, host, port)
+            return
+        self.metrics.connect(host, port)
+        try:
+            self.outgoing_stream = await self._open_tcp_stream(open_tcp_stream, host, port)
+        except Exception as exc:
+            self.metrics.connected(exc)
+            raise
+        self.metrics.connected()
+
+    async def _open_tcp_stream(self, open_tcp_stream, host, port):
+        if self.limits is not None:
+            self.limits.connect()
+        try:
+            with trio.fail_after(self.connect_timeout):
+                stream = await open_tcp_stream(host, port)
+            if self.source_addresses is not None:
+                self.source_address = self.source_addresses.address_of(stream.socket)
+            return stream
+        finally:
+            if self.limits is not None:
+                self.limits.connected()
 
-    async def passthrough(self):
+    async def passthrough(self, data=b""):
         logger.debug("passthrough started")
+        if self.handshake is not None:
+            self.handshake.deadline = math.inf
+        if self.metrics is not None:
+            self.metrics.passthrough()
+        self.last_activity = trio.current_time()
         async with trio.open_nursery() as n:
-            n.start_soon(self._sink, self.incoming_stream, self.outgoing_stream)
-            n.start_soon(self._sink, self.outgoing_stream, self.incoming_stream)
+            n.start_soon(self._sink, self.incoming_stream, self.outgoing_stream, 0, data)
+            n.start_soon(self._sink, self.outgoing_stream, self.incoming_stream, 1)
+            if self.idle_timeout is not None:
+                n.start_soon(self._watchdog, n.cancel_scope)
+        return tuple(self.transferred)
 
-    @staticmethod
-    async def _sink(r, w):
+    async def _sink(self, r, w, index, data=b""):
+        size = len(data)
+        watched = self.idle_timeout is not None
+        metrics = self.metrics
+        direction = DIRECTIONS[index]
+        block = BlockSize(self.block_size, self.max_block_size)
+        try:
+            # pipelined client data goes first
+            if data:
+                if metrics is not None:
+                    metrics.transferred(direction, size)
+                await w.send_all(data)
+            while True:
+                b = await r.receive_some(block.size)
+                if not b:
+                    break
+                block.update(len(b))
+                size += len(b)
+                if metrics is not None:
+                    metrics.transferred(direction, len(b))
+                if watched:
+                    self.last_activity = trio.current_time()
+                await w.send_all(b)
+        finally:
+            self.transferred[index] = size
+
+    async def _watchdog(self, cancel_scope):
+        # ends passthrough when no data was moved in any direction for idle timeout
         while True:
-            b = await r.receive_some(DEFAULT_BLOCK_SIZE)
-            if not b:
-                break
-            await w.send_all(b)
+            deadline = self.last_activity + self.idle_timeout
+            if deadline <= trio.current_time():
+                logger.debug("passthrough idle timeout")
+                cancel_scope.cancel()
+                return
+            await trio.sleep_until(deadline)
 
     async def __aenter__(self):
         return self
 
     async def __aexit__(self, *exc_info):
-        if self.outgoing_stream is not None:
-            await self.outgoing_stream.aclose()
+        try:
+            if self.outgoing_stream is not None:
+                await self.outgoing_stream.aclose()
+        finally:
+            if self.source_addresses is not None:
+                self.source_addresses.release(self.source_address)
 
 
-async def socks_server_handler(stream, **kwargs):
+async def socks_server_handler(
+    stream,
+    *,
+    metrics=None,
+    hooks_factory=None,
+    resolver=None,
+    happy_eyeballs_delay=DEFAULT_HAPPY_EYEBALLS_DELAY,
+    handshake_timeout=None,
+    connect_timeout=None,
+    idle_timeout=None,
+    limits=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+    max_block_size=None,
+    socket_options=None,
+    source_addresses=None,
+    **kwargs,
+):
+    """
+    `trio.serve_tcp` handler, `metrics` is optional `siosocks.metrics.ServerMetrics`, `hooks_factory` is optional
+    callable, which returns `siosocks.interface.EngineHooks` for each connection, `resolver` is optional shared
+    `Resolver` for outgoing connections, `happy_eyeballs_delay` is RFC 8305 connection attempt delay for outgoing
+    connections (`None` tries resolved addresses one by one)
+
+    Timeouts are seconds or `None`: `handshake_timeout` from accept to passthrough start, `connect_timeout` for
+    outgoing connection, `idle_timeout` for tunnel without data in both directions
+
+    `limits` is optional `siosocks.limits.ServerLimits`, rejected connection gets socks failure reply to its request
+
+    `block_size` is passthrough read size, with `max_block_size` it is adaptive (see `siosocks.buffers.BlockSize`)
+
+    `socket_options` is optional `siosocks.sockopts.SocketOptions` for incoming and outgoing sockets,
+    `source_addresses` is optional `siosocks.sources.SourceAddresses` for outgoing connections
+    """
+    rejection = connection_limits = None
+    if limits is not None:
+        try:
+            connection_limits, rejection = limits.admit(stream.socket.getpeername()[0])
+        except SocksLimitException as exc:
+            logger.debug("connection dropped: %s", exc)
+            await stream.aclose()
+            return
+    if rejection is not None:
+        # client gets failure reply to its request in short time
+        logger.debug("connection rejected: %s", rejection)
+        handshake_timeout = limits.handshake_timeout(handshake_timeout)
+    connection_metrics = None if metrics is None else metrics.connection()
+    hooks = None if hooks_factory is None else hooks_factory()
+    handshake = trio.move_on_after(math.inf if handshake_timeout is None else handshake_timeout)
     try:
-        async with stream, ServerIO(stream) as io:
-            await async_engine(SocksServer(**kwargs), io)
-    except Exception:
-        logger.exception("handler failed")
+        io = ServerIO(
+            stream,
+            metrics=connection_metrics,
+            resolver=resolver,
+            happy_eyeballs_delay=happy_eyeballs_delay,
+            handshake=handshake,
+            connect_timeout=connect_timeout,
+            idle_timeout=idle_timeout,
+            limits=connection_limits,
+            block_size=block_size,
+            max_block_size=max_block_size,
+            socket_options=socket_options,
+            source_addresses=source_addresses,
+        )
+        async with stream, io:
+            with handshake:
+                await async_engine(SocksServer(rejection=rejection, **kwargs), io, hooks=hooks)
+            if handshake.cancelled_caught:
+                logger.debug("handshake timeout")
+    except Exception as exc:
+        log_failure(logger, exc)
+        if connection_metrics is not None:
+            connection_metrics.failed(exc)
+    finally:
+        if connection_metrics is not None:
+            connection_metrics.close()
+        if connection_limits is not None:
+            connection_limits.close()
+
+
+class _PrefixedStream(trio.abc.HalfCloseableStream):
+    """
+    Stream, which returns `prefix` before data of wrapped stream
+    """
+
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    async def receive_some(self, max_bytes=None):
+        if not self.prefix:
+            return await self.stream.receive_some(max_bytes)
+        await trio.lowlevel.checkpoint()
+        if max_bytes is None:
+            max_bytes = len(self.prefix)
+        data, self.prefix = self.prefix[:max_bytes], self.prefix[max_bytes:]
+        return data
+
+    async def send_all(self, data):
+        await self.stream.send_all(data)
+
+    async def wait_send_all_might_not_block(self):
+        await self.stream.wait_send_all_might_not_block()
+
+    async def send_eof(self):
+        await self.stream.send_eof()
+
+    async def aclose(self):
+        await self.stream.aclose()
 
 
 class ClientIO(AbstractSocksIO):
     def __init__(self, stream):
         self.stream = stream
+        self.received = 0
+        # destination data received along with socks reply
+        self.leftover = b""
 
     async def read(self):
         data = await self.stream.receive_some(DEFAULT_BLOCK_SIZE)
+        self.received += len(data)
         return data
 
     async def write(self, data):
@@ -69,8 +427,8 @@ class ClientIO(AbstractSocksIO):
     async def connect(self, *_):
         raise RuntimeError("ClientIO.connect should not be called")
 
-    async def passthrough(self):
-        return
+    async def passthrough(self, data=b""):
+        self.leftover = data
 
 
 async def open_tcp_stream(
@@ -85,8 +443,14 @@ async def open_tcp_stream(
     encoding=DEFAULT_ENCODING,
     socks4_extras={},
     socks5_extras={},
+    optimistic=False,
+    early_data=b"",
     **open_tcp_stream_extras,
 ):
+    """
+    `optimistic` and `early_data` are `siosocks.protocol.SocksClient` arguments, without socks `early_data` is
+    written right after connect
+    """
     socks_required = socks_host, socks_port, socks_version
     socks_enabled = all(socks_required)
     socks_disabled = not any(socks_required)
@@ -106,9 +470,168 @@ async def open_tcp_stream(
             encoding=encoding,
             socks4_extras=socks4_extras,
             socks5_extras=socks5_extras,
+            optimistic=optimistic,
+            early_data=early_data,
         )
         io = ClientIO(stream)
         await async_engine(protocol, io)
+        if io.leftover:
+            stream = _PrefixedStream(stream, io.leftover)
     else:
         stream = await trio.open_tcp_stream(host, port, **open_tcp_stream_extras)
+        if early_data:
+            await stream.send_all(early_data)
     return stream
+
+
+class ClientPool:
+    """
+    Pool of connections to socks server with socks5 greeting and auth already done (plain tcp connections for
+    socks4), so new tunnel costs only connect request round trip, use as `async with ClientPool(...) as pool`
+
+    Pool keeps `size` idle connections, idle connection is replaced when server closes it or after `ttl` seconds
+    (keep it below server handshake timeout), failed connection attempt is repeated after `retry_delay` seconds.
+    `open_tcp_stream_extras` are passed to `trio.open_tcp_stream`, `optimistic` applies to
+    connections opened when there is no idle one
+    """
+
+    def __init__(
+        self,
+        socks_host,
+        socks_port,
+        socks_version,
+        *,
+        username=None,
+        password=None,
+        encoding=DEFAULT_ENCODING,
+        size=DEFAULT_POOL_SIZE,
+        ttl=DEFAULT_POOL_TTL,
+        retry_delay=DEFAULT_POOL_RETRY_DELAY,
+        optimistic=False,
+        **open_tcp_stream_extras,
+    ):
+        if socks_version == 4 and username is not None:
+            raise SocksException("Socks4 do not provide auth methods, but auth provided")
+        self.socks_host = socks_host
+        self.socks_port = socks_port
+        self.socks_version = socks_version
+        self.size = size
+        self.ttl = math.inf if ttl is None else ttl
+        self.retry_delay = retry_delay
+        self.optimistic = optimistic
+        self._client_kw = dict(username=username, password=password, encoding=encoding)
+        self._open_tcp_stream_extras = open_tcp_stream_extras
+        # stream -> (cancel scope of idle wait, released event), insertion ordered, newest is taken first
+        self._idle = {}
+        self._starting = 0
+        self._nursery_manager = None
+        self._nursery = None
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    async def __aenter__(self):
+        self._nursery_manager = trio.open_nursery()
+        self._nursery = await self._nursery_manager.__aenter__()
+        self._fill()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        nursery, self._nursery = self._nursery, None
+        nursery.cancel_scope.cancel()
+        return await self._nursery_manager.__aexit__(*exc_info)
+
+    def _fill(self):
+        while self._nursery is not None and len(self._idle) + self._starting < self.size:
+            self._starting += 1
+            self._nursery.start_soon(self._keep)
+
+    async def _greet(self):
+        stream = await trio.open_tcp_stream(self.socks_host, self.socks_port, **self._open_tcp_stream_extras)
+        try:
+            await async_engine(SocksClientGreeting(self.socks_version, **self._client_kw), ClientIO(stream))
+        except BaseException:
+            await trio.aclose_forcefully(stream)
+            raise
+        return stream
+
+    async def _keep(self):
+        """
+        Establish connection and hold it until it is taken, expired or closed by server
+        """
+        try:
+            stream = await self._greet()
+        except Exception as exc:
+            logger.debug("pool connection failed: %r", exc)
+            await trio.sleep(self.retry_delay)
+            self._starting -= 1
+            self._fill()
+            return
+        self._starting -= 1
+        released = trio.Event()
+        try:
+            with trio.move_on_after(self.ttl) as scope:
+                self._idle[stream] = scope, released
+                # server sends nothing before connect request, so this is end of file or protocol violation
+                await stream.receive_some(1)
+        finally:
+            # connection is not taken
+            if self._idle.pop(stream, None) is not None:
+                await trio.aclose_forcefully(stream)
+                self._fill()
+            released.set()
+
+    async def _take(self):
+        while self._idle:
+            stream, (scope, released) = self._idle.popitem()
+            scope.cancel()
+            await released.wait()
+            if scope.cancelled_caught:
+                return stream
+            await trio.aclose_forcefully(stream)
+        return None
+
+    async def open_tcp_stream(self, host, port, *, socks4_extras={}, socks5_extras={}, early_data=b""):
+        """
+        Same as `open_tcp_stream` through pool socks server, opens new connection if there is no idle one
+        """
+        stream = await self._take()
+        self._fill()
+        if stream is not None:
+            io = ClientIO(stream)
+            protocol = SocksClient(
+                host,
+                port,
+                self.socks_version,
+                socks4_extras=socks4_extras,
+                socks5_extras=socks5_extras,
+                greeting=False,
+                early_data=early_data,
+                **self._client_kw,
+            )
+            try:
+                await async_engine(protocol, io)
+            except Exception as exc:
+                await trio.aclose_forcefully(stream)
+                if io.received:
+                    raise
+                # server closed idle connection right before request
+                logger.debug("pool connection is stale: %r", exc)
+            else:
+                if io.leftover:
+                    stream = _PrefixedStream(stream, io.leftover)
+                return stream
+        return await open_tcp_stream(
+            host,
+            port,
+            socks_host=self.socks_host,
+            socks_port=self.socks_port,
+            socks_version=self.socks_version,
+            socks4_extras=socks4_extras,
+            socks5_extras=socks5_extras,
+            optimistic=self.optimistic,
+            early_data=early_data,
+            **self._client_kw,
+            **self._open_tcp_stream_extras,
+        )
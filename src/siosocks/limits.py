@@ -0,0 +1,166 @@
+import threading
+
+from .exceptions import SocksLimitException
+
+# rejected connections served at once
+DEFAULT_MAX_REJECTING = 64
+# seconds
+DEFAULT_REJECTION_TIMEOUT = 2
+
+
+class ServerLimits:
+    """
+    Concurrency limits, one instance shared by all connections of server, `None` is no limit
+
+    `max_connections` and `max_connections_per_ip` are checked on accept, rejected connection takes no slots and gets
+    socks failure reply to its request. `max_connecting` is number of outgoing connections in progress, rejected
+    connect gets socks failure reply
+
+    Rejected connections are bounded separately: at most `max_rejecting` of them are served at once, each one for at
+    most `rejection_timeout` seconds, connections over `max_rejecting` are closed without reply
+    """
+
+    def __init__(
+        self,
+        *,
+        max_connections=None,
+        max_connections_per_ip=None,
+        max_connecting=None,
+        max_rejecting=DEFAULT_MAX_REJECTING,
+        rejection_timeout=DEFAULT_REJECTION_TIMEOUT,
+    ):
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.max_connecting = max_connecting
+        self.max_rejecting = max_rejecting
+        self.rejection_timeout = rejection_timeout
+        self.connections = 0
+        self.connecting = 0
+        self.rejecting = 0
+        self._per_ip = {}
+        # socketserver backend takes slots from many threads
+        self._lock = threading.Lock()
+
+    def full(self):
+        """
+        `True` if `max_connections` is reached, no connection will be accepted until some of them are closed
+        """
+        return self.max_connections is not None and self.connections >= self.max_connections
+
+    def connection(self, host):
+        """
+        Take connection slot for client `host`, backends call it on accept, raises `SocksLimitException`
+        """
+        return ConnectionLimits(self, host)
+
+    def admit(self, host):
+        """
+        Take slots for accepted client `host`, returns `(limits, rejection)`: `ConnectionLimits` and `None`, or
+        `RejectedConnection` and `SocksLimitException` to reply with. Raises `SocksLimitException` when
+        `max_rejecting` is reached, such connection is closed without reply
+        """
+        try:
+            return ConnectionLimits(self, host), None
+        except SocksLimitException as exc:
+            return RejectedConnection(self, exc), exc
+
+    def handshake_timeout(self, timeout):
+        """
+        Handshake timeout of rejected connection, `rejection_timeout` unless `timeout` is shorter
+        """
+        if timeout is None:
+            return self.rejection_timeout
+        return min(timeout, self.rejection_timeout)
+
+    def _acquire(self, host):
+        with self._lock:
+            if self.full():
+                raise SocksLimitException(f"Connections limit {self.max_connections} reached")
+            count = self._per_ip.get(host, 0)
+            if self.max_connections_per_ip is not None and count >= self.max_connections_per_ip:
+                raise SocksLimitException(f"Connections limit {self.max_connections_per_ip} reached for {host}")
+            self._per_ip[host] = count + 1
+            self.connections += 1
+
+    def _release(self, host):
+        with self._lock:
+            self.connections -= 1
+            count = self._per_ip.pop(host) - 1
+            if count:
+                self._per_ip[host] = count
+
+    def _acquire_connect(self):
+        with self._lock:
+            if self.max_connecting is not None and self.connecting >= self.max_connecting:
+                raise SocksLimitException(f"Outgoing connections limit {self.max_connecting} reached")
+            self.connecting += 1
+
+    def _release_connect(self):
+        with self._lock:
+            self.connecting -= 1
+
+    def _acquire_rejecting(self):
+        with self._lock:
+            if self.rejecting >= self.max_rejecting:
+                raise SocksLimitException(f"Rejected connections limit {self.max_rejecting} reached")
+            self.rejecting += 1
+
+    def _release_rejecting(self):
+        with self._lock:
+            self.rejecting -= 1
+
+
+class ConnectionLimits:
+    """
+    Single connection slots, `close` releases everything taken, safe to call more than once
+    """
+
+    def __init__(self, server, host):
+        server._acquire(host)
+        self.server = server
+        self.host = host
+        self.is_connecting = False
+        self.closed = False
+
+    def connect(self):
+        """
+        Take outgoing connection slot, raises `SocksLimitException`
+        """
+        self.server._acquire_connect()
+        self.is_connecting = True
+
+    def connected(self):
+        if self.is_connecting:
+            self.is_connecting = False
+            self.server._release_connect()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.connected()
+        self.server._release(self.host)
+
+
+class RejectedConnection:
+    """
+    Rejected connection slot, same interface as `ConnectionLimits`, `connect` raises `rejection`
+    """
+
+    def __init__(self, server, rejection):
+        server._acquire_rejecting()
+        self.server = server
+        self.rejection = rejection
+        self.closed = False
+
+    def connect(self):
+        raise self.rejection
+
+    def connected(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.server._release_rejecting()
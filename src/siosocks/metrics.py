@@ -0,0 +1,324 @@
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .exceptions import SocksAuthException
+
+logger = logging.getLogger(__name__)
+
+# seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DEFAULT_MAX_DESTINATIONS = 1000
+# passthrough bytes of connection are added to server counter when this many bytes or seconds passed
+TRANSFERRED_BATCH_SIZE = 2**20
+TRANSFERRED_BATCH_INTERVAL = 1
+OTHER_DESTINATION = "other"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if labels.keys() != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        """
+        Yields (name suffix, labels pairs, value)
+        """
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            samples = list(self._samples())
+        for suffix, labels, value in samples:
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        if not self.labelnames and not self._values:
+            yield "", (), 0
+        for key, value in self._values.items():
+            yield "", tuple(zip(self.labelnames, key)), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), *, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per bucket counts (last one is +Inf), sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0]
+            state[0][index] += 1
+            state[1] += value
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return 0 if state is None else sum(state[0])
+
+    def _samples(self):
+        for key, (counts, total) in self._values.items():
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", labels + (("le", _format_value(bound)),), cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, cumulative
+
+
+class Collected(_Metric):
+    """
+    Metric, which values are read from `collect` callable at render time, for state counted elsewhere, `collect`
+    returns {label values tuple: value}
+    """
+
+    def __init__(self, name, documentation, labelnames=(), *, kind, collect):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self.collect = collect
+
+    def _samples(self):
+        for key, value in self.collect().items():
+            yield "", tuple(zip(self.labelnames, key)), value
+
+
+class ServerMetrics:
+    """
+    Socks server counters and histograms, one instance shared by all connections of server
+
+    Destination labels are limited by `max_destinations`, rest of destinations are counted as "other"
+    """
+
+    def __init__(self, *, buckets=DEFAULT_BUCKETS, max_destinations=DEFAULT_MAX_DESTINATIONS):
+        self.accepted = Counter("siosocks_accepted_connections_total", "Accepted incoming connections")
+        self.handshake_seconds = Histogram(
+            "siosocks_handshake_seconds",
+            "Time from accept to passthrough start",
+            ["version"],
+            buckets=buckets,
+        )
+        self.auth_failures = Counter("siosocks_auth_failures_total", "Failed socks5 authentications")
+        self.connect_seconds = Histogram(
+            "siosocks_connect_seconds",
+            "Outgoing connection latency",
+            ["destination"],
+            buckets=buckets,
+        )
+        self.connect_failures = Counter(
+            "siosocks_connect_failures_total",
+            "Failed outgoing connections",
+            ["destination"],
+        )
+        self.active_tunnels = Gauge("siosocks_active_tunnels", "Tunnels in passthrough state")
+        self.transferred = Counter(
+            "siosocks_bytes_total",
+            "Passthrough bytes, up is client to destination, accounted in batches while tunnel is running",
+            ["direction"],
+        )
+        self.max_destinations = max_destinations
+        self._destinations = set()
+        self._collected = []
+
+    @property
+    def metrics(self):
+        return (
+            self.accepted,
+            self.handshake_seconds,
+            self.auth_failures,
+            self.connect_seconds,
+            self.connect_failures,
+            self.active_tunnels,
+            self.transferred,
+            *self._collected,
+        )
+
+    def track_buffer_pool(self, pool):
+        """
+        Report `siosocks.buffers.BufferPool` requests and idle buffers, pool counters are read at render time
+        """
+        self._collected += [
+            Collected(
+                "siosocks_buffer_pool_requests_total",
+                "Passthrough buffer requests, hit is served from pool, miss allocates new buffer",
+                ["result"],
+                kind="counter",
+                collect=lambda: {("hit",): pool.hits, ("miss",): pool.misses},
+            ),
+            Collected(
+                "siosocks_buffer_pool_idle_buffers",
+                "Buffers kept in pool",
+                kind="gauge",
+                collect=lambda: {(): len(pool)},
+            ),
+        ]
+
+    def destination(self, host, port):
+        destination = f"{host}:{port}"
+        if destination in self._destinations:
+            return destination
+        if len(self._destinations) >= self.max_destinations:
+            return OTHER_DESTINATION
+        self._destinations.add(destination)
+        return destination
+
+    def connection(self):
+        """
+        Create per connection tracker, backends call it on accept
+        """
+        return ConnectionMetrics(self)
+
+    def render(self):
+        """
+        Prometheus text exposition format
+        """
+        return "\n".join(m.render() for m in self.metrics) + "\n"
+
+
+class ConnectionMetrics:
+    """
+    Single connection events, backends call them from handshake and passthrough steps, `transferred` is called per
+    passthrough read and batched, so shared counter is not locked per data chunk
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.version = None
+        self.destination = None
+        self.tunnel = False
+        self.closed = False
+        self._started = self._connect_started = self._flushed = time.perf_counter()
+        self._transferred = dict(up=0, down=0)
+        server.accepted.inc()
+
+    def received(self, data):
+        # first byte of socks request is version
+        if self.version is None and data:
+            self.version = data[0]
+
+    def connect(self, host, port):
+        self.destination = self.server.destination(host, port)
+        self._connect_started = time.perf_counter()
+
+    def connected(self, exc=None):
+        if exc is None:
+            elapsed = time.perf_counter() - self._connect_started
+            self.server.connect_seconds.observe(elapsed, destination=self.destination)
+        else:
+            self.server.connect_failures.inc(destination=self.destination)
+
+    def passthrough(self):
+        elapsed = time.perf_counter() - self._started
+        self.server.handshake_seconds.observe(elapsed, version=self.version)
+        self.server.active_tunnels.inc()
+        self.tunnel = True
+
+    def transferred(self, direction, size):
+        pending = self._transferred[direction] = self._transferred[direction] + size
+        if pending >= TRANSFERRED_BATCH_SIZE or time.perf_counter() - self._flushed >= TRANSFERRED_BATCH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """
+        Add passthrough bytes counted since last flush to server counter
+        """
+        self._flushed = time.perf_counter()
+        for direction, size in self._transferred.items():
+            if size:
+                self.server.transferred.inc(size, direction=direction)
+                self._transferred[direction] = 0
+
+    def failed(self, exc):
+        if isinstance(exc, SocksAuthException):
+            self.server.auth_failures.inc()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        if self.tunnel:
+            self.server.active_tunnels.dec()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def start_http_server(metrics, port, host=""):
+    """
+    Serve `metrics` on http://host:port/metrics from daemon thread, returns `ThreadingHTTPServer`
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, name="siosocks-metrics", daemon=True).start()
+    return server
@@ -3,7 +3,7 @@ import contextlib
 import enum
 from ipaddress import IPv4Address, IPv6Address
 
-from .exceptions import SocksException
+from .exceptions import SocksAuthException, SocksException, SocksLimitException
 from .sansio import SansIORW
 
 DEFAULT_ENCODING = "utf-8"
@@ -61,7 +61,7 @@ class Socks4Server(BaseSocks4):
     def write_response(self, code):
         yield from self.io.write_struct(self.fmt, 0, code, 0, self.this_network.packed)
 
-    def run(self):
+    def run(self, rejection=None):
         version, command, port, ipv4 = yield from self.io.read_struct(self.fmt)
         self.verify_version(version)
         user_id = yield from self.io.read_c_string()  # noqa
@@ -72,8 +72,14 @@ class Socks4Server(BaseSocks4):
             host = yield from self.io.read_c_string()
         else:
             host = ipv4.compressed
+        if rejection is not None:
+            yield from self.write_response(Socks4Code.fail)
+            raise rejection
         try:
             yield from self.io.connect(host, port)
+        except SocksLimitException:
+            yield from self.write_response(Socks4Code.fail)
+            raise
         except Exception as exc:
             yield from self.write_response(Socks4Code.fail)
             raise SocksException from exc
@@ -88,12 +94,13 @@ class Socks4Client(BaseSocks4):
             return IPv4Address(host)
         return self.domain_flag_value_high
 
-    def run(self, host, port, user_id=""):
+    def run(self, host, port, user_id="", early_data=b""):
         ipv4 = self.resolve_host(host)
         yield from self.io.write_struct(self.fmt, self.version, SocksCommand.tcp_connect, port, ipv4.packed)
         yield from self.io.write_c_string(user_id)
         if self.domain_flag_value_low <= ipv4 <= self.domain_flag_value_high:
             yield from self.io.write_c_string(host)
+        yield from self.io.write(early_data)
         _, code, *_ = yield from self.io.read_struct(self.fmt)
         if code != Socks4Code.success:
             raise SocksException(f"Code {_hex(code)} not equal to 'success' code {_hex(Socks4Code.success)}")
@@ -179,7 +186,7 @@ class Socks5Server(BaseSocks5):
             auth_method = Socks5AuthMethod.no_acceptable
         yield from self.io.write_struct("BB", self.version, auth_method)
         if auth_method == Socks5AuthMethod.no_acceptable:
-            raise SocksException("No acceptible auth method")
+            raise SocksAuthException("No acceptible auth method")
         if auth_method == Socks5AuthMethod.username_password:
             auth_version = yield from self.io.read_struct("B")
             if auth_version != 1:
@@ -190,9 +197,9 @@ class Socks5Server(BaseSocks5):
             auth_return_code = 0 if auth_successful else 1
             yield from self.io.write_struct("BB", auth_version, auth_return_code)
             if not auth_successful:
-                raise SocksException("Wrong username or password")
+                raise SocksAuthException("Wrong username or password")
 
-    def run(self, username=None, password=None):
+    def run(self, username=None, password=None, rejection=None):
         version = yield from self.io.read_struct("B")
         self.verify_version(version)
         yield from self.auth(username, password)
@@ -200,8 +207,15 @@ class Socks5Server(BaseSocks5):
         if command != SocksCommand.tcp_connect:
             yield from self.write_command(Socks5Code.command_not_supported_or_protocol_error)
             raise SocksException(f"Socks command {_hex(command)} is not supported")
+        if rejection is not None:
+            yield from self.write_command(Socks5Code.connection_not_allowed_by_ruleset)
+            raise rejection
         try:
             yield from self.io.connect(host, port)
+        except SocksLimitException:
+            # same reply as rejected connection
+            yield from self.write_command(Socks5Code.connection_not_allowed_by_ruleset)
+            raise
         except Exception as exc:
             yield from self.write_command(Socks5Code.general_failure)
             raise SocksException from exc
@@ -211,31 +225,58 @@ class Socks5Server(BaseSocks5):
 
 
 class Socks5Client(BaseSocks5):
-    def auth(self, username, password):
-        auth_required = username is not None
-        if auth_required:
-            auth_method = Socks5AuthMethod.username_password
-        else:
-            auth_method = Socks5AuthMethod.no_auth
-        yield from self.io.write_struct("BB", 1, auth_method)
+    @staticmethod
+    def auth_method(username):
+        if username is None:
+            return Socks5AuthMethod.no_auth
+        return Socks5AuthMethod.username_password
+
+    def read_auth_method(self, auth_method):
         version, code = yield from self.io.read_struct("BB")
         self.verify_version(version)
         if code != auth_method:
             raise SocksException(f"Auth method {_hex(auth_method)} not accepted with {_hex(code)} code")
+
+    def write_credentials(self, username, password):
+        yield from self.io.write_struct("B", 1)
+        yield from self.io.write_pascal_string(username)
+        yield from self.io.write_pascal_string(password)
+
+    def read_credentials_status(self):
+        auth_version, code = yield from self.io.read_struct("BB")
+        if auth_version != 1:
+            raise SocksException(f"Username/password auth version {_hex(auth_version)} not supported")
+        if code != 0:
+            raise SocksException(f"Username/password auth failed with code {_hex(code)}")
+
+    def auth(self, username, password):
+        auth_method = self.auth_method(username)
+        yield from self.io.write_struct("BB", 1, auth_method)
+        yield from self.read_auth_method(auth_method)
         if auth_method == Socks5AuthMethod.username_password:
-            yield from self.io.write_struct("B", 1)
-            yield from self.io.write_pascal_string(username)
-            yield from self.io.write_pascal_string(password)
-            auth_version, code = yield from self.io.read_struct("BB")
-            if auth_version != 1:
-                raise SocksException(f"Username/password auth version {_hex(auth_version)} not supported")
-            if code != 0:
-                raise SocksException(f"Username/password auth failed with code {_hex(code)}")
+            yield from self.write_credentials(username, password)
+            yield from self.read_credentials_status()
 
-    def run(self, host, port, username=None, password=None):
+    def greet(self, username, password):
         yield from self.io.write_struct("B", self.version)
         yield from self.auth(username, password)
+
+    def run(self, host, port, username=None, password=None, greeting=True, optimistic=False, early_data=b""):
+        # optimistic mode sends greeting, credentials and connect request in one flight, then checks replies in order
+        optimistic = optimistic and greeting
+        auth_method = self.auth_method(username)
+        if optimistic:
+            yield from self.io.write_struct("BBB", self.version, 1, auth_method)
+            if auth_method == Socks5AuthMethod.username_password:
+                yield from self.write_credentials(username, password)
+        elif greeting:
+            yield from self.greet(username, password)
         yield from self.write_command(SocksCommand.tcp_connect, host, port)
+        yield from self.io.write(early_data)
+        if optimistic:
+            yield from self.read_auth_method(auth_method)
+            if auth_method == Socks5AuthMethod.username_password:
+                yield from self.read_credentials_status()
         code, *_ = yield from self.read_command()
         if code != Socks5Code.request_granted:
             raise SocksException(f"Code {_hex(code)} not equal to 'success' code {_hex(Socks5Code.request_granted)}")
@@ -243,8 +284,18 @@ class Socks5Client(BaseSocks5):
 
 
 def SocksServer(
-    *, allowed_versions={4, 5}, username=None, password=None, strict_security_policy=True, encoding=DEFAULT_ENCODING
+    *,
+    allowed_versions={4, 5},
+    username=None,
+    password=None,
+    strict_security_policy=True,
+    encoding=DEFAULT_ENCODING,
+    rejection=None,
 ):
+    """
+    Server side of handshake, `rejection` is exception of connection rejected by server (e.g. `SocksLimitException`),
+    such client gets failure reply to its request instead of connect and `rejection` is raised
+    """
     auth_required = username is not None
     if 4 in allowed_versions and auth_required and strict_security_policy:
         raise SocksException(
@@ -253,27 +304,81 @@ def SocksServer(
             "strict security policy enabled",
         )
     io = SansIORW(encoding)
-    version = yield from io.read_struct("B", put_back=True)
-    if version not in allowed_versions:
-        raise SocksException(f"Version {version} is not in allowed {allowed_versions}")
-    if version == 4:
-        yield from Socks4Server(io).run()
-    elif version == 5:
-        yield from Socks5Server(io).run(username, password)
-    else:
-        raise SocksException(f"Version {version} is not supported")
+    try:
+        version = yield from io.read_struct("B", put_back=True)
+        if version not in allowed_versions:
+            raise SocksException(f"Version {version} is not in allowed {allowed_versions}")
+        if version == 4:
+            yield from Socks4Server(io).run(rejection)
+        elif version == 5:
+            yield from Socks5Server(io).run(username, password, rejection)
+        else:
+            raise SocksException(f"Version {version} is not supported")
+    except Exception:
+        # error responses are buffered, deliver them before failing
+        yield from io.flush()
+        raise
 
 
 def SocksClient(
-    host, port, version, *, username=None, password=None, encoding=DEFAULT_ENCODING, socks4_extras={}, socks5_extras={}
+    host,
+    port,
+    version,
+    *,
+    username=None,
+    password=None,
+    encoding=DEFAULT_ENCODING,
+    socks4_extras={},
+    socks5_extras={},
+    greeting=True,
+    optimistic=False,
+    early_data=b"",
 ):
+    """
+    `greeting=False` skips socks5 greeting and auth, for connection where `SocksClientGreeting` is done already
+
+    `optimistic=True` sends socks5 greeting, auth and connect request in one flight without waiting for replies,
+    use it only with servers known to support chosen auth method. `early_data` is sent right after connect request,
+    before server reply
+    """
+    auth_required = username is not None
+    if version == 4 and auth_required:
+        raise SocksException("Socks4 do not provide auth methods, but auth provided")
+    io = SansIORW(encoding)
+    try:
+        if version == 4:
+            yield from Socks4Client(io).run(host, port, early_data=early_data, **socks4_extras)
+        elif version == 5:
+            yield from Socks5Client(io).run(
+                host,
+                port,
+                username,
+                password,
+                greeting=greeting,
+                optimistic=optimistic,
+                early_data=early_data,
+                **socks5_extras,
+            )
+        else:
+            raise SocksException(f"Version {version} is not supported")
+    except Exception:
+        yield from io.flush()
+        raise
+
+
+def SocksClientGreeting(version, *, username=None, password=None, encoding=DEFAULT_ENCODING):
+    """
+    Client handshake part, which does not depend on destination: socks5 greeting and auth, nothing for socks4
+    """
     auth_required = username is not None
     if version == 4 and auth_required:
         raise SocksException("Socks4 do not provide auth methods, but auth provided")
     io = SansIORW(encoding)
-    if version == 4:
-        yield from Socks4Client(io).run(host, port, **socks4_extras)
-    elif version == 5:
-        yield from Socks5Client(io).run(host, port, username, password, **socks5_extras)
-    else:
-        raise SocksException(f"Version {version} is not supported")
+    try:
+        if version == 5:
+            yield from Socks5Client(io).greet(username, password)
+        elif version != 4:
+            raise SocksException(f"Version {version} is not supported")
+    except Exception:
+        yield from io.flush()
+        raise
@@ -0,0 +1,97 @@
+import collections
+import ipaddress
+import itertools
+import socket
+import time
+
+# seconds
+DEFAULT_TTL = 60
+DEFAULT_NEGATIVE_TTL = 5
+DEFAULT_MAX_SIZE = 1024
+
+
+def is_ip_address(host):
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def with_port(infos, port):
+    """
+    Replace port in `getaddrinfo` results sockaddr
+    """
+    return [
+        (family, kind, proto, name, (address[0], port, *address[2:])) for family, kind, proto, name, address in infos
+    ]
+
+
+def interleave(infos):
+    """
+    Alternate address families of `getaddrinfo` results, starting with first one (RFC 8305 section 4)
+    """
+    families = {}
+    for info in infos:
+        families.setdefault(info[0], []).append(info)
+    return [info for group in itertools.zip_longest(*families.values()) for info in group if info is not None]
+
+
+def numeric_infos(host, port):
+    """
+    `getaddrinfo` for ip address host, never blocks
+    """
+    return socket.getaddrinfo(host, port, type=socket.SOCK_STREAM, flags=socket.AI_NUMERICHOST)
+
+
+class ResolverCache:
+    """
+    Size bounded (least recently used entries are dropped first) cache of `getaddrinfo` results with fixed time to
+    live, failed lookups (`socket.gaierror`) are cached for `negative_ttl`
+
+    Results are stored per host without port, use `with_port` to get connectable addresses, cache is not thread safe,
+    asyncio and trio resolvers use it from event loop thread only
+    """
+
+    def __init__(self, *, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, host):
+        """
+        Cached `getaddrinfo` results, `None` if there is no fresh entry, raises cached `socket.gaierror`
+        """
+        entry = self._entries.get(host)
+        if entry is None:
+            return None
+        expires, infos, error = entry
+        if expires <= time.monotonic():
+            del self._entries[host]
+            return None
+        self._entries.move_to_end(host)
+        if error is not None:
+            # fresh exception instance, reraising cached one grows its traceback
+            raise socket.gaierror(*error.args)
+        return infos
+
+    def set(self, host, infos):
+        self._put(host, self.ttl, infos, None)
+
+    def set_error(self, host, error):
+        self._put(host, self.negative_ttl, None, error)
+
+    def _put(self, host, ttl, infos, error):
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        self._entries[host] = time.monotonic() + ttl, infos, error
+        self._entries.move_to_end(host)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
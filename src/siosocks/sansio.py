@@ -5,42 +5,137 @@ from .exceptions import SocksException
 MAX_STRING_SIZE = 2**10
 
 
+class _StructCache(dict):
+    def __missing__(self, fmt):
+        s = self[fmt] = struct.Struct("!" + fmt)
+        return s
+
+
+STRUCTS = _StructCache()
+
+
+class Message:
+    __slots__ = ()
+    opcode = None
+    method = None
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._values() == other._values()
+
+    def __repr__(self):
+        args = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({args})"
+
+
+class Read(Message):
+    __slots__ = ()
+    opcode = 0
+    method = "read"
+
+
+class Write(Message):
+    __slots__ = ("data",)
+    opcode = 1
+    method = "write"
+
+    def __init__(self, data):
+        self.data = data
+
+
+class Connect(Message):
+    __slots__ = ("host", "port")
+    opcode = 2
+    method = "connect"
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+
+class Passthrough(Message):
+    __slots__ = ("data",)
+    opcode = 3
+    method = "passthrough"
+
+    def __init__(self, data=b""):
+        # bytes received after handshake (pipelined client data), must be sent to destination first
+        self.data = data
+
+
+READ = Read()
+PASSTHROUGH = Passthrough()
+MESSAGES = {cls.method: cls for cls in (Read, Write, Connect, Passthrough)}
+
+
+def from_dict(message):
+    """
+    Convert legacy `dict(method=..., **kwargs)` message to message object
+    """
+    kwargs = dict(message)
+    return MESSAGES[kwargs.pop("method")](**kwargs)
+
+
 class SansIORW:
     def __init__(self, encoding):
-        self.buffer = b""
+        self._buffer = bytearray()
+        self._offset = 0
+        self._write_buffer = bytearray()
         self.encoding = encoding
 
+    def _append(self, data):
+        if self._offset == len(self._buffer):
+            self._buffer.clear()
+            self._offset = 0
+        self._buffer += data
+
     def _take_first(self, x, *, put_back=False):
-        result = self.buffer[:x]
-        if put_back:
-            return result
-        self.buffer = self.buffer[x:]
+        start = self._offset
+        # one copy, view is released before buffer is resized
+        with memoryview(self._buffer) as view:
+            result = bytes(view[start : start + x])
+        if not put_back:
+            self._offset = start + len(result)
         return result
 
     def _read(self):
-        data = yield dict(method="read")
+        yield from self.flush()
+        data = yield READ
         if not data:
             raise SocksException("Unexpected end of data")
         return data
 
+    def _fill(self, count):
+        while len(self._buffer) - self._offset < count:
+            self._append((yield from self._read()))
+
     def read_exactly(self, count, *, put_back=False):
-        while len(self.buffer) < count:
-            self.buffer += yield from self._read()
+        yield from self._fill(count)
         return self._take_first(count, put_back=put_back)
 
     def read_until(self, delimiter, *, max_size=None, put_back=False):
+        scanned = 0
         while True:
-            pos = self.buffer.find(delimiter)
-            if max_size is not None and (pos == -1 and len(self.buffer) > max_size or pos > max_size):
-                raise SocksException(f"Buffer became too long ({len(self.buffer)} > {max_size})")
+            pos = self._buffer.find(delimiter, self._offset + scanned)
+            size = len(self._buffer) - self._offset
+            if pos != -1:
+                pos -= self._offset
+            if max_size is not None and (pos == -1 and size > max_size or pos > max_size):
+                raise SocksException(f"Buffer became too long ({size} > {max_size})")
             if pos != -1:
                 return self._take_first(pos, put_back=put_back)
-            self.buffer += yield from self._read()
+            # resume search from where previous one stopped, delimiter can be split between chunks
+            scanned = max(0, size - len(delimiter) + 1)
+            self._append((yield from self._read()))
 
     def read_struct(self, fmt, *, put_back=False):
-        s = struct.Struct("!" + fmt)
-        raw = yield from self.read_exactly(s.size, put_back=put_back)
-        values = s.unpack(raw)
+        s = STRUCTS[fmt]
+        yield from self._fill(s.size)
+        values = s.unpack_from(self._buffer, self._offset)
+        if not put_back:
+            self._offset += s.size
         if len(values) == 1:
             return values[0]
         return values
@@ -59,12 +154,19 @@ class SansIORW:
             return b
         return b.decode(self.encoding)
 
+    def flush(self):
+        if self._write_buffer:
+            data = bytes(self._write_buffer)
+            self._write_buffer.clear()
+            yield Write(data)
+
     def write(self, data):
-        yield dict(method="write", data=data)
+        # writes are coalesced and sent as one message on next read, connect or passthrough
+        self._write_buffer += data
+        yield from ()
 
     def write_struct(self, fmt, *values):
-        s = struct.Struct("!" + fmt)
-        yield from self.write(s.pack(*values))
+        yield from self.write(STRUCTS[fmt].pack(*values))
 
     def write_c_string(self, s):
         b = s if self.encoding is None else s.encode(self.encoding)
@@ -80,7 +182,12 @@ class SansIORW:
         yield from self.write(b)
 
     def connect(self, host, port):
-        yield dict(method="connect", host=host, port=port)
+        yield from self.flush()
+        yield Connect(host, port)
 
     def passthrough(self):
-        yield dict(method="passthrough")
+        yield from self.flush()
+        if self._offset == len(self._buffer):
+            yield PASSTHROUGH
+        else:
+            yield Passthrough(self._take_first(len(self._buffer) - self._offset))
@@ -0,0 +1,125 @@
+import logging
+import socket
+import sys
+
+logger = logging.getLogger(__name__)
+# linux value, constant is exposed by python 3.12+
+IP_BIND_ADDRESS_NO_PORT = getattr(socket, "IP_BIND_ADDRESS_NO_PORT", 24 if sys.platform == "linux" else None)
+INET_FAMILIES = (socket.AF_INET, socket.AF_INET6)
+
+
+class SocketOptions:
+    """
+    TCP tuning profile of incoming and outgoing sockets, one instance shared by all connections of server, `None`
+    keeps kernel (or event loop) default, options not supported by platform are skipped
+
+    - `nodelay`: `TCP_NODELAY`, disable Nagle algorithm (asyncio and trio enable it by default)
+    - `send_buffer`, `receive_buffer`: `SO_SNDBUF`, `SO_RCVBUF` bytes
+    - `keepalive`: `SO_KEEPALIVE`, enabled if any of `keepalive_idle`, `keepalive_interval` (`TCP_KEEPIDLE`,
+      `TCP_KEEPINTVL` seconds) or `keepalive_count` (`TCP_KEEPCNT` probes) is set
+    - `quickack`: `TCP_QUICKACK`, linux drops it back after some time, so it is a hint for connection start
+    - `notsent_lowat`: `TCP_NOTSENT_LOWAT` bytes, limits unsent data in kernel, so writers block earlier
+    - `fastopen`: `TCP_FASTOPEN` queue length of listening socket
+
+    Outgoing sockets get `IP_BIND_ADDRESS_NO_PORT`, so binding to source address does not reserve local port before
+    connect
+    """
+
+    def __init__(
+        self,
+        *,
+        nodelay=None,
+        send_buffer=None,
+        receive_buffer=None,
+        keepalive=None,
+        keepalive_idle=None,
+        keepalive_interval=None,
+        keepalive_count=None,
+        quickack=None,
+        notsent_lowat=None,
+        fastopen=None,
+    ):
+        numbers = dict(
+            send_buffer=send_buffer,
+            receive_buffer=receive_buffer,
+            keepalive_idle=keepalive_idle,
+            keepalive_interval=keepalive_interval,
+            keepalive_count=keepalive_count,
+            notsent_lowat=notsent_lowat,
+            fastopen=fastopen,
+        )
+        for name, value in numbers.items():
+            if value is not None and value <= 0:
+                raise ValueError(f"Socket option {name} must be positive, got {value}")
+        if keepalive is None and any(v is not None for v in (keepalive_idle, keepalive_interval, keepalive_count)):
+            keepalive = True
+        self.nodelay = nodelay
+        self.send_buffer = send_buffer
+        self.receive_buffer = receive_buffer
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.quickack = quickack
+        self.notsent_lowat = notsent_lowat
+        self.fastopen = fastopen
+        options = [
+            (socket.IPPROTO_TCP, "TCP_NODELAY", nodelay),
+            (socket.SOL_SOCKET, "SO_SNDBUF", send_buffer),
+            (socket.SOL_SOCKET, "SO_RCVBUF", receive_buffer),
+            (socket.SOL_SOCKET, "SO_KEEPALIVE", keepalive),
+            (socket.IPPROTO_TCP, "TCP_KEEPIDLE", keepalive_idle),
+            (socket.IPPROTO_TCP, "TCP_KEEPINTVL", keepalive_interval),
+            (socket.IPPROTO_TCP, "TCP_KEEPCNT", keepalive_count),
+            (socket.IPPROTO_TCP, "TCP_QUICKACK", quickack),
+            (socket.IPPROTO_TCP, "TCP_NOTSENT_LOWAT", notsent_lowat),
+        ]
+        # (level, option, value) triples, precomputed for per connection calls
+        self.options = _resolve(options)
+        self.listener_options = self.options + _resolve([(socket.IPPROTO_TCP, "TCP_FASTOPEN", fastopen)])
+        self.outgoing_options = list(self.options)
+        if IP_BIND_ADDRESS_NO_PORT is not None:
+            self.outgoing_options.append((socket.IPPROTO_IP, IP_BIND_ADDRESS_NO_PORT, 1))
+
+    def apply(self, sock):
+        """
+        Set options of connected (incoming) socket, failures are logged, connection works with defaults
+        """
+        _set(sock, self.options)
+
+    def apply_outgoing(self, sock):
+        """
+        Set options of outgoing socket before connect, so buffer sizes take part in window negotiation
+        """
+        _set(sock, self.outgoing_options)
+
+    def apply_listener(self, sock):
+        """
+        Set options of listening socket, accepted sockets inherit most of them on linux, errors are raised
+        """
+        if sock.family in INET_FAMILIES:
+            for level, option, value in self.listener_options:
+                sock.setsockopt(level, option, value)
+
+
+def _resolve(options):
+    resolved = []
+    for level, name, value in options:
+        option = getattr(socket, name, None)
+        if value is None:
+            continue
+        if option is None:
+            logger.debug("socket option %s is not supported by platform, skipped", name)
+            continue
+        resolved.append((level, option, int(value)))
+    return resolved
+
+
+def _set(sock, options):
+    if sock.family not in INET_FAMILIES:
+        return
+    for level, option, value in options:
+        try:
+            sock.setsockopt(level, option, value)
+        except OSError as exc:
+            logger.debug("socket option %d/%d not set: %r", level, option, exc)
@@ -0,0 +1,102 @@
+import ipaddress
+import itertools
+import socket
+import threading
+
+from .sockopts import IP_BIND_ADDRESS_NO_PORT
+
+STRATEGIES = ("round-robin", "least-connections")
+
+
+class SourceAddresses:
+    """
+    Local addresses for outgoing connections, one instance shared by all connections of server, so destinations see
+    connections from several addresses and each of them has own ephemeral ports range
+
+    Address of socket family is taken by `strategy`: `"round-robin"` or `"least-connections"` (fewest outgoing
+    connections bound to it, ties are taken round-robin). Sockets of family without addresses are not bound.
+    `IP_BIND_ADDRESS_NO_PORT` defers local port choice to connect, so port is unique per destination, not per source
+    address
+    """
+
+    def __init__(self, addresses, *, strategy="round-robin"):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown source address strategy {strategy!r}, expected one of {STRATEGIES}")
+        if not addresses:
+            raise ValueError("Source addresses list is empty")
+        self.strategy = strategy
+        self._families = {}
+        self._active = {}
+        for address in addresses:
+            ip = ipaddress.ip_address(address)
+            family = socket.AF_INET if ip.version == 4 else socket.AF_INET6
+            if ip not in self._active:
+                self._families.setdefault(family, []).append(ip)
+                self._active[ip] = 0
+        self._counters = {family: itertools.count() for family in self._families}
+        # socketserver backend and connect workers bind from many threads
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        """
+        Outgoing connections count by address
+        """
+        with self._lock:
+            return {str(ip): count for ip, count in self._active.items()}
+
+    def _acquire(self, family):
+        candidates = self._families.get(family)
+        if candidates is None:
+            return None
+        with self._lock:
+            start = next(self._counters[family]) % len(candidates)
+            if self.strategy == "round-robin":
+                ip = candidates[start]
+            else:
+                ip = min(candidates[start:] + candidates[:start], key=self._active.__getitem__)
+            self._active[ip] += 1
+        return ip
+
+    def bind(self, sock):
+        """
+        Bind socket to next address of its family before connect, returns address or `None` if socket is not bound,
+        address should be released when connection is closed
+        """
+        ip = self._acquire(sock.family)
+        if ip is None:
+            return None
+        try:
+            if IP_BIND_ADDRESS_NO_PORT is not None:
+                sock.setsockopt(socket.IPPROTO_IP, IP_BIND_ADDRESS_NO_PORT, 1)
+            sock.bind((str(ip), 0))
+        except BaseException:
+            self.release(ip)
+            raise
+        return ip
+
+    def release(self, address):
+        """
+        Return address taken by `bind`, `None` is ignored
+        """
+        if address is None:
+            return
+        with self._lock:
+            self._active[ipaddress.ip_address(address)] -= 1
+
+    def address_of(self, sock):
+        """
+        Address socket is bound to if it is one of pool addresses, otherwise `None`
+        """
+        try:
+            ip = ipaddress.ip_address(sock.getsockname()[0])
+        except (OSError, ValueError):
+            return None
+        return ip if ip in self._active else None
+
+    def close(self, sock):
+        """
+        Release address of socket and close it, for connect attempts, which were not used
+        """
+        self.release(self.address_of(sock))
+        sock.close()
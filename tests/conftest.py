@@ -0,0 +1,125 @@
+import asyncio
+import socket
+
+import pytest
+import pytest_asyncio
+
+from siosocks.interface import EngineHooks
+from siosocks.sockopts import SocketOptions
+from siosocks.sources import SourceAddresses
+
+BLACKHOLE_HOST = "127.0.0.2"
+
+
+@pytest.fixture
+def blackhole():
+    """
+    Factory of listening sockets with full accept queue, connections to them hang (syn is dropped)
+    """
+    sockets = []
+
+    def factory(port):
+        listener = socket.create_server((BLACKHOLE_HOST, port), backlog=0)
+        sockets.append(listener)
+        for _ in range(4):
+            sock = socket.socket()
+            sock.setblocking(False)
+            sock.connect_ex((BLACKHOLE_HOST, port))
+            sockets.append(sock)
+        return BLACKHOLE_HOST, port
+
+    yield factory
+    for sock in sockets:
+        sock.close()
+
+
+@pytest.fixture
+def dual_addresses(blackhole):
+    """
+    Factory of `getaddrinfo` results for port, first address hangs, second one is 127.0.0.1
+    """
+
+    def factory(port):
+        return [
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", blackhole(port)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", port)),
+        ]
+
+    return factory
+
+
+class RecordingSocketOptions(SocketOptions):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.tuned = []
+
+    def _record(self, kind, sock):
+        self.tuned.append((kind, sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)))
+
+    def apply(self, sock):
+        super().apply(sock)
+        self._record("connection", sock)
+
+    def apply_outgoing(self, sock):
+        super().apply_outgoing(sock)
+        self._record("outgoing", sock)
+
+
+@pytest.fixture
+def socket_options():
+    """
+    Keepalive profile, which records kind of tuned sockets and their `SO_KEEPALIVE` value
+    """
+    return RecordingSocketOptions(keepalive_idle=60, nodelay=True)
+
+
+@pytest.fixture
+def source_addresses():
+    return SourceAddresses(["127.0.0.3", "127.0.0.4"])
+
+
+@pytest_asyncio.fixture
+async def peer_port():
+    """
+    Port of endpoint, which replies with client address it sees
+    """
+
+    async def handler(r, w):
+        w.write(w.get_extra_info("peername")[0].encode())
+        await w.drain()
+        w.close()
+
+    server = await asyncio.start_server(handler, "127.0.0.1", 0)
+    yield server.sockets[0].getsockname()[1]
+    server.close()
+    await server.wait_closed()
+
+
+class RecordingHooks(EngineHooks):
+    def __init__(self):
+        self.events = []
+        self.connects = []
+
+    def read(self, started, finished, data):
+        self.events.append("read")
+
+    def write(self, started, finished, size):
+        self.events.append("write")
+
+    def connect(self, started, finished, host, port, exc):
+        self.events.append("connect")
+        self.connects.append((host, port, exc))
+
+    def passthrough_started(self, timestamp):
+        self.events.append("passthrough_started")
+
+    def passthrough_finished(self, timestamp, transferred):
+        self.events.append(("passthrough_finished", transferred))
+
+
+@pytest.fixture
+def hooks():
+    """
+    Engine hooks, which record names of called methods (and connect arguments), share one for all connections
+    """
+    return RecordingHooks()
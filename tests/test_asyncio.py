@@ -1,10 +1,25 @@
 import asyncio
+import functools
+import socket
+import sys
 
 import pytest
 import pytest_asyncio
 
 from siosocks.exceptions import SocksException
-from siosocks.io.asyncio import open_connection, socks_server_handler
+from siosocks.io.asyncio import (
+    ClientIO,
+    ClientPool,
+    Resolver,
+    ServerIO,
+    create_connection,
+    loop_factory,
+    open_connection,
+    socks_server_handler,
+)
+from siosocks.io.socket import SPLICE_AVAILABLE
+from siosocks.limits import ServerLimits
+from siosocks.metrics import ServerMetrics
 
 HOST = "127.0.0.1"
 MESSAGE = b"socks work!"
@@ -69,6 +84,29 @@ async def test_connection_socks_failed(socks_server_port, unused_tcp_port):
         )
 
 
+@pytest.mark.asyncio
+async def test_handler_failure_logged(unused_tcp_port_factory, caplog):
+    socks_server_port, closed_port = unused_tcp_port_factory(), unused_tcp_port_factory()
+    handled = asyncio.get_running_loop().create_future()
+
+    async def handler(reader, writer):
+        await socks_server_handler(reader, writer)
+        handled.set_result(None)
+
+    server = await asyncio.start_server(handler, HOST, socks_server_port)
+    try:
+        with caplog.at_level("DEBUG", logger="siosocks.io.asyncio"):
+            with pytest.raises(SocksException):
+                kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+                await open_connection(HOST, closed_port, **kw)
+            # handler returns, failure is logged at debug level instead of unhandled callback error
+            await asyncio.wait_for(handled, 1)
+        assert not [record for record in caplog.records if record.levelname == "ERROR"]
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
 @pytest.mark.asyncio
 async def test_connection_partly_passed_error(endpoint_port, socks_server_port):
     with pytest.raises(SocksException):
@@ -78,3 +116,642 @@ async def test_connection_partly_passed_error(endpoint_port, socks_server_port):
             socks_host=HOST,
             socks_port=socks_server_port,
         )
+
+
+def test_loop_factory(monkeypatch):
+    assert loop_factory("asyncio") is asyncio.new_event_loop
+    with pytest.raises(ValueError):
+        loop_factory("foo")
+    monkeypatch.setitem(sys.modules, "uvloop", None)
+    with pytest.raises(ImportError, match="uvloop is not installed"):
+        loop_factory("uvloop")
+
+
+def test_uvloop_connection_socks_success():
+    uvloop = pytest.importorskip("uvloop")
+
+    async def main():
+        async def handler(r, w):
+            w.write(await r.read(8192))
+            await w.drain()
+            w.close()
+
+        endpoint = await asyncio.start_server(handler, HOST, 0)
+        socks = await asyncio.start_server(socks_server_handler, HOST, 0)
+        async with endpoint, socks:
+            r, w = await open_connection(
+                HOST,
+                endpoint.sockets[0].getsockname()[1],
+                socks_host=HOST,
+                socks_port=socks.sockets[0].getsockname()[1],
+                socks_version=5,
+            )
+            w.write(MESSAGE)
+            assert await r.read(8192) == MESSAGE
+            w.close()
+            assert isinstance(asyncio.get_running_loop(), uvloop.Loop)
+
+    with asyncio.Runner(loop_factory=loop_factory("uvloop")) as runner:
+        runner.run(main())
+
+
+@pytest.mark.asyncio
+async def test_metrics(endpoint_port, unused_tcp_port_factory):
+    metrics = ServerMetrics()
+    socks_server_port = unused_tcp_port_factory()
+    handler = functools.partial(socks_server_handler, metrics=metrics)
+    server = await asyncio.start_server(handler, HOST, socks_server_port)
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    try:
+        r, w = await open_connection(HOST, endpoint_port, **kw)
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+        failed_port = unused_tcp_port_factory()
+        with pytest.raises(SocksException):
+            await open_connection(HOST, failed_port, **kw)
+        for _ in range(100):
+            if metrics.transferred.value(direction="down"):
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        server.close()
+        await server.wait_closed()
+    assert metrics.accepted.value() == 2
+    assert metrics.handshake_seconds.count(version=5) == 1
+    assert metrics.connect_seconds.count(destination=f"{HOST}:{endpoint_port}") == 1
+    assert metrics.connect_failures.value(destination=f"{HOST}:{failed_port}") == 1
+    assert metrics.active_tunnels.value() == 0
+    assert metrics.transferred.value(direction="up") == len(MESSAGE)
+    assert metrics.transferred.value(direction="down") == len(MESSAGE)
+
+
+@pytest.mark.asyncio
+async def test_hooks(endpoint_port, unused_tcp_port_factory, hooks):
+    socks_server_port = unused_tcp_port_factory()
+    handler = functools.partial(socks_server_handler, hooks_factory=lambda: hooks)
+    server = await asyncio.start_server(handler, HOST, socks_server_port)
+    try:
+        r, w = await open_connection(
+            HOST, endpoint_port, socks_host=HOST, socks_port=socks_server_port, socks_version=4
+        )
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+        for _ in range(100):
+            if len(hooks.events) == 5:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        server.close()
+        await server.wait_closed()
+    assert hooks.events == [
+        "read",
+        "connect",
+        "write",
+        "passthrough_started",
+        ("passthrough_finished", (len(MESSAGE), len(MESSAGE))),
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("socks_version", [4, 5])
+async def test_resolver(endpoint_port, unused_tcp_port_factory, socks_version):
+    resolver = Resolver()
+    socks_server_port = unused_tcp_port_factory()
+    handler = functools.partial(socks_server_handler, resolver=resolver)
+    server = await asyncio.start_server(handler, HOST, socks_server_port)
+    try:
+        for _ in range(2):
+            r, w = await open_connection(
+                "localhost",
+                endpoint_port,
+                socks_host=HOST,
+                socks_port=socks_server_port,
+                socks_version=socks_version,
+            )
+            w.write(MESSAGE)
+            assert await r.read(8192) == MESSAGE
+            w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+    assert resolver.cache.get("localhost") is not None
+
+
+@pytest.mark.asyncio
+async def test_resolver_coalescing(monkeypatch):
+    calls = []
+    loop = asyncio.get_running_loop()
+
+    async def getaddrinfo(host, port, **kw):
+        calls.append(host)
+        await asyncio.sleep(0.01)
+        if host == "missing.test":
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", 0))]
+
+    monkeypatch.setattr(loop, "getaddrinfo", getaddrinfo)
+    resolver = Resolver()
+    results = await asyncio.gather(*(resolver.resolve("python.org", port) for port in range(10)))
+    assert calls == ["python.org"]
+    assert [address for [(*_, address)] in results] == [("127.0.0.1", port) for port in range(10)]
+    results = await asyncio.gather(*(resolver.resolve("missing.test", 80) for _ in range(10)), return_exceptions=True)
+    assert all(isinstance(r, socket.gaierror) for r in results)
+    with pytest.raises(socket.gaierror):
+        await resolver.resolve("missing.test", 80)
+    assert await resolver.resolve("127.0.0.1", 80)
+    assert calls == ["python.org", "missing.test"]
+
+
+@pytest.mark.asyncio
+async def test_resolver_owner_cancelled(monkeypatch):
+    calls = []
+    loop = asyncio.get_running_loop()
+
+    async def getaddrinfo(host, port, **kw):
+        calls.append(host)
+        await asyncio.sleep(0.01)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", 0))]
+
+    monkeypatch.setattr(loop, "getaddrinfo", getaddrinfo)
+    resolver = Resolver()
+    owner = asyncio.ensure_future(resolver.resolve("python.org", 80))
+    await asyncio.sleep(0)
+    waiter = asyncio.ensure_future(resolver.resolve("python.org", 80))
+    await asyncio.sleep(0)
+    owner.cancel()
+    [(*_, address)] = await waiter
+    assert address == ("127.0.0.1", 80)
+    assert calls == ["python.org", "python.org"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("cached", [False, True], ids=["uncached", "resolver"])
+async def test_happy_eyeballs(endpoint_port, unused_tcp_port_factory, dual_addresses, monkeypatch, cached):
+    loop = asyncio.get_running_loop()
+    infos = dual_addresses(endpoint_port)
+
+    async def getaddrinfo(host, port, **kw):
+        return infos
+
+    monkeypatch.setattr(loop, "getaddrinfo", getaddrinfo)
+    socks_server_port = unused_tcp_port_factory()
+    handler = functools.partial(socks_server_handler, resolver=Resolver() if cached else None)
+    server = await asyncio.start_server(handler, HOST, socks_server_port)
+    started = loop.time()
+    try:
+        r, w = await open_connection(
+            "destination.test", endpoint_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5
+        )
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+    assert loop.time() - started < 1
+
+
+@pytest.mark.asyncio
+async def test_create_connection(dual_addresses, unused_tcp_port, monkeypatch):
+    loop = asyncio.get_running_loop()
+    infos = dual_addresses(unused_tcp_port)
+
+    async def getaddrinfo(host, port, **kw):
+        return infos
+
+    monkeypatch.setattr(loop, "getaddrinfo", getaddrinfo)
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(create_connection("destination.test", unused_tcp_port, happy_eyeballs_delay=None), 0.5)
+    with pytest.raises(ConnectionRefusedError):
+        await create_connection(HOST, unused_tcp_port)
+
+
+@pytest.mark.asyncio
+async def test_handshake_timeout(unused_tcp_port):
+    handler = functools.partial(socks_server_handler, handshake_timeout=0.1)
+    server = await asyncio.start_server(handler, HOST, unused_tcp_port)
+    try:
+        r, w = await asyncio.open_connection(HOST, unused_tcp_port)
+        w.write(b"\x05")
+        assert await asyncio.wait_for(r.read(8192), 1) == b""
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_connect_timeout(blackhole, unused_tcp_port_factory):
+    host, port = blackhole(unused_tcp_port_factory())
+    socks_server_port = unused_tcp_port_factory()
+    handler = functools.partial(socks_server_handler, connect_timeout=0.1)
+    server = await asyncio.start_server(handler, HOST, socks_server_port)
+    try:
+        with pytest.raises(SocksException):
+            await asyncio.wait_for(
+                open_connection(host, port, socks_host=HOST, socks_port=socks_server_port, socks_version=5), 1
+            )
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_idle_timeout(unused_tcp_port_factory):
+    async def silent(r, w):
+        await r.read()
+        w.close()
+
+    endpoint = await asyncio.start_server(silent, HOST, unused_tcp_port_factory())
+    endpoint_port = endpoint.sockets[0].getsockname()[1]
+    socks_server_port = unused_tcp_port_factory()
+    handler = functools.partial(socks_server_handler, idle_timeout=0.2)
+    server = await asyncio.start_server(handler, HOST, socks_server_port)
+    try:
+        r, w = await open_connection(
+            HOST, endpoint_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5
+        )
+        w.write(MESSAGE)
+        await asyncio.sleep(0.1)
+        w.write(MESSAGE)
+        assert await asyncio.wait_for(r.read(8192), 1) == b""
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+        endpoint.close()
+        await endpoint.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_max_connections_per_ip(endpoint_port, unused_tcp_port):
+    limits = ServerLimits(max_connections_per_ip=1)
+    handler = functools.partial(socks_server_handler, limits=limits)
+    server = await asyncio.start_server(handler, HOST, unused_tcp_port)
+    kw = dict(socks_host=HOST, socks_port=unused_tcp_port, socks_version=5)
+    try:
+        r, w = await open_connection(HOST, endpoint_port, **kw)
+        # rejected connection gets failure reply to its request
+        with pytest.raises(SocksException, match="0x02"):
+            await open_connection(HOST, endpoint_port, **kw)
+        w.close()
+        for _ in range(100):
+            if not limits.connections:
+                break
+            await asyncio.sleep(0.01)
+        r, w = await open_connection(HOST, endpoint_port, **kw)
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_rejected_connections_bounded(endpoint_port, unused_tcp_port):
+    limits = ServerLimits(max_connections=1, max_rejecting=1, rejection_timeout=0.2)
+    handler = functools.partial(socks_server_handler, limits=limits)
+    server = await asyncio.start_server(handler, HOST, unused_tcp_port)
+    kw = dict(socks_host=HOST, socks_port=unused_tcp_port, socks_version=5)
+    try:
+        r, w = await open_connection(HOST, endpoint_port, **kw)
+        idle = [await asyncio.open_connection(HOST, unused_tcp_port) for _ in range(10)]
+        await asyncio.sleep(0.05)
+        assert limits.rejecting == 1
+        # one idle rejected connection waits for its request, the rest are closed without reply
+        for ir, iw in idle:
+            assert await asyncio.wait_for(ir.read(8192), 1) == b""
+            iw.close()
+        assert limits.rejecting == 0
+        with pytest.raises(SocksException, match="0x02"):
+            await open_connection(HOST, endpoint_port, **kw)
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_max_connecting(endpoint_port, blackhole, unused_tcp_port_factory):
+    limits = ServerLimits(max_connecting=1)
+    socks_server_port = unused_tcp_port_factory()
+    handler = functools.partial(socks_server_handler, limits=limits)
+    server = await asyncio.start_server(handler, HOST, socks_server_port)
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    hanging = asyncio.ensure_future(open_connection(*blackhole(unused_tcp_port_factory()), **kw))
+    try:
+        for _ in range(100):
+            if limits.connecting:
+                break
+            await asyncio.sleep(0.01)
+        with pytest.raises(SocksException, match="0x02"):
+            await open_connection(HOST, endpoint_port, **kw)
+    finally:
+        hanging.cancel()
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("socks_version", [4, 5])
+async def test_client_pool(endpoint_port, unused_tcp_port, socks_version):
+    accepted = []
+
+    async def handler(reader, writer):
+        accepted.append(writer)
+        await socks_server_handler(reader, writer)
+
+    server = await asyncio.start_server(handler, HOST, unused_tcp_port)
+    try:
+        async with ClientPool(HOST, unused_tcp_port, socks_version, size=2) as pool:
+            for _ in range(100):
+                if pool.idle == 2:
+                    break
+                await asyncio.sleep(0.01)
+            assert len(accepted) == 2
+            for _ in range(3):
+                r, w = await pool.open_connection(HOST, endpoint_port)
+                w.write(MESSAGE)
+                assert await r.read(8192) == MESSAGE
+                w.close()
+        assert pool.idle == 0
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_client_pool_stale(endpoint_port, unused_tcp_port):
+    handler = functools.partial(socks_server_handler, handshake_timeout=0.1)
+    server = await asyncio.start_server(handler, HOST, unused_tcp_port)
+    try:
+        async with ClientPool(HOST, unused_tcp_port, 5, size=1, ttl=10) as pool:
+            await asyncio.sleep(0.2)
+            r, w = await pool.open_connection(HOST, endpoint_port)
+            w.write(MESSAGE)
+            assert await r.read(8192) == MESSAGE
+            w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_client_pool_retry(unused_tcp_port):
+    async with ClientPool(HOST, unused_tcp_port, 5, size=1, retry_delay=0.1) as pool:
+        with pytest.raises(ConnectionRefusedError):
+            await pool.open_connection(HOST, 80)
+        server = await asyncio.start_server(socks_server_handler, HOST, unused_tcp_port)
+        try:
+            for _ in range(100):
+                if pool.idle:
+                    break
+                await asyncio.sleep(0.01)
+            assert pool.idle == 1
+        finally:
+            server.close()
+            await server.wait_closed()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("optimistic", [False, True])
+@pytest.mark.parametrize("socks_version", [4, 5])
+async def test_early_data(endpoint_port, unused_tcp_port, socks_version, optimistic):
+    auth = dict(username="yoba", password="foo") if socks_version == 5 else {}
+    handler = functools.partial(socks_server_handler, allowed_versions={socks_version}, **auth)
+    server = await asyncio.start_server(handler, HOST, unused_tcp_port)
+    try:
+        r, w = await open_connection(
+            HOST,
+            endpoint_port,
+            socks_host=HOST,
+            socks_port=unused_tcp_port,
+            socks_version=socks_version,
+            optimistic=optimistic,
+            early_data=MESSAGE,
+            **auth,
+        )
+        assert await r.read(8192) == MESSAGE
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_client_leftover():
+    reader = asyncio.StreamReader()
+    reader.feed_data(b"world")
+    reader.feed_eof()
+    io = ClientIO(reader, None)
+    await io.passthrough(b"hello ")
+    assert io.r is reader
+    assert await io.r.read() == b"hello world"
+
+
+@pytest.mark.asyncio
+async def test_client_leftover_flow_control():
+    class Transport:
+        paused = False
+
+        def pause_reading(self):
+            self.paused = True
+
+        def resume_reading(self):
+            self.paused = False
+
+    transport = Transport()
+    reader = asyncio.StreamReader(limit=2**10)
+    reader.set_transport(transport)
+    io = ClientIO(reader, None)
+    await io.passthrough(b"x" * 2**12)
+    # leftover goes to reader itself, so its limit pauses transport until leftover is read
+    assert io.r is reader
+    assert transport.paused
+    assert await io.r.readexactly(2**12) == b"x" * 2**12
+    assert not transport.paused
+
+
+@pytest.mark.asyncio
+async def test_adaptive_block_size(unused_tcp_port_factory):
+    async def echo(r, w):
+        while b := await r.read(2**16):
+            w.write(b)
+            await w.drain()
+        w.close()
+
+    payload = bytes(range(256)) * 2**12
+    endpoint = await asyncio.start_server(echo, HOST, unused_tcp_port_factory())
+    handler = functools.partial(socks_server_handler, block_size=1024, max_block_size=2**18)
+    socks_server_port = unused_tcp_port_factory()
+    server = await asyncio.start_server(handler, HOST, socks_server_port)
+    try:
+        r, w = await open_connection(
+            HOST,
+            endpoint.sockets[0].getsockname()[1],
+            socks_host=HOST,
+            socks_port=socks_server_port,
+            socks_version=5,
+        )
+        w.write(payload)
+        assert await asyncio.wait_for(r.readexactly(len(payload)), 5) == payload
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+        endpoint.close()
+        await endpoint.wait_closed()
+
+
+splice_only = pytest.mark.skipif(not SPLICE_AVAILABLE, reason="splice is not available")
+
+
+@splice_only
+@pytest.mark.asyncio
+async def test_splice_half_close(unused_tcp_port_factory):
+    async def digest(r, w):
+        data = await r.read()
+        w.write(data[::-1])
+        w.close()
+
+    payload = bytes(range(256)) * 2**12
+    endpoint = await asyncio.start_server(digest, HOST, unused_tcp_port_factory())
+    metrics = ServerMetrics()
+    handler = functools.partial(socks_server_handler, metrics=metrics, splice=True)
+    socks_server_port = unused_tcp_port_factory()
+    server = await asyncio.start_server(handler, HOST, socks_server_port)
+    try:
+        r, w = await open_connection(
+            HOST,
+            endpoint.sockets[0].getsockname()[1],
+            socks_host=HOST,
+            socks_port=socks_server_port,
+            socks_version=5,
+            early_data=MESSAGE,
+        )
+        w.write(payload)
+        w.write_eof()
+        assert await asyncio.wait_for(r.read(), 5) == (MESSAGE + payload)[::-1]
+        w.close()
+        for _ in range(100):
+            if metrics.active_tunnels.value() == 0:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        server.close()
+        await server.wait_closed()
+        endpoint.close()
+        await endpoint.wait_closed()
+    assert metrics.transferred.value(direction="up") == len(MESSAGE) + len(payload)
+    assert metrics.transferred.value(direction="down") == len(MESSAGE) + len(payload)
+
+
+@splice_only
+@pytest.mark.asyncio
+async def test_splice_pipelined(endpoint_port, unused_tcp_port):
+    handler = functools.partial(socks_server_handler, splice=True, allowed_versions={5})
+    server = await asyncio.start_server(handler, HOST, unused_tcp_port)
+    try:
+        # request and data in one flight, data is buffered by stream reader before passthrough
+        r, w = await open_connection(
+            HOST,
+            endpoint_port,
+            socks_host=HOST,
+            socks_port=unused_tcp_port,
+            socks_version=5,
+            optimistic=True,
+            early_data=MESSAGE,
+        )
+        assert await asyncio.wait_for(r.read(8192), 1) == MESSAGE
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@splice_only
+@pytest.mark.asyncio
+async def test_splice_idle_timeout(unused_tcp_port_factory):
+    async def silent(r, w):
+        await r.read()
+        w.close()
+
+    endpoint = await asyncio.start_server(silent, HOST, unused_tcp_port_factory())
+    socks_server_port = unused_tcp_port_factory()
+    handler = functools.partial(socks_server_handler, idle_timeout=0.2, splice=True)
+    server = await asyncio.start_server(handler, HOST, socks_server_port)
+    try:
+        r, w = await open_connection(
+            HOST, endpoint.sockets[0].getsockname()[1], socks_host=HOST, socks_port=socks_server_port, socks_version=5
+        )
+        w.write(MESSAGE)
+        assert await asyncio.wait_for(r.read(8192), 1) == b""
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+        endpoint.close()
+        await endpoint.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_splice_fallback_tls():
+    class Writer:
+        def get_extra_info(self, name):
+            return dict(sslcontext=object(), socket=object())[name]
+
+    assert not ServerIO(None, Writer(), splice=True).splice
+
+
+@splice_only
+@pytest.mark.asyncio
+async def test_splice_fallback_reader():
+    class Writer:
+        def get_extra_info(self, name):
+            return dict(sslcontext=None, socket=object())[name]
+
+    # reader buffered data can not be taken, so streams are used
+    assert not ServerIO(object(), Writer(), splice=True).splice
+    assert ServerIO(asyncio.StreamReader(), Writer(), splice=True).splice
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("splice", [False, True], ids=["streams", "splice"])
+async def test_socket_options(endpoint_port, unused_tcp_port, socket_options, splice):
+    handler = functools.partial(socks_server_handler, socket_options=socket_options, splice=splice)
+    server = await asyncio.start_server(handler, HOST, unused_tcp_port)
+    try:
+        r, w = await open_connection(HOST, endpoint_port, socks_host=HOST, socks_port=unused_tcp_port, socks_version=5)
+        w.write(MESSAGE)
+        assert await asyncio.wait_for(r.read(8192), 1) == MESSAGE
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+    assert sorted(kind for kind, _ in socket_options.tuned) == ["connection", "outgoing"]
+    assert all(keepalive for _, keepalive in socket_options.tuned)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("splice", [False, True], ids=["streams", "splice"])
+async def test_source_addresses(peer_port, unused_tcp_port, source_addresses, splice):
+    handler = functools.partial(socks_server_handler, source_addresses=source_addresses, splice=splice)
+    server = await asyncio.start_server(handler, HOST, unused_tcp_port)
+    peers = []
+    try:
+        for _ in range(2):
+            r, w = await open_connection(HOST, peer_port, socks_host=HOST, socks_port=unused_tcp_port, socks_version=5)
+            peers.append(await asyncio.wait_for(r.read(), 1))
+            w.close()
+        for _ in range(100):
+            if not any(source_addresses.active.values()):
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        server.close()
+        await server.wait_closed()
+    assert peers == [b"127.0.0.3", b"127.0.0.4"]
+    assert source_addresses.active == {"127.0.0.3": 0, "127.0.0.4": 0}
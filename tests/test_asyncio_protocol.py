@@ -0,0 +1,394 @@
+import asyncio
+import functools
+
+import pytest
+import pytest_asyncio
+
+from siosocks.exceptions import SocksException
+from siosocks.io.asyncio import Resolver, SocksServerProtocol, open_connection
+from siosocks.limits import ServerLimits
+from siosocks.metrics import ServerMetrics
+
+HOST = "127.0.0.1"
+MESSAGE = b"socks work!"
+
+
+@pytest_asyncio.fixture
+async def endpoint_port(unused_tcp_port_factory):
+    port = unused_tcp_port_factory()
+
+    async def handler(r, w):
+        while True:
+            b = await r.read(8192)
+            if not b:
+                break
+            w.write(b)
+            await w.drain()
+        w.close()
+
+    server = await asyncio.start_server(handler, HOST, port)
+    yield port
+    server.close()
+    await server.wait_closed()
+
+
+@pytest_asyncio.fixture
+async def socks_server_port(unused_tcp_port_factory):
+    port = unused_tcp_port_factory()
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(SocksServerProtocol, HOST, port)
+    yield port
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("socks_version", [4, 5])
+async def test_connection_socks_success(endpoint_port, socks_server_port, socks_version):
+    r, w = await open_connection(
+        HOST,
+        endpoint_port,
+        socks_host=HOST,
+        socks_port=socks_server_port,
+        socks_version=socks_version,
+    )
+    w.write(MESSAGE)
+    m = await r.read(8192)
+    assert m == MESSAGE
+    w.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_socks_bulk(endpoint_port, socks_server_port):
+    r, w = await open_connection(
+        HOST,
+        endpoint_port,
+        socks_host=HOST,
+        socks_port=socks_server_port,
+        socks_version=5,
+    )
+    payload = bytes(range(256)) * 2**14
+
+    async def send():
+        w.write(payload)
+        await w.drain()
+
+    _, m = await asyncio.gather(send(), r.readexactly(len(payload)))
+    assert m == payload
+    w.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_socks_failed(socks_server_port, unused_tcp_port):
+    with pytest.raises(SocksException):
+        await open_connection(
+            HOST,
+            unused_tcp_port,
+            socks_host=HOST,
+            socks_port=socks_server_port,
+            socks_version=4,
+        )
+
+
+@pytest.mark.asyncio
+async def test_connection_socks_auth(endpoint_port, unused_tcp_port):
+    loop = asyncio.get_running_loop()
+    factory = functools.partial(SocksServerProtocol, allowed_versions={5}, username="yoba", password="foo")
+    server = await loop.create_server(factory, HOST, unused_tcp_port)
+    kw = dict(socks_host=HOST, socks_port=unused_tcp_port, socks_version=5, username="yoba")
+    try:
+        with pytest.raises(SocksException):
+            await open_connection(HOST, endpoint_port, password="bar", **kw)
+        r, w = await open_connection(HOST, endpoint_port, password="foo", **kw)
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_metrics(endpoint_port, unused_tcp_port_factory):
+    metrics = ServerMetrics()
+    socks_server_port = unused_tcp_port_factory()
+    factory = functools.partial(SocksServerProtocol, metrics=metrics)
+    server = await asyncio.get_running_loop().create_server(factory, HOST, socks_server_port)
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    try:
+        r, w = await open_connection(HOST, endpoint_port, **kw)
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+        failed_port = unused_tcp_port_factory()
+        with pytest.raises(SocksException):
+            await open_connection(HOST, failed_port, **kw)
+        for _ in range(100):
+            if metrics.transferred.value(direction="down"):
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        server.close()
+        await server.wait_closed()
+    assert metrics.accepted.value() == 2
+    assert metrics.handshake_seconds.count(version=5) == 1
+    assert metrics.connect_seconds.count(destination=f"{HOST}:{endpoint_port}") == 1
+    assert metrics.connect_failures.value(destination=f"{HOST}:{failed_port}") == 1
+    assert metrics.active_tunnels.value() == 0
+    assert metrics.transferred.value(direction="up") == len(MESSAGE)
+    assert metrics.transferred.value(direction="down") == len(MESSAGE)
+
+
+@pytest.mark.asyncio
+async def test_hooks(endpoint_port, unused_tcp_port_factory, hooks):
+    socks_server_port = unused_tcp_port_factory()
+    factory = functools.partial(SocksServerProtocol, hooks_factory=lambda: hooks)
+    server = await asyncio.get_running_loop().create_server(factory, HOST, socks_server_port)
+    try:
+        r, w = await open_connection(
+            HOST, endpoint_port, socks_host=HOST, socks_port=socks_server_port, socks_version=4
+        )
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+        for _ in range(100):
+            if len(hooks.events) == 5:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        server.close()
+        await server.wait_closed()
+    assert hooks.events == [
+        "read",
+        "connect",
+        "write",
+        "passthrough_started",
+        ("passthrough_finished", (len(MESSAGE), len(MESSAGE))),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_resolver(endpoint_port, unused_tcp_port_factory):
+    resolver = Resolver()
+    socks_server_port = unused_tcp_port_factory()
+    loop = asyncio.get_running_loop()
+    factory = functools.partial(SocksServerProtocol, resolver=resolver)
+    server = await loop.create_server(factory, HOST, socks_server_port)
+    try:
+        r, w = await open_connection(
+            "localhost", endpoint_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5
+        )
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+    assert resolver.cache.get("localhost") is not None
+
+
+@pytest.mark.asyncio
+async def test_happy_eyeballs(endpoint_port, unused_tcp_port_factory, dual_addresses, monkeypatch):
+    loop = asyncio.get_running_loop()
+    infos = dual_addresses(endpoint_port)
+
+    async def getaddrinfo(host, port, **kw):
+        return infos
+
+    monkeypatch.setattr(loop, "getaddrinfo", getaddrinfo)
+    socks_server_port = unused_tcp_port_factory()
+    server = await loop.create_server(SocksServerProtocol, HOST, socks_server_port)
+    started = loop.time()
+    try:
+        r, w = await open_connection(
+            "destination.test", endpoint_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5
+        )
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+    assert loop.time() - started < 1
+
+
+@pytest.mark.asyncio
+async def test_handshake_timeout(unused_tcp_port):
+    loop = asyncio.get_running_loop()
+    factory = functools.partial(SocksServerProtocol, handshake_timeout=0.1)
+    server = await loop.create_server(factory, HOST, unused_tcp_port)
+    try:
+        r, w = await asyncio.open_connection(HOST, unused_tcp_port)
+        w.write(b"\x05")
+        assert await asyncio.wait_for(r.read(8192), 1) == b""
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_connect_timeout(blackhole, unused_tcp_port_factory):
+    loop = asyncio.get_running_loop()
+    host, port = blackhole(unused_tcp_port_factory())
+    socks_server_port = unused_tcp_port_factory()
+    factory = functools.partial(SocksServerProtocol, connect_timeout=0.1)
+    server = await loop.create_server(factory, HOST, socks_server_port)
+    try:
+        with pytest.raises(SocksException):
+            await asyncio.wait_for(
+                open_connection(host, port, socks_host=HOST, socks_port=socks_server_port, socks_version=5), 1
+            )
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_idle_timeout(endpoint_port, unused_tcp_port):
+    loop = asyncio.get_running_loop()
+    factory = functools.partial(SocksServerProtocol, idle_timeout=0.2)
+    server = await loop.create_server(factory, HOST, unused_tcp_port)
+    try:
+        r, w = await open_connection(HOST, endpoint_port, socks_host=HOST, socks_port=unused_tcp_port, socks_version=5)
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        await asyncio.sleep(0.1)
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        assert await asyncio.wait_for(r.read(8192), 1) == b""
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_max_connections_per_ip(endpoint_port, unused_tcp_port):
+    loop = asyncio.get_running_loop()
+    limits = ServerLimits(max_connections_per_ip=1)
+    server = await loop.create_server(functools.partial(SocksServerProtocol, limits=limits), HOST, unused_tcp_port)
+    kw = dict(socks_host=HOST, socks_port=unused_tcp_port, socks_version=5)
+    try:
+        r, w = await open_connection(HOST, endpoint_port, **kw)
+        with pytest.raises(SocksException, match="0x02"):
+            await open_connection(HOST, endpoint_port, **kw)
+        w.close()
+        for _ in range(100):
+            if not limits.connections:
+                break
+            await asyncio.sleep(0.01)
+        r, w = await open_connection(HOST, endpoint_port, **kw)
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_rejected_connections_bounded(endpoint_port, unused_tcp_port):
+    loop = asyncio.get_running_loop()
+    limits = ServerLimits(max_connections=1, max_rejecting=1, rejection_timeout=0.2)
+    server = await loop.create_server(functools.partial(SocksServerProtocol, limits=limits), HOST, unused_tcp_port)
+    kw = dict(socks_host=HOST, socks_port=unused_tcp_port, socks_version=5)
+    try:
+        r, w = await open_connection(HOST, endpoint_port, **kw)
+        idle = [await asyncio.open_connection(HOST, unused_tcp_port) for _ in range(10)]
+        await asyncio.sleep(0.05)
+        assert limits.rejecting == 1
+        for ir, iw in idle:
+            assert await asyncio.wait_for(ir.read(8192), 1) == b""
+            iw.close()
+        assert limits.rejecting == 0
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_max_connecting(endpoint_port, blackhole, unused_tcp_port_factory):
+    loop = asyncio.get_running_loop()
+    limits = ServerLimits(max_connecting=1)
+    socks_server_port = unused_tcp_port_factory()
+    server = await loop.create_server(functools.partial(SocksServerProtocol, limits=limits), HOST, socks_server_port)
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    hanging = asyncio.ensure_future(open_connection(*blackhole(unused_tcp_port_factory()), **kw))
+    try:
+        for _ in range(100):
+            if limits.connecting:
+                break
+            await asyncio.sleep(0.01)
+        with pytest.raises(SocksException, match="0x02"):
+            await open_connection(HOST, endpoint_port, **kw)
+    finally:
+        hanging.cancel()
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_early_data(endpoint_port, unused_tcp_port):
+    loop = asyncio.get_running_loop()
+    factory = functools.partial(SocksServerProtocol, allowed_versions={5}, username="yoba", password="foo")
+    server = await loop.create_server(factory, HOST, unused_tcp_port)
+    try:
+        r, w = await open_connection(
+            HOST,
+            endpoint_port,
+            socks_host=HOST,
+            socks_port=unused_tcp_port,
+            socks_version=5,
+            username="yoba",
+            password="foo",
+            optimistic=True,
+            early_data=MESSAGE,
+        )
+        assert await r.read(8192) == MESSAGE
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_socket_options(endpoint_port, unused_tcp_port, socket_options):
+    loop = asyncio.get_running_loop()
+    factory = functools.partial(SocksServerProtocol, socket_options=socket_options)
+    server = await loop.create_server(factory, HOST, unused_tcp_port)
+    try:
+        r, w = await open_connection(HOST, endpoint_port, socks_host=HOST, socks_port=unused_tcp_port, socks_version=5)
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+    assert sorted(kind for kind, _ in socket_options.tuned) == ["connection", "outgoing"]
+    assert all(keepalive for _, keepalive in socket_options.tuned)
+
+
+@pytest.mark.asyncio
+async def test_source_addresses(peer_port, unused_tcp_port, source_addresses):
+    loop = asyncio.get_running_loop()
+    factory = functools.partial(SocksServerProtocol, source_addresses=source_addresses)
+    server = await loop.create_server(factory, HOST, unused_tcp_port)
+    peers = []
+    try:
+        for _ in range(2):
+            r, w = await open_connection(HOST, peer_port, socks_host=HOST, socks_port=unused_tcp_port, socks_version=5)
+            peers.append(await asyncio.wait_for(r.read(), 1))
+            w.close()
+        for _ in range(100):
+            if not any(source_addresses.active.values()):
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        server.close()
+        await server.wait_closed()
+    assert peers == [b"127.0.0.3", b"127.0.0.4"]
+    assert source_addresses.active == {"127.0.0.3": 0, "127.0.0.4": 0}
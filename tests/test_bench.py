@@ -0,0 +1,40 @@
+import pytest
+
+from siosocks.bench.protocol import VARIANTS, handshake, main, measure, profile
+from siosocks.protocol import SocksClient, SocksServer
+
+
+@pytest.mark.parametrize("name", sorted(VARIANTS))
+def test_handshake(name):
+    client_factory, server_factory = VARIANTS[name]
+    client, server = handshake(client_factory(), server_factory())
+    assert client.done and server.done
+    assert client.messages["passthrough"] == server.messages["passthrough"] == 1
+    assert server.messages["connect"] == 1
+
+
+def test_handshake_stalled():
+    with pytest.raises(RuntimeError):
+        handshake(SocksServer(), SocksServer())
+
+
+def test_profile_is_deterministic():
+    factories = VARIANTS["socks5-auth"]
+    assert profile(*factories) == profile(*factories)
+    result = profile(*factories)
+    assert result["client"]["written"] > 0
+    assert result["server"]["steps"] > result["server"]["messages"]["read"]
+
+
+def test_measure():
+    result = measure(lambda: SocksClient("127.0.0.1", 666, 4), SocksServer, number=10, repeat=1, memory_number=5)
+    assert result["handshakes_per_s"] > 0
+    assert result["peak_bytes"] > 0
+
+
+def test_main(tmp_path, capsys):
+    path = tmp_path / "result.json"
+    results = main(["-n", "5", "--repeat", "1", "--memory-number", "1", "--variant", "socks4", "--json", str(path)])
+    assert set(results) == {"socks4"}
+    assert path.exists()
+    assert "socks4" in capsys.readouterr().out
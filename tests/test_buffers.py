@@ -0,0 +1,47 @@
+import pytest
+
+from siosocks.buffers import BlockSize, BufferPool
+
+
+def test_block_size_fixed():
+    block = BlockSize(1024)
+    block.update(1024)
+    assert block.size == 1024
+    block.update(1)
+    assert block.size == 1024
+
+
+def test_block_size_adaptive():
+    block = BlockSize(1024, 5000)
+    sizes = []
+    for _ in range(4):
+        block.update(block.size)
+        sizes.append(block.size)
+    assert sizes == [2048, 4096, 5000, 5000]
+    # read between quarter and whole block keeps size
+    block.update(2000)
+    assert block.size == 5000
+    for _ in range(4):
+        block.update(10)
+        sizes.append(block.size)
+    assert sizes[4:] == [2500, 1250, 1024, 1024]
+
+
+@pytest.mark.parametrize("size, maximum", [(0, None), (-1, 10), (10, 5)])
+def test_block_size_bad_values(size, maximum):
+    with pytest.raises(ValueError):
+        BlockSize(size, maximum)
+
+
+def test_buffer_pool():
+    pool = BufferPool(size=1, buffer_size=16)
+    a = pool.acquire()
+    b = pool.acquire()
+    assert len(a) == len(b) == 16
+    assert (pool.hits, pool.misses) == (0, 2)
+    pool.release(a)
+    pool.release(b)
+    # only `size` buffers are kept
+    assert len(pool) == 1
+    assert pool.acquire() is a
+    assert (pool.hits, pool.misses) == (1, 2)
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+
+from siosocks.exceptions import SocksException
+from siosocks.interface import AbstractSocksIO, EngineHooks, async_engine, log_failure, sync_engine
+from siosocks.sansio import SansIORW
+
+
+class IO(AbstractSocksIO):
+    def __init__(self, *data):
+        self.incoming = list(data)
+        self.calls = []
+
+    def read(self):
+        self.calls.append(("read",))
+        return self.incoming.pop(0)
+
+    def write(self, data):
+        self.calls.append(("write", data))
+
+    def connect(self, host, port):
+        self.calls.append(("connect", host, port))
+
+    def passthrough(self):
+        self.calls.append(("passthrough",))
+
+
+def test_sync_engine_messages():
+    def protocol():
+        io = SansIORW(encoding="utf-8")
+        data = yield from io.read_exactly(3)
+        yield from io.write(data)
+        yield from io.connect("foo", 1)
+        yield from io.passthrough()
+
+    io = IO(b"bar")
+    sync_engine(protocol(), io)
+    assert io.calls == [("read",), ("write", b"bar"), ("connect", "foo", 1), ("passthrough",)]
+
+
+def test_sync_engine_legacy_dict_messages():
+    def protocol():
+        data = yield dict(method="read")
+        yield dict(method="write", data=data)
+        yield dict(method="connect", host="foo", port=1)
+        yield dict(method="passthrough")
+
+    io = IO(b"bar")
+    sync_engine(protocol(), io)
+    assert io.calls == [("read",), ("write", b"bar"), ("connect", "foo", 1), ("passthrough",)]
+
+
+class Recorder(EngineHooks):
+    def __init__(self):
+        self.events = []
+
+    def read(self, started, finished, data):
+        assert started <= finished
+        self.events.append(("read", data))
+
+    def write(self, started, finished, size):
+        assert started <= finished
+        self.events.append(("write", size))
+
+    def connect(self, started, finished, host, port, exc):
+        assert started <= finished
+        self.events.append(("connect", host, port, type(exc)))
+
+    def passthrough_started(self, timestamp):
+        self.events.append(("passthrough_started",))
+
+    def passthrough_finished(self, timestamp, transferred):
+        self.events.append(("passthrough_finished", transferred))
+
+
+def hooked_protocol():
+    io = SansIORW(encoding="utf-8")
+    data = yield from io.read_exactly(3)
+    yield from io.write(data)
+    try:
+        yield from io.connect("foo", 1)
+    except ConnectionRefusedError:
+        yield from io.connect("foo", 2)
+    yield from io.passthrough()
+
+
+class FailingIO(IO):
+    def connect(self, host, port):
+        super().connect(host, port)
+        if port == 1:
+            raise ConnectionRefusedError
+
+    def passthrough(self):
+        super().passthrough()
+        return 3, 4
+
+
+EXPECTED_EVENTS = [
+    ("read", b"bar"),
+    ("write", 3),
+    ("connect", "foo", 1, ConnectionRefusedError),
+    ("connect", "foo", 2, type(None)),
+    ("passthrough_started",),
+    ("passthrough_finished", (3, 4)),
+]
+
+
+def test_sync_engine_hooks():
+    hooks = Recorder()
+    io = FailingIO(b"bar")
+    sync_engine(hooked_protocol(), io, hooks=hooks)
+    assert hooks.events == EXPECTED_EVENTS
+    assert io.calls[-1] == ("passthrough",)
+
+
+def test_async_engine_hooks():
+    class AsyncIO:
+        def __init__(self, io):
+            self.io = io
+
+        def __getattr__(self, name):
+            async def method(*args):
+                return getattr(self.io, name)(*args)
+
+            return method
+
+    hooks = Recorder()
+    asyncio.run(async_engine(hooked_protocol(), AsyncIO(FailingIO(b"bar")), hooks=hooks))
+    assert hooks.events == EXPECTED_EVENTS
+
+
+def test_default_hooks_do_nothing():
+    sync_engine(hooked_protocol(), FailingIO(b"bar"), hooks=EngineHooks())
+
+
+def test_log_failure(caplog):
+    logger = logging.getLogger("siosocks.test")
+    with caplog.at_level(logging.DEBUG, logger="siosocks.test"):
+        log_failure(logger, SocksException("bad version"))
+        log_failure(logger, ConnectionResetError())
+        log_failure(logger, RuntimeError("bug"))
+    levels = [(r.levelno, r.exc_info is not None) for r in caplog.records]
+    assert levels == [(logging.DEBUG, False), (logging.DEBUG, False), (logging.ERROR, True)]
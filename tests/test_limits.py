@@ -0,0 +1,82 @@
+import pytest
+
+from siosocks.exceptions import SocksLimitException
+from siosocks.limits import ServerLimits
+
+
+def test_max_connections():
+    limits = ServerLimits(max_connections=2)
+    a = limits.connection("127.0.0.1")
+    limits.connection("127.0.0.2")
+    assert limits.full()
+    with pytest.raises(SocksLimitException):
+        limits.connection("127.0.0.3")
+    a.close()
+    a.close()
+    assert not limits.full()
+    assert limits.connections == 1
+    limits.connection("127.0.0.3")
+
+
+def test_max_connections_per_ip():
+    limits = ServerLimits(max_connections_per_ip=1)
+    a = limits.connection("127.0.0.1")
+    limits.connection("127.0.0.2")
+    with pytest.raises(SocksLimitException):
+        limits.connection("127.0.0.1")
+    assert limits.connections == 2
+    a.close()
+    limits.connection("127.0.0.1")
+
+
+def test_max_connecting():
+    limits = ServerLimits(max_connecting=1)
+    a = limits.connection("127.0.0.1")
+    b = limits.connection("127.0.0.1")
+    a.connect()
+    with pytest.raises(SocksLimitException):
+        b.connect()
+    b.connected()
+    assert limits.connecting == 1
+    a.connected()
+    b.connect()
+    b.close()
+    assert limits.connecting == 0
+    assert limits.connections == 1
+
+
+def test_no_limits():
+    limits = ServerLimits()
+    connections = [limits.connection("127.0.0.1") for _ in range(100)]
+    for connection in connections:
+        connection.connect()
+    assert not limits.full()
+    for connection in connections:
+        connection.close()
+    assert limits.connections == limits.connecting == 0
+
+
+def test_admit_rejected():
+    limits = ServerLimits(max_connections=1, max_rejecting=1, rejection_timeout=2)
+    accepted, rejection = limits.admit("127.0.0.1")
+    assert rejection is None
+    rejected, rejection = limits.admit("127.0.0.2")
+    assert isinstance(rejection, SocksLimitException)
+    with pytest.raises(SocksLimitException, match="Connections limit"):
+        rejected.connect()
+    assert limits.connections == limits.rejecting == 1
+    with pytest.raises(SocksLimitException, match="Rejected connections limit"):
+        limits.admit("127.0.0.3")
+    rejected.close()
+    rejected.close()
+    assert limits.rejecting == 0
+    limits.admit("127.0.0.3")[0].close()
+    accepted.close()
+    assert limits.connections == limits.rejecting == 0
+
+
+def test_rejected_handshake_timeout():
+    limits = ServerLimits(rejection_timeout=2)
+    assert limits.handshake_timeout(None) == 2
+    assert limits.handshake_timeout(1) == 1
+    assert limits.handshake_timeout(10) == 2
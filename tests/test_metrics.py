@@ -0,0 +1,173 @@
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from siosocks.buffers import BufferPool
+from siosocks.exceptions import SocksAuthException, SocksException
+from siosocks.metrics import (
+    OTHER_DESTINATION,
+    TRANSFERRED_BATCH_SIZE,
+    Counter,
+    Gauge,
+    Histogram,
+    ServerMetrics,
+    start_http_server,
+)
+
+
+def test_counter():
+    c = Counter("requests_total", "Requests", ["method"])
+    c.inc(method="get")
+    c.inc(2, method="get")
+    c.inc(method='p"o\\st')
+    assert c.value(method="get") == 3
+    assert c.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{method="get"} 3',
+        'requests_total{method="p\\"o\\\\st"} 1',
+    ]
+
+
+def test_counter_without_labels_rendered_as_zero():
+    assert Counter("x_total", "X").render().splitlines()[-1] == "x_total 0"
+
+
+def test_wrong_labels():
+    c = Counter("x_total", "X", ["a"])
+    with pytest.raises(ValueError):
+        c.inc(b=1)
+    with pytest.raises(ValueError):
+        c.inc()
+
+
+def test_gauge():
+    g = Gauge("active", "Active")
+    g.inc()
+    g.inc()
+    g.dec()
+    assert g.value() == 1
+    assert "# TYPE active gauge" in g.render()
+
+
+def test_histogram():
+    h = Histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    h.observe(0.05)
+    h.observe(0.1)
+    h.observe(0.5)
+    h.observe(5)
+    assert h.count() == 4
+    assert h.render().splitlines()[2:] == [
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 5.65",
+        "latency_seconds_count 4",
+    ]
+
+
+def test_histogram_concurrent_observe():
+    h = Histogram("x_seconds", "X")
+
+    def observe():
+        for _ in range(1000):
+            h.observe(0.01)
+
+    threads = [threading.Thread(target=observe) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert h.count() == 4000
+
+
+def test_destinations_limit():
+    m = ServerMetrics(max_destinations=2)
+    assert m.destination("a", 1) == "a:1"
+    assert m.destination("b", 1) == "b:1"
+    assert m.destination("c", 1) == OTHER_DESTINATION
+    assert m.destination("a", 1) == "a:1"
+
+
+def test_connection_lifecycle():
+    m = ServerMetrics()
+    c = m.connection()
+    c.received(b"\x05\x01\x00")
+    c.received(b"\x04")
+    c.connect("python.org", 443)
+    c.connected()
+    c.passthrough()
+    assert m.active_tunnels.value() == 1
+    c.transferred("up", 10)
+    c.transferred("down", 0)
+    c.close()
+    c.close()
+    assert m.accepted.value() == 1
+    assert m.handshake_seconds.count(version=5) == 1
+    assert m.connect_seconds.count(destination="python.org:443") == 1
+    assert m.active_tunnels.value() == 0
+    assert m.transferred.value(direction="up") == 10
+    assert m.transferred.value(direction="down") == 0
+
+
+def test_transferred_batches(monkeypatch):
+    m = ServerMetrics()
+    c = m.connection()
+    c.transferred("up", 10)
+    assert m.transferred.value(direction="up") == 0
+    c.transferred("up", TRANSFERRED_BATCH_SIZE)
+    assert m.transferred.value(direction="up") == TRANSFERRED_BATCH_SIZE + 10
+    c.transferred("down", 5)
+    monkeypatch.setattr("siosocks.metrics.TRANSFERRED_BATCH_INTERVAL", 0)
+    c.transferred("up", 1)
+    assert m.transferred.value(direction="up") == TRANSFERRED_BATCH_SIZE + 11
+    assert m.transferred.value(direction="down") == 5
+    c.transferred("down", 5)
+    c.close()
+    assert m.transferred.value(direction="down") == 10
+
+
+def test_connection_failures():
+    m = ServerMetrics()
+    c = m.connection()
+    c.connect("python.org", 443)
+    c.connected(ConnectionRefusedError())
+    c.failed(SocksException())
+    c.failed(SocksAuthException())
+    c.close()
+    assert m.connect_failures.value(destination="python.org:443") == 1
+    assert m.auth_failures.value() == 1
+    assert m.active_tunnels.value() == 0
+
+
+def test_http_server():
+    m = ServerMetrics()
+    m.connection()
+    server = start_http_server(m, 0, "127.0.0.1")
+    try:
+        _, port = server.server_address
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            body = response.read().decode()
+        assert "siosocks_accepted_connections_total 1\n" in body
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_buffer_pool():
+    metrics = ServerMetrics()
+    pool = BufferPool(size=2)
+    metrics.track_buffer_pool(pool)
+    pool.release(pool.acquire())
+    pool.acquire()
+    pool.acquire()
+    text = metrics.render()
+    assert "# TYPE siosocks_buffer_pool_requests_total counter" in text
+    assert 'siosocks_buffer_pool_requests_total{result="hit"} 1' in text
+    assert 'siosocks_buffer_pool_requests_total{result="miss"} 2' in text
+    assert "siosocks_buffer_pool_idle_buffers 0" in text
@@ -3,9 +3,9 @@ import contextlib
 
 import pytest
 
-from siosocks.exceptions import SocksException
-from siosocks.protocol import SocksClient, SocksServer
-from siosocks.sansio import SansIORW
+from siosocks.exceptions import SocksException, SocksLimitException
+from siosocks.protocol import SocksClient, SocksClientGreeting, SocksServer
+from siosocks.sansio import PASSTHROUGH, READ, Connect, Passthrough, SansIORW, Write
 
 
 class ConnectionFailed(Exception):
@@ -24,10 +24,10 @@ class Node:
         while True:
             request = gen_method(self.receive.pop(0))
             gen_method = self.generator.send
-            method = request.pop("method")
+            method = request.method
             self.calls[method] += 1
             if method == "write":
-                data = request["data"]
+                data = request.data
                 if data:
                     self.send.append(data)
                 self.receive.append(None)
@@ -223,6 +223,56 @@ def test_server_socks4_connect_failed():
         rotor(client(), SocksServer(), fail_connection=True)
 
 
+def rejected(data, at_connect=False, **kwargs):
+    # rejected on accept, or `at_connect` by outgoing connections limit
+    server = SocksServer(**kwargs) if at_connect else SocksServer(rejection=SocksLimitException("limit"), **kwargs)
+    written = []
+    value = None
+    with pytest.raises(SocksLimitException):
+        while True:
+            request = server.send(value)
+            value = None
+            if request.method == "write":
+                written.append(request.data)
+            elif request.method == "read":
+                assert data, "server waits for more data"
+                value, data = data, b""
+            elif request.method == "connect" and at_connect:
+                request = server.throw(SocksLimitException("limit"))
+                assert request.method == "write"
+                written.append(request.data)
+            else:
+                raise AssertionError(f"Unexpected method {request.method}")
+    return b"".join(written)
+
+
+def test_server_socks4_rejected():
+    assert rejected(b"\x04\x01\x00\x7b\x7f\x00\x00\x01yoba\x00") == b"\x00\x5b\x00\x00\x00\x00\x00\x00"
+
+
+def test_server_socks5_rejected():
+    request = b"\x05\x01\x00" + b"\x05\x01\x00\x01\x7f\x00\x00\x01\x00\x7b"
+    reply = b"\x05\x00" + b"\x05\x02\x00\x01\x00\x00\x00\x00\x00\x00"
+    assert rejected(request) == reply
+
+
+def test_server_socks5_rejected_after_auth():
+    request = b"\x05\x01\x02" + b"\x01\x04yoba\x03foo" + b"\x05\x01\x00\x01\x7f\x00\x00\x01\x00\x7b"
+    reply = b"\x05\x02" + b"\x01\x00" + b"\x05\x02\x00\x01\x00\x00\x00\x00\x00\x00"
+    assert rejected(request, username="yoba", password="foo", allowed_versions={5}) == reply
+
+
+def test_server_socks4_connect_limit():
+    request = b"\x04\x01\x00\x7b\x7f\x00\x00\x01yoba\x00"
+    assert rejected(request, at_connect=True) == b"\x00\x5b\x00\x00\x00\x00\x00\x00"
+
+
+def test_server_socks5_connect_limit():
+    request = b"\x05\x01\x00" + b"\x05\x01\x00\x01\x7f\x00\x00\x01\x00\x7b"
+    reply = b"\x05\x00" + b"\x05\x02\x00\x01\x00\x00\x00\x00\x00\x00"
+    assert rejected(request, at_connect=True) == reply
+
+
 def test_server_socks4_success_by_ipv4():
     def client():
         io = SansIORW(encoding="utf-8")
@@ -599,3 +649,85 @@ def test_server_socks5_connection_domain_success():
         yield from io.passthrough()
 
     rotor(client(), SocksServer())
+
+
+def test_client_socks4_request_coalesced():
+    protocol = SocksClient("python.org", 123, 4, socks4_extras=dict(user_id="yoba"))
+    request = next(protocol)
+    assert request == Write(b"\x04\x01\x00\x7b\x00\x00\x00\xffyoba\x00python.org\x00")
+    assert protocol.send(None) == READ
+
+
+def test_server_error_response_flushed():
+    protocol = SocksServer()
+    assert next(protocol) == READ
+    assert protocol.send(b"\x05\x01\x02") == Write(b"\x05\xff")
+    with pytest.raises(SocksException):
+        protocol.send(None)
+
+
+@pytest.mark.parametrize("version", [4, 5])
+def test_client_greeting_then_request(version):
+    auth = dict(username="yoba", password="foo") if version == 5 else {}
+
+    def client():
+        yield from SocksClientGreeting(version, **auth)
+        yield from SocksClient("python.org", 80, version, greeting=False, **auth)
+
+    rotor(client(), SocksServer(allowed_versions={version}, **auth))
+
+
+def test_client_greeting_socks5_request_only():
+    protocol = SocksClient("python.org", 80, 5, greeting=False)
+    assert next(protocol) == Write(b"\x05\x01\x00\x03\x0apython.org\x00\x50")
+
+
+def test_client_greeting_bad_version():
+    with pytest.raises(SocksException):
+        next(SocksClientGreeting(6))
+    with pytest.raises(SocksException):
+        next(SocksClientGreeting(4, username="yoba"))
+
+
+def test_client_socks5_optimistic_one_flight():
+    protocol = SocksClient("python.org", 80, 5, username="yoba", password="foo", optimistic=True, early_data=b"hello")
+    request = next(protocol)
+    assert request == Write(b"\x05\x01\x02" + b"\x01\x04yoba\x03foo" + b"\x05\x01\x00\x03\x0apython.org\x00\x50hello")
+    assert protocol.send(None) == READ
+    response = b"\x05\x02" + b"\x01\x00" + b"\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00" + b"world"
+    assert protocol.send(response) == Passthrough(b"world")
+
+
+def test_client_socks5_optimistic_auth_not_accepted():
+    protocol = SocksClient("python.org", 80, 5, username="yoba", password="foo", optimistic=True)
+    next(protocol)
+    assert protocol.send(None) == READ
+    with pytest.raises(SocksException):
+        protocol.send(b"\x05\xff")
+
+
+@pytest.mark.parametrize("optimistic", [False, True])
+@pytest.mark.parametrize("version", [4, 5])
+def test_client_optimistic_rotor(version, optimistic):
+    auth = dict(username="yoba", password="foo") if version == 5 else {}
+    client = SocksClient("python.org", 80, version, optimistic=optimistic, early_data=b"hello", **auth)
+    rotor(client, SocksServer(allowed_versions={version}, **auth))
+
+
+def test_server_pipelined_request():
+    protocol = SocksServer(allowed_versions={5}, username="yoba", password="foo")
+    assert next(protocol) == READ
+    request = b"\x05\x01\x02" + b"\x01\x04yoba\x03foo" + b"\x05\x01\x00\x03\x0apython.org\x00\x50hello"
+    assert protocol.send(request) == Write(b"\x05\x02\x01\x00")
+    assert protocol.send(None) == Connect("python.org", 80)
+    assert protocol.send(None) == Write(b"\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00")
+    assert protocol.send(None) == Passthrough(b"hello")
+
+
+def test_server_passthrough_without_leftover():
+    protocol = SocksServer()
+    next(protocol)
+    protocol.send(b"\x05\x01\x00\x05\x01\x00\x01\x7f\x00\x00\x01\x00\x50")
+    protocol.send(None)
+    protocol.send(None)
+    assert protocol.send(None) is PASSTHROUGH
@@ -0,0 +1,81 @@
+import socket
+
+import pytest
+
+from siosocks import resolver
+from siosocks.resolver import ResolverCache, interleave, is_ip_address, numeric_infos, with_port
+
+INFOS = [
+    (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", 0)),
+    (socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("::1", 0, 0, 0)),
+]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(resolver.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_cache_ttl(clock):
+    cache = ResolverCache(ttl=10)
+    assert cache.get("python.org") is None
+    cache.set("python.org", INFOS)
+    clock[0] += 9
+    assert cache.get("python.org") == INFOS
+    clock[0] += 1
+    assert cache.get("python.org") is None
+    assert len(cache) == 0
+
+
+def test_cache_negative_ttl(clock):
+    cache = ResolverCache(negative_ttl=1)
+    cache.set_error("python.org", socket.gaierror(socket.EAI_NONAME, "Name or service not known"))
+    with pytest.raises(socket.gaierror) as exc_info:
+        cache.get("python.org")
+    assert exc_info.value.args == (socket.EAI_NONAME, "Name or service not known")
+    clock[0] += 1
+    assert cache.get("python.org") is None
+
+
+def test_cache_lru(clock):
+    cache = ResolverCache(max_size=2)
+    cache.set("a", INFOS)
+    cache.set("b", INFOS)
+    assert cache.get("a") == INFOS
+    cache.set("c", INFOS)
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == INFOS
+    assert cache.get("c") == INFOS
+
+
+def test_cache_disabled(clock):
+    cache = ResolverCache(ttl=0, negative_ttl=0)
+    cache.set("a", INFOS)
+    cache.set_error("b", socket.gaierror())
+    assert len(cache) == 0
+
+
+def test_helpers():
+    assert is_ip_address("127.0.0.1")
+    assert is_ip_address("::1")
+    assert not is_ip_address("localhost")
+    assert with_port(INFOS, 666) == [
+        (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", 666)),
+        (socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("::1", 666, 0, 0)),
+    ]
+    [(family, *_, address)] = numeric_infos("127.0.0.1", 666)
+    assert family == socket.AF_INET
+    assert address == ("127.0.0.1", 666)
+    with pytest.raises(socket.gaierror):
+        numeric_infos("localhost", 666)
+
+
+def test_interleave():
+    v4 = [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (f"127.0.0.{i}", 0)) for i in range(3)]
+    v6 = [(socket.AF_INET6, socket.SOCK_STREAM, 6, "", (f"::{i}", 0, 0, 0)) for i in range(2)]
+    assert interleave(v6 + v4) == [v6[0], v4[0], v6[1], v4[1], v4[2]]
+    assert interleave(v4) == v4
+    assert interleave([]) == []
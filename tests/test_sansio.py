@@ -1,7 +1,7 @@
 import pytest
 
 from siosocks.exceptions import SocksException
-from siosocks.sansio import SansIORW
+from siosocks.sansio import READ, STRUCTS, Connect, SansIORW, Write, from_dict
 
 
 @pytest.fixture
@@ -32,8 +32,10 @@ def io():
                         request = method(data)
                     except StopIteration as e:
                         return e.value
+                    if isinstance(request, Write):
+                        data = self.write(request.data)
                     else:
-                        data = getattr(self, request.pop("method"))(**request)
+                        data = self.read()
 
             return wrapper
 
@@ -98,16 +100,65 @@ def test_write(io):
 
 def test_write_struct(io):
     io.write_struct("3B", 1, 2, 3)
+    assert io.buffer == []
+    io.flush()
     assert io.buffer == [b"\x01\x02\x03"]
 
 
 def test_write_c_string(io):
     io.write_c_string("foobar")
-    assert io.buffer == [b"foobar", b"\x00"]
+    io.flush()
+    assert io.buffer == [b"foobar\x00"]
 
 
 def test_write_pascal_string(io):
     io.write_pascal_string("foobar")
-    assert io.buffer == [b"\x06", b"foobar"]
+    io.flush()
+    assert io.buffer == [b"\x06foobar"]
     with pytest.raises(SocksException):
         io.write_pascal_string("x" * 256)
+
+
+def test_writes_coalesced_until_read(io):
+    io.write_c_string("foo")
+    io.write_pascal_string("bar")
+    assert io.buffer == []
+    # fake io reads back written data, so whole flushed message is received as one chunk
+    assert io.read_exactly(1) == b"f"
+    assert io.buffer == []
+    assert io.read_exactly(7) == b"oo\x00\x03bar"
+    io.flush()
+    assert io.buffer == []
+
+
+def test_read_until_delimiter_split_between_chunks(io):
+    io.set(b"foo\r", b"\nbar", b"\r\n")
+    assert io.read_until(b"\r\n") == b"foo"
+    assert io.read_exactly(2) == b"\r\n"
+    assert io.read_until(b"\r\n") == b"bar"
+
+
+def test_read_buffer_reused_after_consume(io):
+    io.set(b"\x01\x02", b"\x03", b"\x04\x05")
+    assert io.read_struct("B") == 1
+    assert io.read_exactly(2) == b"\x02\x03"
+    assert io.read_struct("H") == 0x0405
+    assert io.io._offset == len(io.io._buffer)
+    io.set(b"\x06")
+    assert io.read_exactly(1) == b"\x06"
+    assert io.io._buffer == b"\x06"
+
+
+def test_struct_cache():
+    assert STRUCTS["BBH4s"] is STRUCTS["BBH4s"]
+    assert STRUCTS["BBH4s"].format == "!BBH4s"
+
+
+def test_messages():
+    assert Write(b"foo") == Write(b"foo")
+    assert Write(b"foo") != Write(b"bar")
+    assert Connect("foo", 1) != Write(b"foo")
+    assert repr(Connect("foo", 1)) == "Connect(host='foo', port=1)"
+    assert from_dict(dict(method="read")) is not READ
+    assert from_dict(dict(method="read")) == READ
+    assert from_dict(dict(method="connect", host="foo", port=1)) == Connect("foo", 1)
@@ -0,0 +1,435 @@
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+import pytest_asyncio
+
+from siosocks.buffers import BufferPool
+from siosocks.exceptions import SocksException
+from siosocks.io.asyncio import open_connection
+from siosocks.io.selector import SelectorServer
+from siosocks.limits import ServerLimits
+from siosocks.metrics import ServerMetrics
+
+HOST = "127.0.0.1"
+MESSAGE = b"socks work!"
+PAYLOAD = bytes(range(256)) * 2**14
+
+
+@pytest_asyncio.fixture
+async def endpoint_port(unused_tcp_port_factory):
+    port = unused_tcp_port_factory()
+
+    async def handler(r, w):
+        while True:
+            b = await r.read(8192)
+            if not b:
+                break
+            w.write(b)
+            await w.drain()
+        w.close()
+
+    server = await asyncio.start_server(handler, HOST, port)
+    yield port
+    server.close()
+    await server.wait_closed()
+
+
+@pytest_asyncio.fixture(
+    params=[(0, False), (2, False), (0, True)],
+    ids=["non-blocking-connect", "connect-workers", "splice"],
+)
+async def socks_server_port(request):
+    connect_workers, splice = request.param
+    server = SelectorServer((HOST, 0), connect_workers=connect_workers, io_kw=dict(splice=splice))
+    thread = threading.Thread(target=server.serve_forever, args=[0.01])
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("socks_version", [4, 5])
+async def test_connection_socks_success(endpoint_port, socks_server_port, socks_version):
+    r, w = await open_connection(
+        HOST,
+        endpoint_port,
+        socks_host=HOST,
+        socks_port=socks_server_port,
+        socks_version=socks_version,
+    )
+    w.write(MESSAGE)
+    m = await r.read(8192)
+    assert m == MESSAGE
+    w.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_socks_domain(endpoint_port, socks_server_port):
+    r, w = await open_connection(
+        "localhost",
+        endpoint_port,
+        socks_host=HOST,
+        socks_port=socks_server_port,
+        socks_version=5,
+    )
+    w.write(MESSAGE)
+    m = await r.read(8192)
+    assert m == MESSAGE
+    w.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_socks_failed(socks_server_port, unused_tcp_port):
+    with pytest.raises(SocksException):
+        await open_connection(
+            HOST,
+            unused_tcp_port,
+            socks_host=HOST,
+            socks_port=socks_server_port,
+            socks_version=5,
+        )
+
+
+@pytest.mark.asyncio
+async def test_connection_socks_bulk(endpoint_port, socks_server_port):
+    r, w = await open_connection(
+        HOST,
+        endpoint_port,
+        socks_host=HOST,
+        socks_port=socks_server_port,
+        socks_version=5,
+    )
+
+    async def send():
+        w.write(PAYLOAD)
+        await w.drain()
+        w.write_eof()
+
+    _, m = await asyncio.wait_for(asyncio.gather(send(), r.read()), timeout=5)
+    assert m == PAYLOAD
+
+
+@pytest.mark.asyncio
+async def test_many_connections(endpoint_port, socks_server_port):
+    async def echo(i):
+        r, w = await open_connection(
+            HOST,
+            endpoint_port,
+            socks_host=HOST,
+            socks_port=socks_server_port,
+            socks_version=5,
+        )
+        message = str(i).encode()
+        w.write(message)
+        w.write_eof()
+        assert await r.read() == message
+        w.close()
+
+    await asyncio.wait_for(asyncio.gather(*map(echo, range(100))), timeout=5)
+
+
+@pytest.mark.asyncio
+async def test_metrics(endpoint_port, unused_tcp_port_factory):
+    metrics = ServerMetrics()
+    server = SelectorServer((HOST, 0), metrics=metrics)
+    thread = threading.Thread(target=server.serve_forever, args=[0.01])
+    thread.start()
+    socks_server_port = server.server_address[1]
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    try:
+        r, w = await open_connection(HOST, endpoint_port, **kw)
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+        failed_port = unused_tcp_port_factory()
+        with pytest.raises(SocksException):
+            await open_connection(HOST, failed_port, **kw)
+        for _ in range(100):
+            if metrics.transferred.value(direction="down"):
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+    assert metrics.accepted.value() == 2
+    assert metrics.handshake_seconds.count(version=5) == 1
+    assert metrics.connect_seconds.count(destination=f"{HOST}:{endpoint_port}") == 1
+    assert metrics.connect_failures.value(destination=f"{HOST}:{failed_port}") == 1
+    assert metrics.active_tunnels.value() == 0
+    assert metrics.transferred.value(direction="up") == len(MESSAGE)
+    assert metrics.transferred.value(direction="down") == len(MESSAGE)
+
+
+@pytest.mark.asyncio
+async def test_hooks(endpoint_port, unused_tcp_port_factory, hooks):
+    server = SelectorServer((HOST, 0), hooks_factory=lambda: hooks)
+    thread = threading.Thread(target=server.serve_forever, args=[0.01])
+    thread.start()
+    socks_server_port = server.server_address[1]
+    try:
+        r, w = await open_connection(
+            HOST, endpoint_port, socks_host=HOST, socks_port=socks_server_port, socks_version=4
+        )
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+        for _ in range(100):
+            if len(hooks.events) == 5:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+    assert hooks.events == [
+        "read",
+        "connect",
+        "write",
+        "passthrough_started",
+        ("passthrough_finished", (len(MESSAGE), len(MESSAGE))),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_happy_eyeballs(endpoint_port, socks_server_port, dual_addresses, monkeypatch):
+    getaddrinfo = socket.getaddrinfo
+    infos = dual_addresses(endpoint_port)
+
+    def fake_getaddrinfo(host, *args, **kwargs):
+        return infos if host == "destination.test" else getaddrinfo(host, *args, **kwargs)
+
+    monkeypatch.setattr(socket, "getaddrinfo", fake_getaddrinfo)
+    started = time.monotonic()
+    r, w = await open_connection(
+        "destination.test", endpoint_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5
+    )
+    w.write(MESSAGE)
+    assert await r.read(8192) == MESSAGE
+    assert time.monotonic() - started < 1
+    w.close()
+
+
+def test_call_later():
+    server = SelectorServer((HOST, 0))
+    calls = []
+    server.call_later(0.02, calls.append, 2)
+    server.call_later(0.01, calls.append, 1)
+    server.call_later(0.01, calls.append, 0).cancel()
+    with server:
+        thread = threading.Thread(target=server.serve_forever, args=[10])
+        thread.start()
+        time.sleep(0.1)
+        server.shutdown()
+        thread.join()
+    assert calls == [1, 2]
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def factory(connect_workers=0, limits=None, buffer_pool=None, **io_kw):
+        server = SelectorServer(
+            (HOST, 0), connect_workers=connect_workers, io_kw=io_kw, limits=limits, buffer_pool=buffer_pool
+        )
+        thread = threading.Thread(target=server.serve_forever, args=[0.01])
+        thread.start()
+        servers.append((server, thread))
+        return server.server_address[1]
+
+    yield factory
+    for server, thread in servers:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+@pytest.mark.asyncio
+async def test_slow_resolver_does_not_block_loop(serve, endpoint_port, monkeypatch):
+    getaddrinfo = socket.getaddrinfo
+
+    def slow_getaddrinfo(host, *args, **kwargs):
+        if host == "slow.test":
+            time.sleep(0.5)
+            host = HOST
+        return getaddrinfo(host, *args, **kwargs)
+
+    monkeypatch.setattr(socket, "getaddrinfo", slow_getaddrinfo)
+    kw = dict(socks_host=HOST, socks_port=serve(), socks_version=5)
+    r, w = await open_connection(HOST, endpoint_port, **kw)
+    slow = asyncio.ensure_future(open_connection("slow.test", endpoint_port, **kw))
+    await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    w.write(MESSAGE)
+    assert await asyncio.wait_for(r.read(8192), 1) == MESSAGE
+    assert time.perf_counter() - started < 0.3
+    w.close()
+    r, w = await slow
+    w.write(MESSAGE)
+    assert await asyncio.wait_for(r.read(8192), 1) == MESSAGE
+    w.close()
+
+
+@pytest.mark.asyncio
+async def test_handshake_timeout(serve):
+    socks_server_port = serve(handshake_timeout=0.1)
+    r, w = await asyncio.open_connection(HOST, socks_server_port)
+    w.write(b"\x05")
+    assert await asyncio.wait_for(r.read(8192), 1) == b""
+    w.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("connect_workers", [0, 2], ids=["non-blocking-connect", "connect-workers"])
+async def test_connect_timeout(serve, blackhole, unused_tcp_port, connect_workers):
+    host, port = blackhole(unused_tcp_port)
+    socks_server_port = serve(connect_workers=connect_workers, connect_timeout=0.1)
+    with pytest.raises(SocksException):
+        await asyncio.wait_for(
+            open_connection(host, port, socks_host=HOST, socks_port=socks_server_port, socks_version=5), 1
+        )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("splice", [False, True], ids=["copy", "splice"])
+async def test_idle_timeout(serve, endpoint_port, splice):
+    socks_server_port = serve(splice=splice, idle_timeout=0.2)
+    r, w = await open_connection(HOST, endpoint_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    w.write(MESSAGE)
+    assert await r.read(8192) == MESSAGE
+    await asyncio.sleep(0.1)
+    w.write(MESSAGE)
+    assert await r.read(8192) == MESSAGE
+    assert await asyncio.wait_for(r.read(8192), 1) == b""
+    w.close()
+
+
+@pytest.mark.asyncio
+async def test_max_connections(serve, endpoint_port):
+    limits = ServerLimits(max_connections=1)
+    kw = dict(socks_host=HOST, socks_port=serve(limits=limits), socks_version=5)
+    r, w = await open_connection(HOST, endpoint_port, **kw)
+    # server stops accepting, next client waits in listen backlog
+    waiting = asyncio.ensure_future(open_connection(HOST, endpoint_port, **kw))
+    await asyncio.sleep(0.1)
+    assert not waiting.done()
+    w.close()
+    r, w = await asyncio.wait_for(waiting, 1)
+    w.write(MESSAGE)
+    assert await r.read(8192) == MESSAGE
+    w.close()
+
+
+@pytest.mark.asyncio
+async def test_max_connections_per_ip(serve, endpoint_port):
+    limits = ServerLimits(max_connections_per_ip=1)
+    kw = dict(socks_host=HOST, socks_port=serve(limits=limits), socks_version=5)
+    r, w = await open_connection(HOST, endpoint_port, **kw)
+    with pytest.raises(SocksException, match="0x02"):
+        await open_connection(HOST, endpoint_port, **kw)
+    w.close()
+    for _ in range(100):
+        if not limits.connections:
+            break
+        await asyncio.sleep(0.01)
+    r, w = await open_connection(HOST, endpoint_port, **kw)
+    w.write(MESSAGE)
+    assert await r.read(8192) == MESSAGE
+    w.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("connect_workers", [0, 2], ids=["non-blocking-connect", "connect-workers"])
+async def test_max_connecting(serve, endpoint_port, blackhole, unused_tcp_port, connect_workers):
+    limits = ServerLimits(max_connecting=1)
+    socks_server_port = serve(connect_workers=connect_workers, limits=limits, connect_timeout=1)
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    hanging = asyncio.ensure_future(open_connection(*blackhole(unused_tcp_port), **kw))
+    try:
+        for _ in range(100):
+            if limits.connecting:
+                break
+            await asyncio.sleep(0.01)
+        with pytest.raises(SocksException, match="0x02"):
+            await open_connection(HOST, endpoint_port, **kw)
+    finally:
+        hanging.cancel()
+
+
+@pytest.mark.asyncio
+async def test_early_data(endpoint_port, socks_server_port):
+    r, w = await open_connection(
+        HOST,
+        endpoint_port,
+        socks_host=HOST,
+        socks_port=socks_server_port,
+        socks_version=5,
+        optimistic=True,
+        early_data=MESSAGE,
+    )
+    assert await r.read(8192) == MESSAGE
+    w.write(MESSAGE)
+    assert await r.read(8192) == MESSAGE
+    w.close()
+
+
+@pytest.mark.asyncio
+async def test_adaptive_block_size(serve, endpoint_port):
+    socks_server_port = serve(block_size=1024, max_block_size=2**18)
+    r, w = await open_connection(HOST, endpoint_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    w.write(PAYLOAD)
+    w.write_eof()
+    assert await asyncio.wait_for(r.read(), 5) == PAYLOAD
+    w.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("max_block_size", [None, 2**18], ids=["fixed", "adaptive"])
+async def test_buffer_pool(serve, endpoint_port, max_block_size):
+    pool = BufferPool(size=4, buffer_size=2**16)
+    socks_server_port = serve(buffer_pool=pool, max_block_size=max_block_size)
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    for _ in range(2):
+        r, w = await open_connection(HOST, endpoint_port, **kw)
+        w.write(PAYLOAD)
+        w.write_eof()
+        assert await asyncio.wait_for(r.read(), 5) == PAYLOAD
+        w.close()
+    # buffers are returned after each sent chunk, so tunnels reuse few of them
+    assert pool.hits > 100
+    assert pool.misses <= 4
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("connect_workers", [0, 2], ids=["non-blocking-connect", "connect-workers"])
+async def test_socket_options(serve, endpoint_port, socket_options, connect_workers):
+    socks_server_port = serve(connect_workers=connect_workers, socket_options=socket_options)
+    r, w = await open_connection(HOST, endpoint_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    w.write(MESSAGE)
+    assert await asyncio.wait_for(r.read(8192), 1) == MESSAGE
+    w.close()
+    assert sorted(kind for kind, _ in socket_options.tuned) == ["connection", "outgoing"]
+    assert all(keepalive for _, keepalive in socket_options.tuned)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("connect_workers", [0, 2], ids=["non-blocking-connect", "connect-workers"])
+async def test_source_addresses(serve, peer_port, source_addresses, connect_workers):
+    socks_server_port = serve(connect_workers=connect_workers, source_addresses=source_addresses)
+    peers = []
+    for _ in range(2):
+        r, w = await open_connection(HOST, peer_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+        peers.append(await asyncio.wait_for(r.read(), 1))
+        w.close()
+    for _ in range(100):
+        if not any(source_addresses.active.values()):
+            break
+        await asyncio.sleep(0.01)
+    assert peers == [b"127.0.0.3", b"127.0.0.4"]
+    assert source_addresses.active == {"127.0.0.3": 0, "127.0.0.4": 0}
@@ -1,17 +1,24 @@
 import asyncio
+import selectors
+import socket
 import socketserver
 import threading
+import time
 from functools import partial
 
 import pytest
 import pytest_asyncio
 
+from siosocks.buffers import BufferPool
 from siosocks.exceptions import SocksException
 from siosocks.io.asyncio import open_connection
-from siosocks.io.socket import socks_server_handler
+from siosocks.io.socket import CopyRelay, Tunnel, create_connection, socks_server_handler
+from siosocks.limits import ServerLimits
+from siosocks.metrics import TRANSFERRED_BATCH_SIZE, ServerMetrics
 
 HOST = "127.0.0.1"
 MESSAGE = b"socks work!"
+PAYLOAD = bytes(range(256)) * 2**14
 
 
 @pytest_asyncio.fixture
@@ -31,9 +38,28 @@ async def endpoint_port(unused_tcp_port_factory):
 
 
 @pytest_asyncio.fixture
-async def socks_server_port(unused_tcp_port_factory):
+async def echo_port(unused_tcp_port_factory):
     port = unused_tcp_port_factory()
-    handler = partial(socks_server_handler, socks_protocol_kw={})
+
+    async def handler(r, w):
+        while True:
+            b = await r.read(8192)
+            if not b:
+                break
+            w.write(b)
+            await w.drain()
+        w.close()
+
+    server = await asyncio.start_server(handler, HOST, port)
+    yield port
+    server.close()
+    await server.wait_closed()
+
+
+@pytest_asyncio.fixture(params=[False, True], ids=["copy", "splice"])
+async def socks_server_port(request, unused_tcp_port_factory):
+    port = unused_tcp_port_factory()
+    handler = partial(socks_server_handler, socks_protocol_kw={}, io_kw=dict(splice=request.param))
     server = socketserver.ThreadingTCPServer((HOST, port), handler)
     server.socket.settimeout(0.5)
     thread = threading.Thread(target=server.serve_forever, args=[0.01])
@@ -74,3 +100,359 @@ async def test_connection_partly_passed_error(endpoint_port, socks_server_port):
             socks_host=HOST,
             socks_port=socks_server_port,
         )
+
+
+@pytest.mark.asyncio
+async def test_connection_socks_bulk(echo_port, socks_server_port):
+    r, w = await open_connection(
+        HOST,
+        echo_port,
+        socks_host=HOST,
+        socks_port=socks_server_port,
+        socks_version=5,
+    )
+
+    async def send():
+        w.write(PAYLOAD)
+        await w.drain()
+        # half-close must reach endpoint, which closes connection in response
+        w.write_eof()
+
+    _, m = await asyncio.wait_for(asyncio.gather(send(), r.read()), timeout=5)
+    assert m == PAYLOAD
+    w.close()
+
+
+@pytest.mark.asyncio
+async def test_metrics(echo_port, unused_tcp_port_factory):
+    metrics = ServerMetrics()
+    socks_server_port = unused_tcp_port_factory()
+    handler = partial(socks_server_handler, socks_protocol_kw={}, metrics=metrics)
+    server = socketserver.ThreadingTCPServer((HOST, socks_server_port), handler)
+    thread = threading.Thread(target=server.serve_forever, args=[0.01])
+    thread.start()
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    try:
+        r, w = await open_connection(HOST, echo_port, **kw)
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+        failed_port = unused_tcp_port_factory()
+        with pytest.raises(SocksException):
+            await open_connection(HOST, failed_port, **kw)
+        for _ in range(100):
+            if metrics.transferred.value(direction="down"):
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+    assert metrics.accepted.value() == 2
+    assert metrics.handshake_seconds.count(version=5) == 1
+    assert metrics.connect_seconds.count(destination=f"{HOST}:{echo_port}") == 1
+    assert metrics.connect_failures.value(destination=f"{HOST}:{failed_port}") == 1
+    assert metrics.active_tunnels.value() == 0
+    assert metrics.transferred.value(direction="up") == len(MESSAGE)
+    assert metrics.transferred.value(direction="down") == len(MESSAGE)
+
+
+@pytest.mark.asyncio
+async def test_hooks(echo_port, unused_tcp_port_factory, hooks):
+    socks_server_port = unused_tcp_port_factory()
+    handler = partial(socks_server_handler, socks_protocol_kw={}, hooks_factory=lambda: hooks)
+    server = socketserver.ThreadingTCPServer((HOST, socks_server_port), handler)
+    thread = threading.Thread(target=server.serve_forever, args=[0.01])
+    thread.start()
+    try:
+        r, w = await open_connection(HOST, echo_port, socks_host=HOST, socks_port=socks_server_port, socks_version=4)
+        w.write(MESSAGE)
+        assert await r.read(8192) == MESSAGE
+        w.close()
+        for _ in range(100):
+            if len(hooks.events) == 5:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+    assert hooks.events == [
+        "read",
+        "connect",
+        "write",
+        "passthrough_started",
+        ("passthrough_finished", (len(MESSAGE), len(MESSAGE))),
+    ]
+
+
+def test_create_connection_happy_eyeballs(dual_addresses, monkeypatch):
+    with socket.create_server((HOST, 0)) as server:
+        port = server.getsockname()[1]
+        infos = dual_addresses(port)
+        monkeypatch.setattr(socket, "getaddrinfo", lambda *_, **__: infos)
+        started = time.monotonic()
+        with create_connection(("destination.test", port), happy_eyeballs_delay=0.05) as sock:
+            assert sock.getpeername() == (HOST, port)
+            assert sock.getblocking()
+        assert time.monotonic() - started < 1
+
+
+def test_create_connection_failed(unused_tcp_port, monkeypatch):
+    infos = [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (HOST, unused_tcp_port))] * 2
+    monkeypatch.setattr(socket, "getaddrinfo", lambda *_, **__: infos)
+    with pytest.raises(ConnectionRefusedError):
+        create_connection(("destination.test", unused_tcp_port), happy_eyeballs_delay=None)
+
+
+@pytest.mark.asyncio
+async def test_happy_eyeballs(echo_port, socks_server_port, dual_addresses, monkeypatch):
+    getaddrinfo = socket.getaddrinfo
+    infos = dual_addresses(echo_port)
+
+    def fake_getaddrinfo(host, *args, **kwargs):
+        return infos if host == "destination.test" else getaddrinfo(host, *args, **kwargs)
+
+    monkeypatch.setattr(socket, "getaddrinfo", fake_getaddrinfo)
+    started = time.monotonic()
+    r, w = await open_connection(
+        "destination.test", echo_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5
+    )
+    w.write(MESSAGE)
+    assert await r.read(8192) == MESSAGE
+    assert time.monotonic() - started < 1
+    w.close()
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def factory(limits=None, buffer_pool=None, metrics=None, **io_kw):
+        handler = partial(
+            socks_server_handler,
+            socks_protocol_kw={},
+            io_kw=io_kw,
+            limits=limits,
+            buffer_pool=buffer_pool,
+            metrics=metrics,
+        )
+        server = socketserver.ThreadingTCPServer((HOST, 0), handler)
+        # destinations are served by test event loop, which may be closed before tunnels see end of file
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, args=[0.01])
+        thread.start()
+        servers.append((server, thread))
+        return server.server_address[1]
+
+    yield factory
+    for server, thread in servers:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+@pytest.mark.asyncio
+async def test_handshake_timeout(serve):
+    socks_server_port = serve(handshake_timeout=0.1)
+    r, w = await asyncio.open_connection(HOST, socks_server_port)
+    w.write(b"\x05")
+    assert await asyncio.wait_for(r.read(8192), 1) == b""
+    w.close()
+
+
+@pytest.mark.asyncio
+async def test_connect_timeout(serve, blackhole, unused_tcp_port):
+    host, port = blackhole(unused_tcp_port)
+    socks_server_port = serve(connect_timeout=0.1)
+    with pytest.raises(SocksException):
+        await asyncio.wait_for(
+            open_connection(host, port, socks_host=HOST, socks_port=socks_server_port, socks_version=5), 1
+        )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("splice", [False, True], ids=["copy", "splice"])
+async def test_idle_timeout(serve, echo_port, splice):
+    socks_server_port = serve(splice=splice, idle_timeout=0.2)
+    r, w = await open_connection(HOST, echo_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    w.write(MESSAGE)
+    assert await r.read(8192) == MESSAGE
+    await asyncio.sleep(0.1)
+    w.write(MESSAGE)
+    assert await r.read(8192) == MESSAGE
+    assert await asyncio.wait_for(r.read(8192), 1) == b""
+    w.close()
+
+
+@pytest.mark.asyncio
+async def test_max_connections_per_ip(serve, echo_port):
+    limits = ServerLimits(max_connections_per_ip=1)
+    kw = dict(socks_host=HOST, socks_port=serve(limits=limits), socks_version=5)
+    r, w = await open_connection(HOST, echo_port, **kw)
+    with pytest.raises(SocksException, match="0x02"):
+        await open_connection(HOST, echo_port, **kw)
+    w.close()
+    for _ in range(100):
+        if not limits.connections:
+            break
+        await asyncio.sleep(0.01)
+    r, w = await open_connection(HOST, echo_port, **kw)
+    w.write(MESSAGE)
+    assert await r.read(8192) == MESSAGE
+    w.close()
+
+
+@pytest.mark.asyncio
+async def test_rejected_connections_bounded(serve, echo_port):
+    limits = ServerLimits(max_connections=1, max_rejecting=1, rejection_timeout=0.2)
+    port = serve(limits=limits)
+    r, w = await open_connection(HOST, echo_port, socks_host=HOST, socks_port=port, socks_version=5)
+    idle = [await asyncio.open_connection(HOST, port) for _ in range(10)]
+    await asyncio.sleep(0.05)
+    assert limits.rejecting == 1
+    for ir, iw in idle:
+        assert await asyncio.wait_for(ir.read(8192), 1) == b""
+        iw.close()
+    for _ in range(100):
+        if not limits.rejecting:
+            break
+        await asyncio.sleep(0.01)
+    assert limits.rejecting == 0
+    w.close()
+
+
+@pytest.mark.asyncio
+async def test_max_connecting(serve, echo_port, blackhole, unused_tcp_port):
+    limits = ServerLimits(max_connecting=1)
+    kw = dict(socks_host=HOST, socks_port=serve(limits=limits, connect_timeout=1), socks_version=5)
+    hanging = asyncio.ensure_future(open_connection(*blackhole(unused_tcp_port), **kw))
+    try:
+        for _ in range(100):
+            if limits.connecting:
+                break
+            await asyncio.sleep(0.01)
+        with pytest.raises(SocksException, match="0x02"):
+            await open_connection(HOST, echo_port, **kw)
+    finally:
+        hanging.cancel()
+
+
+@pytest.mark.asyncio
+async def test_early_data(echo_port, socks_server_port):
+    r, w = await open_connection(
+        HOST,
+        echo_port,
+        socks_host=HOST,
+        socks_port=socks_server_port,
+        socks_version=5,
+        optimistic=True,
+        early_data=MESSAGE,
+    )
+    assert await r.read(8192) == MESSAGE
+    w.write(MESSAGE)
+    assert await r.read(8192) == MESSAGE
+    w.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("splice", [False, True], ids=["copy", "splice"])
+async def test_adaptive_block_size(serve, echo_port, splice):
+    socks_server_port = serve(splice=splice, block_size=1024, max_block_size=2**18)
+    r, w = await open_connection(HOST, echo_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    w.write(PAYLOAD)
+    w.write_eof()
+    assert await asyncio.wait_for(r.read(), 5) == PAYLOAD
+    w.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("splice", [False, True], ids=["copy", "splice"])
+async def test_metrics_running_tunnel(serve, echo_port, splice):
+    metrics = ServerMetrics()
+    socks_server_port = serve(metrics=metrics, splice=splice)
+    r, w = await open_connection(HOST, echo_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    w.write(PAYLOAD)
+    assert await asyncio.wait_for(r.readexactly(len(PAYLOAD)), 5) == PAYLOAD
+    # bytes are counted in batches before tunnel ends
+    assert metrics.transferred.value(direction="up") >= len(PAYLOAD) - TRANSFERRED_BATCH_SIZE
+    assert metrics.transferred.value(direction="down") >= len(PAYLOAD) - TRANSFERRED_BATCH_SIZE
+    w.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("max_block_size", [None, 2**18], ids=["fixed", "adaptive"])
+async def test_buffer_pool(serve, echo_port, max_block_size):
+    pool = BufferPool(size=4, buffer_size=2**16)
+    socks_server_port = serve(buffer_pool=pool, max_block_size=max_block_size)
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    for _ in range(2):
+        r, w = await open_connection(HOST, echo_port, **kw)
+        w.write(PAYLOAD)
+        w.write_eof()
+        assert await asyncio.wait_for(r.read(), 5) == PAYLOAD
+        w.close()
+    # buffers are returned after each sent chunk, so tunnels reuse few of them
+    assert pool.hits > 100
+    assert pool.misses <= 4
+
+
+def test_tunnel_interest_changes():
+    a, b = socket.socketpair()
+    c, d = socket.socketpair()
+    with a, b, c, d:
+        tunnel = Tunnel(b, c)
+        assert tunnel.interest() == {b: selectors.EVENT_READ, c: selectors.EVENT_READ}
+        a.sendall(MESSAGE)
+        # chunk is sent right away, so registrations stay as they are
+        assert not tunnel.process(b, selectors.EVENT_READ)
+        assert d.recv(8192) == MESSAGE
+        a.shutdown(socket.SHUT_WR)
+        assert tunnel.process(b, selectors.EVENT_READ)
+        assert tunnel.interest() == {b: 0, c: selectors.EVENT_READ}
+
+
+def test_own_buffer_follows_block_size():
+    a, b = socket.socketpair()
+    c, d = socket.socketpair()
+    with a, b, c, d:
+        b.setblocking(False)
+        c.setblocking(False)
+        relay = CopyRelay(b, c, block_size=1024, max_block_size=2**16)
+        sizes = []
+        for _ in range(4):
+            a.sendall(bytes(relay.block.size))
+            relay.process(b, selectors.EVENT_READ)
+            sizes.append(len(relay.buffer))
+            while relay.pending:
+                d.recv(2**17)
+                relay.process(c, selectors.EVENT_WRITE)
+        # buffer is allocated at current block size, not at maximum up front
+        assert sizes == [1024, 2048, 4096, 8192]
+
+
+@pytest.mark.asyncio
+async def test_socket_options(serve, echo_port, socket_options):
+    socks_server_port = serve(socket_options=socket_options)
+    r, w = await open_connection(HOST, echo_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    w.write(MESSAGE)
+    assert await asyncio.wait_for(r.read(8192), 1) == MESSAGE
+    w.close()
+    assert sorted(kind for kind, _ in socket_options.tuned) == ["connection", "outgoing"]
+    assert all(keepalive for _, keepalive in socket_options.tuned)
+
+
+@pytest.mark.asyncio
+async def test_source_addresses(serve, peer_port, source_addresses):
+    socks_server_port = serve(source_addresses=source_addresses)
+    peers = []
+    for _ in range(2):
+        r, w = await open_connection(HOST, peer_port, socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+        peers.append(await asyncio.wait_for(r.read(), 1))
+        w.close()
+    for _ in range(100):
+        if not any(source_addresses.active.values()):
+            break
+        await asyncio.sleep(0.01)
+    assert peers == [b"127.0.0.3", b"127.0.0.4"]
+    assert source_addresses.active == {"127.0.0.3": 0, "127.0.0.4": 0}
@@ -0,0 +1,64 @@
+import socket
+
+import pytest
+
+from siosocks.sockopts import IP_BIND_ADDRESS_NO_PORT, SocketOptions
+
+
+def test_empty_profile():
+    options = SocketOptions()
+    assert options.options == []
+    assert options.listener_options == []
+
+
+def test_keepalive_implied():
+    assert SocketOptions(keepalive_count=3).keepalive is True
+    assert SocketOptions(keepalive=False, keepalive_count=3).keepalive is False
+    assert SocketOptions().keepalive is None
+
+
+@pytest.mark.parametrize("name", ["send_buffer", "keepalive_idle", "notsent_lowat", "fastopen"])
+def test_bad_values(name):
+    with pytest.raises(ValueError):
+        SocketOptions(**{name: 0})
+
+
+def test_apply():
+    options = SocketOptions(nodelay=True, keepalive_idle=42, receive_buffer=2**16)
+    with socket.socket() as sock:
+        options.apply(sock)
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE) == 42
+        # linux doubles requested size for bookkeeping
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 2**16
+
+
+@pytest.mark.skipif(IP_BIND_ADDRESS_NO_PORT is None, reason="IP_BIND_ADDRESS_NO_PORT is not available")
+def test_apply_outgoing():
+    with socket.socket() as sock:
+        SocketOptions().apply_outgoing(sock)
+        assert sock.getsockopt(socket.IPPROTO_IP, IP_BIND_ADDRESS_NO_PORT)
+
+
+@pytest.mark.skipif(not hasattr(socket, "TCP_FASTOPEN"), reason="TCP_FASTOPEN is not available")
+def test_apply_listener():
+    with socket.create_server(("127.0.0.1", 0)) as sock:
+        SocketOptions(fastopen=16).apply_listener(sock)
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN) == 16
+
+
+def test_non_inet_socket_skipped():
+    a, b = socket.socketpair()
+    with a, b:
+        SocketOptions(nodelay=True).apply(a)
+        SocketOptions(nodelay=True).apply_listener(b)
+
+
+def test_failures_are_not_raised():
+    options = SocketOptions(nodelay=True)
+    sock = socket.socket()
+    sock.close()
+    # connection keeps kernel defaults
+    options.apply(sock)
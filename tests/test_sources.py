@@ -0,0 +1,61 @@
+import socket
+
+import pytest
+
+from siosocks.sources import SourceAddresses
+
+ADDRESSES = ["127.0.0.3", "127.0.0.4"]
+
+
+def bind_all(pool, count, family=socket.AF_INET):
+    sockets = [socket.socket(family) for _ in range(count)]
+    return sockets, [pool.bind(sock) for sock in sockets]
+
+
+def test_round_robin():
+    pool = SourceAddresses(ADDRESSES)
+    sockets, addresses = bind_all(pool, 3)
+    assert list(map(str, addresses)) == ["127.0.0.3", "127.0.0.4", "127.0.0.3"]
+    assert [sock.getsockname()[0] for sock in sockets] == list(map(str, addresses))
+    assert pool.active == {"127.0.0.3": 2, "127.0.0.4": 1}
+    for sock in sockets:
+        pool.close(sock)
+    assert pool.active == {"127.0.0.3": 0, "127.0.0.4": 0}
+
+
+def test_least_connections():
+    pool = SourceAddresses(ADDRESSES + ["127.0.0.5"], strategy="least-connections")
+    sockets, addresses = bind_all(pool, 3)
+    assert sorted(map(str, addresses)) == ["127.0.0.3", "127.0.0.4", "127.0.0.5"]
+    # 127.0.0.4 is least loaded after release, so it is taken twice in a row
+    pool.close(sockets[1])
+    more, addresses = bind_all(pool, 1)
+    assert str(addresses[0]) == "127.0.0.4"
+    for sock in sockets[::2] + more:
+        pool.close(sock)
+    assert set(pool.active.values()) == {0}
+
+
+def test_family_without_addresses():
+    pool = SourceAddresses(ADDRESSES)
+    with socket.socket(socket.AF_INET6) as sock:
+        assert pool.bind(sock) is None
+        assert pool.address_of(sock) is None
+
+
+def test_bind_failure_releases():
+    pool = SourceAddresses(ADDRESSES[:1])
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        with pytest.raises(OSError):
+            pool.bind(sock)
+    assert pool.active == {"127.0.0.3": 0}
+
+
+@pytest.mark.parametrize(
+    "addresses, strategy",
+    [([], "round-robin"), (["localhost"], "round-robin"), (ADDRESSES, "random")],
+)
+def test_bad_values(addresses, strategy):
+    with pytest.raises(ValueError):
+        SourceAddresses(addresses, strategy=strategy)
@@ -1,10 +1,15 @@
+import math
+import socket
 from functools import partial
 
 import pytest
 import trio
+import trio.testing
 
 from siosocks.exceptions import SocksException
-from siosocks.io.trio import open_tcp_stream, socks_server_handler
+from siosocks.io.trio import ClientPool, Resolver, _PrefixedStream, open_tcp_stream, socks_server_handler
+from siosocks.limits import ServerLimits
+from siosocks.metrics import ServerMetrics
 
 # TODO: Use fixtures after https://github.com/pytest-dev/pytest-asyncio/issues/124 resolved
 
@@ -70,3 +75,368 @@ async def test_connection_partly_passed_error(nursery):
             socks_host=HOST,
             socks_port=socks_server_port,
         )
+
+
+@pytest.mark.trio
+async def test_metrics(nursery):
+    async def handler(stream):
+        async with stream:
+            await stream.send_all(await stream.receive_some(8192))
+
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, endpoint_port, *_ = listeners[0].socket.getsockname()
+    metrics = ServerMetrics()
+    socks_handler = partial(socks_server_handler, metrics=metrics)
+    listeners = await nursery.start(partial(trio.serve_tcp, socks_handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    async with await open_tcp_stream(HOST, endpoint_port, **kw) as stream:
+        await stream.send_all(MESSAGE)
+        assert await stream.receive_some(8192) == MESSAGE
+    with pytest.raises(SocksException):
+        await open_tcp_stream(HOST, 1, **kw)
+    for _ in range(100):
+        if not metrics.active_tunnels.value() and metrics.transferred.value(direction="down"):
+            break
+        await trio.sleep(0.01)
+    assert metrics.active_tunnels.value() == 0
+    assert metrics.accepted.value() == 2
+    assert metrics.handshake_seconds.count(version=5) == 1
+    assert metrics.connect_failures.value(destination=f"{HOST}:1") == 1
+    assert metrics.transferred.value(direction="up") == len(MESSAGE)
+
+
+@pytest.mark.trio
+async def test_hooks(nursery, hooks):
+    endpoint_port = await endpoint(nursery)
+    handler = partial(socks_server_handler, hooks_factory=lambda: hooks)
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    stream = await open_tcp_stream(HOST, endpoint_port, socks_host=HOST, socks_port=socks_server_port, socks_version=4)
+    async with stream:
+        await stream.send_all(MESSAGE)
+        assert await stream.receive_some(8192) == MESSAGE
+    assert hooks.connects == [(HOST, endpoint_port, None)]
+    assert [e for e in hooks.events if e in ("connect", "passthrough_started")] == ["connect", "passthrough_started"]
+
+
+@pytest.mark.trio
+async def test_resolver(nursery):
+    resolver = Resolver()
+    endpoint_port = await endpoint(nursery)
+    handler = partial(socks_server_handler, resolver=resolver)
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    for _ in range(2):
+        async with await open_tcp_stream("localhost", endpoint_port, **kw) as stream:
+            await stream.send_all(MESSAGE)
+            assert await stream.receive_some(8192) == MESSAGE
+    assert resolver.cache.get("localhost") is not None
+
+
+@pytest.mark.trio
+async def test_resolver_coalescing(monkeypatch):
+    calls = []
+
+    async def getaddrinfo(host, port, **kw):
+        calls.append(host)
+        await trio.sleep(0.01)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", 0))]
+
+    monkeypatch.setattr(trio.socket, "getaddrinfo", getaddrinfo)
+    resolver = Resolver()
+    results = []
+
+    async def resolve(port):
+        results.append(await resolver.resolve("python.org", port))
+
+    async with trio.open_nursery() as n:
+        for port in range(10):
+            n.start_soon(resolve, port)
+    assert calls == ["python.org"]
+    assert len(results) == 10
+
+
+@pytest.mark.trio
+async def test_happy_eyeballs(nursery, dual_addresses, monkeypatch):
+    endpoint_port = await endpoint(nursery)
+    infos = dual_addresses(endpoint_port)
+    getaddrinfo = trio.socket.getaddrinfo
+
+    async def fake_getaddrinfo(host, *args, **kwargs):
+        return infos if host == "destination.test" else await getaddrinfo(host, *args, **kwargs)
+
+    monkeypatch.setattr(trio.socket, "getaddrinfo", fake_getaddrinfo)
+    handler = partial(socks_server_handler, resolver=Resolver(), happy_eyeballs_delay=0.05)
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    with trio.fail_after(1):
+        async with await open_tcp_stream("destination.test", endpoint_port, **kw) as stream:
+            await stream.send_all(MESSAGE)
+            assert await stream.receive_some(8192) == MESSAGE
+
+
+@pytest.mark.trio
+async def test_happy_eyeballs_disabled(nursery, monkeypatch):
+    endpoint_port = await endpoint(nursery)
+    delays = []
+    open_tcp_stream_ = trio.open_tcp_stream
+
+    async def recording_open_tcp_stream(host, port, **kwargs):
+        if port == endpoint_port:
+            delays.append(kwargs["happy_eyeballs_delay"])
+        return await open_tcp_stream_(host, port, **kwargs)
+
+    monkeypatch.setattr(trio, "open_tcp_stream", recording_open_tcp_stream)
+    handler = partial(socks_server_handler, happy_eyeballs_delay=None)
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    with trio.fail_after(1):
+        async with await open_tcp_stream(HOST, endpoint_port, **kw) as stream:
+            await stream.send_all(MESSAGE)
+            assert await stream.receive_some(8192) == MESSAGE
+    # trio would use its own 0.25 seconds delay for `None`
+    assert delays == [math.inf]
+
+
+@pytest.mark.trio
+async def test_handshake_timeout(nursery):
+    handler = partial(socks_server_handler, handshake_timeout=0.1)
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    with trio.fail_after(1):
+        async with await trio.open_tcp_stream(HOST, socks_server_port) as stream:
+            await stream.send_all(b"\x05")
+            assert await stream.receive_some(8192) == b""
+
+
+@pytest.mark.trio
+async def test_connect_timeout(nursery, blackhole, unused_tcp_port):
+    host, port = blackhole(unused_tcp_port)
+    handler = partial(socks_server_handler, connect_timeout=0.1)
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    with trio.fail_after(1), pytest.raises(SocksException):
+        await open_tcp_stream(host, port, socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+
+
+@pytest.mark.trio
+async def test_idle_timeout(nursery):
+    endpoint_port = await endpoint(nursery)
+    handler = partial(socks_server_handler, idle_timeout=0.2)
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    with trio.fail_after(1):
+        async with await open_tcp_stream(HOST, endpoint_port, **kw) as stream:
+            await stream.send_all(MESSAGE)
+            assert await stream.receive_some(8192) == MESSAGE
+            await trio.sleep(0.1)
+            await stream.send_all(MESSAGE)
+            assert await stream.receive_some(8192) == MESSAGE
+            assert await stream.receive_some(8192) == b""
+
+
+@pytest.mark.trio
+async def test_max_connections_per_ip(nursery):
+    endpoint_port = await endpoint(nursery)
+    limits = ServerLimits(max_connections_per_ip=1)
+    handler = partial(socks_server_handler, limits=limits)
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    with trio.fail_after(1):
+        # connection slot is taken on accept, before handshake
+        stream = await trio.open_tcp_stream(HOST, socks_server_port)
+        for _ in range(100):
+            if limits.connections:
+                break
+            await trio.sleep(0.01)
+        with pytest.raises(SocksException, match="0x02"):
+            await open_tcp_stream(HOST, endpoint_port, **kw)
+        await stream.aclose()
+        for _ in range(100):
+            if not limits.connections:
+                break
+            await trio.sleep(0.01)
+        async with await open_tcp_stream(HOST, endpoint_port, **kw) as stream:
+            await stream.send_all(MESSAGE)
+            assert await stream.receive_some(8192) == MESSAGE
+
+
+@pytest.mark.trio
+async def test_rejected_connections_bounded(nursery):
+    limits = ServerLimits(max_connections=1, max_rejecting=1, rejection_timeout=0.2)
+    handler = partial(socks_server_handler, limits=limits)
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    with trio.fail_after(2):
+        stream = await trio.open_tcp_stream(HOST, socks_server_port)
+        idle = [await trio.open_tcp_stream(HOST, socks_server_port) for _ in range(10)]
+        await trio.sleep(0.05)
+        assert limits.rejecting == 1
+        for idle_stream in idle:
+            assert await idle_stream.receive_some(8192) == b""
+            await idle_stream.aclose()
+        for _ in range(100):
+            if not limits.rejecting:
+                break
+            await trio.sleep(0.01)
+        assert limits.rejecting == 0
+        await stream.aclose()
+
+
+@pytest.mark.trio
+async def test_max_connecting(nursery, blackhole, unused_tcp_port):
+    endpoint_port = await endpoint(nursery)
+    limits = ServerLimits(max_connecting=1)
+    handler = partial(socks_server_handler, limits=limits)
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    with trio.move_on_after(1) as hanging:
+        nursery.start_soon(partial(open_tcp_stream, *blackhole(unused_tcp_port), **kw))
+        for _ in range(100):
+            if limits.connecting:
+                break
+            await trio.sleep(0.01)
+        with pytest.raises(SocksException, match="0x02"):
+            await open_tcp_stream(HOST, endpoint_port, **kw)
+    assert not hanging.cancelled_caught
+
+
+@pytest.mark.trio
+@pytest.mark.parametrize("socks_version", [4, 5])
+async def test_client_pool(nursery, socks_version):
+    endpoint_port = await endpoint(nursery)
+    accepted = []
+
+    async def handler(stream):
+        accepted.append(stream)
+        await socks_server_handler(stream)
+
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    with trio.fail_after(1):
+        async with ClientPool(HOST, socks_server_port, socks_version, size=2) as pool:
+            for _ in range(100):
+                if pool.idle == 2:
+                    break
+                await trio.sleep(0.01)
+            assert len(accepted) == 2
+            for _ in range(3):
+                async with await pool.open_tcp_stream(HOST, endpoint_port) as stream:
+                    await stream.send_all(MESSAGE)
+                    assert await stream.receive_some(8192) == MESSAGE
+        assert pool.idle == 0
+
+
+@pytest.mark.trio
+async def test_client_pool_expired(nursery):
+    accepted = []
+
+    async def handler(stream):
+        accepted.append(stream)
+        await socks_server_handler(stream)
+
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    with trio.fail_after(1):
+        async with ClientPool(HOST, socks_server_port, 5, size=1, ttl=0.05):
+            for _ in range(100):
+                if len(accepted) >= 3:
+                    break
+                await trio.sleep(0.01)
+    assert len(accepted) >= 3
+
+
+@pytest.mark.trio
+@pytest.mark.parametrize("optimistic", [False, True])
+async def test_early_data(nursery, optimistic):
+    endpoint_port = await endpoint(nursery)
+    handler = partial(socks_server_handler, allowed_versions={5}, username="yoba", password="foo")
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5, username="yoba", password="foo")
+    with trio.fail_after(1):
+        async with await open_tcp_stream(HOST, endpoint_port, optimistic=optimistic, early_data=MESSAGE, **kw) as s:
+            assert await s.receive_some(8192) == MESSAGE
+            await s.send_all(MESSAGE)
+            assert await s.receive_some(8192) == MESSAGE
+
+
+@pytest.mark.trio
+async def test_client_leftover():
+    a, b = trio.testing.memory_stream_pair()
+    stream = _PrefixedStream(a, b"hello ")
+    await b.send_all(b"world")
+    assert await stream.receive_some(3) == b"hel"
+    assert await stream.receive_some() == b"lo "
+    assert await stream.receive_some(8192) == b"world"
+    await stream.send_all(MESSAGE)
+    assert await b.receive_some(8192) == MESSAGE
+
+
+@pytest.mark.trio
+async def test_adaptive_block_size(nursery):
+    endpoint_port = await endpoint(nursery)
+    handler = partial(socks_server_handler, block_size=1024, max_block_size=2**18)
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    payload = bytes(range(256)) * 2**12
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    received = bytearray()
+    with trio.fail_after(5):
+        async with await open_tcp_stream(HOST, endpoint_port, **kw) as stream:
+            async with trio.open_nursery() as n:
+                n.start_soon(stream.send_all, payload)
+                while len(received) < len(payload):
+                    received += await stream.receive_some(2**16)
+    assert received == payload
+
+
+@pytest.mark.trio
+@pytest.mark.parametrize("cached", [False, True], ids=["uncached", "cached"])
+async def test_socket_options(nursery, socket_options, cached):
+    endpoint_port = await endpoint(nursery)
+    resolver = Resolver() if cached else None
+    handler = partial(socks_server_handler, socket_options=socket_options, resolver=resolver)
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    with trio.fail_after(1):
+        async with await open_tcp_stream(HOST, endpoint_port, **kw) as s:
+            await s.send_all(MESSAGE)
+            assert await s.receive_some(8192) == MESSAGE
+    assert sorted(kind for kind, _ in socket_options.tuned) == ["connection", "outgoing"]
+    assert all(keepalive for _, keepalive in socket_options.tuned)
+
+
+@pytest.mark.trio
+@pytest.mark.parametrize("cached", [False, True], ids=["uncached", "cached"])
+async def test_source_addresses(nursery, source_addresses, cached):
+    async def peer(stream):
+        async with stream:
+            await stream.send_all(stream.socket.getpeername()[0].encode())
+
+    listeners = await nursery.start(partial(trio.serve_tcp, peer, 0, host=HOST))
+    _, peer_port, *_ = listeners[0].socket.getsockname()
+    resolver = Resolver() if cached else None
+    handler = partial(socks_server_handler, source_addresses=source_addresses, resolver=resolver)
+    listeners = await nursery.start(partial(trio.serve_tcp, handler, 0, host=HOST))
+    _, socks_server_port, *_ = listeners[0].socket.getsockname()
+    kw = dict(socks_host=HOST, socks_port=socks_server_port, socks_version=5)
+    peers = []
+    with trio.fail_after(1):
+        for _ in range(2):
+            async with await open_tcp_stream(HOST, peer_port, **kw) as s:
+                peers.append(await s.receive_some(8192))
+    for _ in range(100):
+        if not any(source_addresses.active.values()):
+            break
+        await trio.sleep(0.01)
+    assert peers == [b"127.0.0.3", b"127.0.0.4"]
+    assert source_addresses.active == {"127.0.0.3": 0, "127.0.0.4": 0}